@@ -0,0 +1,359 @@
+# coding: utf-8
+# author: luyf
+# create date: 2016.12.14
+
+import argparse
+import json
+import os
+import shutil
+import tempfile
+import threading
+import time
+import SimpleHTTPServer
+import SocketServer
+
+import numpy as np
+from scoring import Candidates
+from searchengine import Crawler, Searcher, DEFAULT_WEIGHTS, TOP_K
+
+# 生成模拟语料的默认参数
+PAGES = 1000  # 网页数
+VOCABULARY = 5000  # 英文词汇量
+WORDS_PER_PAGE = 300  # 每个网页的平均单词数
+LINKS_PER_PAGE = 10  # 每个网页的平均外链数
+CHINESE_RATIO = 0.3  # 中文词的比例
+ZIPF_EXPONENT = 1.1  # 单词频率和网页受欢迎程度的Zipf指数
+QUERIES = 200  # 每种查询单词数执行的查询次数
+QUERY_WORDS = (1, 2, 3)  # 查询单词数
+PERCENTILES = (50, 90, 99)
+SCORING_SIZES = (10000, 100000, 1000000)  # 评分测试的候选网页数
+SCORING_PAGE_RANK_WEIGHTS = (1.0, 0.1)  # 评分测试的PageRank权重，权重越小MaxScore能筛掉的网页越多
+SCORING_REPEATS = 5  # 评分测试每项重复的次数，取最短耗时
+
+SYLLABLES = ['ka', 'lo', 'mi', 'ne', 'ru', 'ta', 'po', 'si', 'de', 'gu', 'ba', 'fe', 'ho', 'ji', 'qu', 'zo',
+             'an', 'el', 'in', 'or', 'us', 'ry', 'th', 'st']
+CHINESE_WORDS = [u'搜索', u'引擎', u'网页', u'链接', u'索引', u'数据库', u'排名', u'算法', u'中文', u'分词',
+                 u'机器', u'学习', u'神经', u'网络', u'查询', u'单词', u'位置', u'频度', u'文档', u'服务器',
+                 u'爬虫', u'编程', u'语言', u'计算', u'数据', u'结果', u'用户', u'系统', u'信息', u'技术',
+                 u'北京', u'上海', u'大学', u'学生', u'老师', u'时间', u'问题', u'方法', u'工作', u'社会']
+
+
+def zipf_probabilities(n, exponent=ZIPF_EXPONENT):
+    """
+    :return: 第i个元素的概率与 1/(i+1)^exponent 成正比
+    """
+    weights = 1.0 / np.arange(1, n + 1) ** exponent
+    return weights / weights.sum()
+
+
+def make_vocabulary(size, rs):
+    """
+    由音节随机组合出互不相同的英文单词
+    """
+    words = set()
+    while len(words) < size:
+        words.add(''.join(rs.choice(SYLLABLES, rs.randint(2, 5))))
+    words = sorted(words)
+    rs.shuffle(words)
+    return words
+
+
+def generate_corpus(directory, pages=PAGES, vocabulary=VOCABULARY, words_per_page=WORDS_PER_PAGE,
+                    links_per_page=LINKS_PER_PAGE, chinese_ratio=CHINESE_RATIO, seed=0):
+    """
+    生成模拟语料：单词按Zipf分布抽取，中英文混合，相邻的中文词之间没有空格；
+    外链数服从幂律分布，链接目标按网页受欢迎程度的Zipf分布选择，得到少数网页有大量回指链接的结构
+    :param directory: 网页保存的目录，网页为 p0.html ... p{pages-1}.html
+    :param pages: 网页数
+    :param vocabulary: 英文词汇量
+    :param words_per_page: 每个网页的平均单词数
+    :param links_per_page: 每个网页的平均外链数
+    :param chinese_ratio: 中文词的比例
+    :param seed: 随机数种子
+    :return: 语料的单词列表，按出现概率从高到低排列，供生成查询使用
+    """
+    rs = np.random.RandomState(seed)
+    english = make_vocabulary(vocabulary, rs)
+    words = english + CHINESE_WORDS
+    # 英文词和中文词各自按Zipf分布抽取，再按比例混合
+    probabilities = np.concatenate([zipf_probabilities(len(english)) * (1 - chinese_ratio),
+                                    zipf_probabilities(len(CHINESE_WORDS)) * chinese_ratio])
+    popularity = zipf_probabilities(pages)
+    popular_order = rs.permutation(pages)  # 受欢迎程度排名第i的网页
+
+    for page in range(pages):
+        text = []
+        last_chinese = False
+        for index in rs.choice(len(words), rs.poisson(words_per_page) + 1, p=probabilities):
+            chinese = index >= len(english)
+            if chinese and last_chinese:
+                text[-1] += words[index]  # 中文词直接接在前一个中文词后面
+            else:
+                text.append(words[index])
+            last_chinese = chinese
+        link_count = min(int(rs.pareto(2.0) * links_per_page) + 1, pages - 1)
+        targets = popular_order[rs.choice(pages, link_count, p=popularity)]
+        links = []
+        for target in targets:
+            if target == page:
+                continue
+            anchor = ' '.join(words[i] for i in rs.choice(len(words), rs.randint(1, 4), p=probabilities))
+            links.append(u'<a href="p%d.html">%s</a>' % (target, anchor))
+        paragraphs = [u' '.join(text[i:i + 50]) for i in range(0, len(text), 50)]
+        html = u'<html><head><title>%s</title></head><body>%s<div>%s</div></body></html>' % (
+            text[0], u''.join(u'<p>%s</p>' % p for p in paragraphs), u' '.join(links))
+        f = open(os.path.join(directory, 'p%d.html' % page), 'wb')
+        f.write(html.encode('utf-8'))
+        f.close()
+    order = np.argsort(-probabilities)
+    return [words[i] for i in order]
+
+
+class QuietHandler(SimpleHTTPServer.SimpleHTTPRequestHandler):
+    def log_message(self, format, *args):
+        pass
+
+
+class CorpusServer(SocketServer.ThreadingMixIn, SocketServer.TCPServer):
+    """
+    在后台线程中提供语料目录中网页的本地HTTP服务
+    """
+    daemon_threads = True
+    allow_reuse_address = True
+    request_queue_size = 128
+
+    def __init__(self, directory, port=0):
+        directory = os.path.abspath(directory)
+
+        class Handler(QuietHandler):
+            def translate_path(self, path):
+                return os.path.join(directory, os.path.basename(path.split('?')[0]))
+
+        SocketServer.TCPServer.__init__(self, ('127.0.0.1', port), Handler)
+        self.thread = threading.Thread(target=self.serve_forever)
+        self.thread.daemon = True
+        self.thread.start()
+
+    def url(self, name):
+        return 'http://127.0.0.1:%d/%s' % (self.server_address[1], name)
+
+    def close(self):
+        self.shutdown()
+        self.server_close()
+
+
+def count_rows(con):
+    return dict((table, con.execute('select count(*) from %s' % table).fetchone()[0])
+                for table in ('urllist', 'wordlist', 'wordlocation', 'link', 'linkwords'))
+
+
+def latency_stats(latencies):
+    """
+    :param latencies: 耗时列表（秒）
+    :return: 以毫秒为单位的平均值和各百分位数
+    """
+    ms = np.array(latencies) * 1000
+    stats = {'count': len(latencies), 'mean_ms': float(ms.mean())}
+    for p in PERCENTILES:
+        stats['p%d_ms' % p] = float(np.percentile(ms, p))
+    return stats
+
+
+def benchmark_queries(db_name, vocabulary, queries=QUERIES, query_words=QUERY_WORDS, seed=0):
+    """
+    按查询单词数分组测量Searcher.top_k的耗时，查询单词按语料的单词频率抽取，不使用查询缓存
+    :param db_name: 数据库
+    :param vocabulary: 按出现概率从高到低排列的单词列表
+    :param queries: 每组查询次数
+    :param query_words: 查询单词数列表
+    :param seed: 随机数种子
+    :return: {单词数: 耗时统计}
+    """
+    rs = np.random.RandomState(seed)
+    probabilities = zipf_probabilities(len(vocabulary))
+    searcher = Searcher(db_name, cache_size=0)
+    searcher.top_k(vocabulary[0])  # 加载特征数据，不计入查询耗时
+    results = {}
+    for n in query_words:
+        latencies = []
+        matched = 0
+        for i in range(queries):
+            q = ' '.join(vocabulary[j] for j in rs.choice(len(vocabulary), n, replace=False, p=probabilities))
+            start = time.time()
+            if searcher.top_k(q):
+                matched += 1
+            latencies.append(time.time() - start)
+        results[str(n)] = latency_stats(latencies)
+        results[str(n)]['matched'] = matched
+    return results
+
+
+class SyntheticFeatures:
+    """
+    评分测试用的网页特征，PageRank值服从Pareto分布，与FeatureStore提供相同的按urlid取值接口
+    """
+    def __init__(self, size, rs):
+        self.page_rank = 0.15 + rs.pareto(1.5, size + 1)
+
+    def get_page_ranks(self, url_ids):
+        return self.page_rank[url_ids]
+
+    def get_inbounds(self, url_ids):
+        return np.zeros(len(url_ids), dtype=np.int64)
+
+
+def max_score_top_k(candidates, bounds, weights, k):
+    """
+    MaxScore提前结束的向量化版本，作为Candidates.top_k的对照：先算不含PageRank的部分得分，
+    第k大的部分得分是第k名得分的下界，PageRank归一化后不超过1，部分得分加上PageRank权重仍低于下界的网页不可能进入前k名，
+    只对其余网页加上PageRank得分再选出前k名，结果与对全部候选网页打分相同
+    :return: (按评价值从高到低排列的 [(评价值, urlid), ...], 没有被筛掉的网页数)
+    """
+    page_rank_weight = weights.get('page_rank', 0)
+    partial = candidates.score(bounds, dict(weights, page_rank=0))
+    n = len(partial)
+    if n <= k:
+        return candidates.top_k(candidates.score(bounds, weights), k), n
+    kept = np.nonzero(partial + page_rank_weight >= np.partition(partial, n - k)[n - k])[0]
+    scores = partial[kept] + page_rank_weight * candidates.page_rank[kept] / (bounds['page_rank'] or 1.0)
+    if len(kept) > k:
+        selected = np.nonzero(scores >= np.partition(scores, len(kept) - k)[len(kept) - k])[0]
+    else:
+        selected = np.arange(len(kept))
+    selected = selected[np.lexsort((candidates.url_ids[kept[selected]], scores[selected]))[::-1][:k]]
+    return zip(scores[selected].tolist(), candidates.url_ids[kept[selected]].tolist()), len(kept)
+
+
+def benchmark_scoring(sizes=SCORING_SIZES, page_rank_weights=SCORING_PAGE_RANK_WEIGHTS, k=TOP_K,
+                      repeats=SCORING_REPEATS, seed=0):
+    """
+    在模拟的长倒排列表上比较两种选出前k名的方法：对全部候选网页打分（Candidates.score+top_k）与MaxScore筛选，
+    频度服从Zipf分布，位置均匀分布，1%的网页有链接文字，只测量评分和选择，不包括求交集
+    :param sizes: 候选网页数列表
+    :param page_rank_weights: PageRank权重列表，其他特征使用默认权重
+    :param k: 结果数
+    :param repeats: 重复次数，取最短耗时
+    :param seed: 随机数种子
+    :return: [{'candidates', 'page_rank_weight', 'full_ms', 'max_score_ms', 'kept', 'same_results'}, ...]
+    """
+    results = []
+    for size in sizes:
+        rs = np.random.RandomState(seed)
+        candidates = Candidates(np.arange(1, size + 1), rs.zipf(2.0, size), rs.randint(0, 2000, size),
+                                np.zeros(size), SyntheticFeatures(size, rs))
+        candidates.link_text[rs.randint(0, size, size // 100)] = rs.rand(size // 100)
+        for page_rank_weight in page_rank_weights:
+            weights = dict(DEFAULT_WEIGHTS, page_rank=page_rank_weight)
+            bounds = candidates.get_bounds(weights)
+            timings = {'full': [], 'max_score': []}
+            for i in range(repeats):
+                start = time.time()
+                full = candidates.top_k(candidates.score(bounds, weights), k)
+                timings['full'].append(time.time() - start)
+                start = time.time()
+                pruned, kept = max_score_top_k(candidates, bounds, weights, k)
+                timings['max_score'].append(time.time() - start)
+            results.append({'candidates': size, 'page_rank_weight': page_rank_weight,
+                            'full_ms': min(timings['full']) * 1000, 'max_score_ms': min(timings['max_score']) * 1000,
+                            'kept': kept, 'same_results': full == pruned})
+    return results
+
+
+def run(output, directory=None, pages=PAGES, vocabulary=VOCABULARY, words_per_page=WORDS_PER_PAGE,
+        links_per_page=LINKS_PER_PAGE, chinese_ratio=CHINESE_RATIO, queries=QUERIES, fetchers=8,
+        bulk_index=True, seed=0):
+    """
+    生成语料并启动本地HTTP服务，依次测量抓取、PageRank计算和查询，结果以JSON格式写入output
+    :param output: 结果文件
+    :param directory: 语料和数据库所在的目录，默认使用临时目录并在结束后删除
+    :param fetchers: 抓取线程数，为0时使用单线程的Crawler.crawl
+    :param bulk_index: 是否使用批量索引模式
+    :return: 结果字典
+    """
+    keep = directory is not None
+    if directory is None:
+        directory = tempfile.mkdtemp(prefix='pci_benchmark_')
+    elif not os.path.exists(directory):
+        os.makedirs(directory)
+    db_name = os.path.join(directory, 'benchmark.db')
+    if os.path.exists(db_name):
+        os.remove(db_name)
+
+    result = {'time': time.strftime('%Y-%m-%d %H:%M:%S'),
+              'params': {'pages': pages, 'vocabulary': vocabulary, 'words_per_page': words_per_page,
+                         'links_per_page': links_per_page, 'chinese_ratio': chinese_ratio, 'queries': queries,
+                         'fetchers': fetchers, 'bulk_index': bulk_index, 'seed': seed}}
+    server = None
+    try:
+        start = time.time()
+        words = generate_corpus(directory, pages, vocabulary, words_per_page, links_per_page, chinese_ratio, seed)
+        result['generate_seconds'] = time.time() - start
+        server = CorpusServer(directory)
+
+        crawler = Crawler(db_name, bulk_index=bulk_index)
+        crawler.create_index_tables()
+        crawler.db_commit()
+        seeds = [server.url('p%d.html' % i) for i in range(pages)]  # 所有网页都作为种子，只抓取一层
+        start = time.time()
+        if fetchers > 0:
+            crawler.crawl_concurrent(seeds, depth=1, fetchers=fetchers, per_host=fetchers)
+        else:
+            crawler.crawl(seeds, depth=1)
+        elapsed = time.time() - start
+        rows = count_rows(crawler.con)
+        indexed = crawler.con.execute('select count(distinct urlid) from wordlocation').fetchone()[0]
+        result['crawl'] = {'seconds': elapsed, 'pages': indexed, 'pages_per_second': indexed / elapsed,
+                           'rows': rows, 'rows_per_second': sum(rows.values()) / elapsed}
+
+        start = time.time()
+        crawler.calculate_page_rank()
+        result['page_rank'] = {'seconds': time.time() - start}
+        crawler.con.close()
+
+        result['query'] = benchmark_queries(db_name, words, queries, seed=seed)
+    finally:
+        if server is not None:
+            server.close()
+        if not keep:
+            shutil.rmtree(directory, ignore_errors=True)
+
+    f = open(output, 'w')
+    json.dump(result, f, indent=2, sort_keys=True)
+    f.close()
+    return result
+
+
+def main():
+    parser = argparse.ArgumentParser(description=u'searchengine.py的性能测试')
+    parser.add_argument('--output', default='benchmark.json', help=u'JSON格式的结果文件')
+    parser.add_argument('--dir', default=None, help=u'语料和数据库所在的目录，默认使用临时目录')
+    parser.add_argument('--pages', type=int, default=PAGES)
+    parser.add_argument('--vocabulary', type=int, default=VOCABULARY)
+    parser.add_argument('--words-per-page', type=int, default=WORDS_PER_PAGE)
+    parser.add_argument('--links-per-page', type=int, default=LINKS_PER_PAGE)
+    parser.add_argument('--chinese-ratio', type=float, default=CHINESE_RATIO)
+    parser.add_argument('--queries', type=int, default=QUERIES)
+    parser.add_argument('--fetchers', type=int, default=8, help=u'抓取线程数，为0时单线程抓取')
+    parser.add_argument('--no-bulk', action='store_true', help=u'不使用批量索引模式')
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--scoring', action='store_true', help=u'只比较对全部候选网页打分与MaxScore筛选的耗时')
+    args = parser.parse_args()
+    if args.scoring:
+        for row in benchmark_scoring(seed=args.seed):
+            print ('%(candidates)8d candidates, page_rank weight %(page_rank_weight).1f: full %(full_ms).2f ms, '
+                   'max_score %(max_score_ms).2f ms (kept %(kept)d, same results %(same_results)s)' % row)
+        return
+    result = run(args.output, args.dir, args.pages, args.vocabulary, args.words_per_page, args.links_per_page,
+                 args.chinese_ratio, args.queries, args.fetchers, not args.no_bulk, args.seed)
+
+    print 'crawl: %.1f pages/s, %.0f rows/s' % (result['crawl']['pages_per_second'],
+                                                 result['crawl']['rows_per_second'])
+    print 'calculate_page_rank: %.3f s' % result['page_rank']['seconds']
+    for n in sorted(result['query']):
+        stats = result['query'][n]
+        print 'query %s words: ' % n + ', '.join('p%d %.2f ms' % (p, stats['p%d_ms' % p]) for p in PERCENTILES)
+    print 'results written to %s' % args.output
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,344 @@
+# coding: utf-8
+# author: luyf
+# create date: 2016.12.15
+
+import cPickle as pickle
+import os
+import struct
+import tempfile
+import zlib
+
+import numpy as np
+from searchengine import Crawler, IGNORE_WORDS, CRAWLER_DEPTH
+from tokenizer import separate_words_many
+from fetcher import FetchPool, FETCHERS, PER_HOST, DELAY
+
+
+SPOOL_PAGES = 100  # 记录文件中每个压缩块的网页数
+RUN_ROWS = 1000000  # 每个有序段在内存中排序的单词位置数，决定排序时的内存上限
+FAN_IN = 64  # 每一趟同时归并的有序段数，超过时分多趟归并
+BLOCK_ROWS = 65536  # 有序段文件中每个压缩块的单词位置数
+LINK_ROWS = 50000  # 缓冲的link和linkwords行数，达到后写入数据库
+BLOCK_HEADER = struct.Struct('<I')  # 压缩块长度
+
+
+def write_block(f, data):
+    data = zlib.compress(data, 1)
+    f.write(BLOCK_HEADER.pack(len(data)))
+    f.write(data)
+
+
+def read_blocks(path):
+    """
+    依次读取文件中以长度开头的zlib压缩块
+    :return: 解压后数据的迭代器
+    """
+    f = open(path, 'rb')
+    try:
+        while True:
+            header = f.read(BLOCK_HEADER.size)
+            if not header:
+                return
+            yield zlib.decompress(f.read(BLOCK_HEADER.unpack(header)[0]))
+    finally:
+        f.close()
+
+
+class SpoolWriter:
+    """
+    把抓取并解析好的网页依次写入压缩的记录文件，每条记录为 (url, 单词列表, (链接, 链接的文字) 列表)
+    每SPOOL_PAGES条记录序列化后压缩为一块
+    """
+    def __init__(self, path):
+        self.file = open(path, 'wb')
+        self.pages = []
+        self.count = 0
+
+    def write(self, url, words, page_links):
+        self.pages.append((url, words, page_links))
+        self.count += 1
+        if len(self.pages) >= SPOOL_PAGES:
+            self.flush()
+
+    def flush(self):
+        if self.pages:
+            write_block(self.file, pickle.dumps(self.pages, pickle.HIGHEST_PROTOCOL))
+            self.pages = []
+
+    def close(self):
+        self.flush()
+        self.file.close()
+
+
+def read_spool(path):
+    """
+    按写入顺序读取记录文件中的网页
+    :param path: 记录文件
+    :return: (url, 单词列表, (链接, 链接的文字) 列表) 的迭代器
+    """
+    for data in read_blocks(path):
+        for page in pickle.loads(data):
+            yield page
+
+
+def crawl_to_spool(pages, spool_path, depth=CRAWLER_DEPTH, fetchers=FETCHERS, per_host=PER_HOST, delay=DELAY):
+    """
+    与Crawler.crawl_concurrent相同的逐层广度优先搜索，但不访问数据库，解析结果写入记录文件，
+    之后由BulkBuilder一次建立索引
+    :param pages: 网页列表
+    :param spool_path: 记录文件
+    :param depth: 循环深度
+    :param fetchers: 抓取线程数
+    :param per_host: 每个站点的并发请求数上限
+    :param delay: 同一站点相邻两次请求之间的最小间隔（秒）
+    :return: 写入的网页数
+    """
+    parser = Crawler(':memory:')  # 只用于解析网页
+    writer = SpoolWriter(spool_path)
+    pool = FetchPool(parser.parse_page, fetchers, per_host, delay)
+    try:
+        seen = set(pages)
+        for i in range(depth):
+            for page in pages:
+                pool.submit(page)
+            new_pages = []
+            for n in range(len(pages)):
+                page, result = pool.get_result()
+                if result is None:
+                    print 'Could not open %s' % page
+                    continue
+                words, page_links = result
+                writer.write(page, words, page_links)
+                for (url, link_text) in page_links:
+                    if url[0:4] == 'http' and url not in seen:
+                        seen.add(url)
+                        new_pages.append(url)
+            pages = new_pages
+    finally:
+        pool.close()
+        writer.close()
+    return writer.count
+
+
+def sort_postings(postings):
+    """
+    :param postings: 每行为 (单词id, 网页id, 位置) 的uint32数组
+    :return: 按行排序后的数组
+    """
+    if len(postings) == 0:
+        return postings
+    bits = [int(postings[:, i].max()).bit_length() for i in range(3)]
+    if sum(bits) > 64:
+        return postings[np.lexsort((postings[:, 2], postings[:, 1], postings[:, 0]))]
+    # 三列合并为一个64位整数作为排序键，比按多列排序快得多
+    key = postings[:, 0].astype(np.uint64) << np.uint64(bits[1] + bits[2])
+    key |= postings[:, 1].astype(np.uint64) << np.uint64(bits[2])
+    key |= postings[:, 2]
+    return postings[np.argsort(key)]
+
+
+def write_run(chunks, path):
+    """
+    把有序的单词位置写入有序段文件，每BLOCK_ROWS行为一个zlib压缩块
+    :param chunks: 有序的单词位置数组的序列，可以是迭代器
+    :param path: 有序段文件
+    :return:
+    """
+    f = open(path, 'wb')
+    for chunk in chunks:
+        for start in range(0, len(chunk), BLOCK_ROWS):
+            write_block(f, chunk[start:start + BLOCK_ROWS].tostring())
+    f.close()
+
+
+def read_run(path):
+    """
+    逐块读取有序段文件，内存中只保留一个压缩块
+    :return: 单词位置数组的迭代器
+    """
+    for data in read_blocks(path):
+        yield np.frombuffer(data, dtype=np.uint32).reshape(-1, 3)
+
+
+def count_not_after(rows, bound):
+    """
+    :param rows: 有序的单词位置数组
+    :param bound: (单词id, 网页id, 位置)
+    :return: rows中按字典序不大于bound的行数，这些行都在开头
+    """
+    w, u, l = rows[:, 0], rows[:, 1], rows[:, 2]
+    return int(((w < bound[0]) | ((w == bound[0]) & ((u < bound[1]) | ((u == bound[1]) & (l <= bound[2]))))).sum())
+
+
+def merge_runs(paths):
+    """
+    多路归并有序段，每次从各段当前的块中取出不大于“各块最后一行中的最小者”的所有行，合并排序后输出
+    这些行之后不会再有更小的行，每次至少取完一个块，内存中每个有序段只保留一个块
+    :param paths: 有序段文件列表
+    :return: 有序的单词位置数组的迭代器
+    """
+    readers = [read_run(path) for path in paths]
+    blocks = [next(reader, None) for reader in readers]
+    while True:
+        active = [i for i in range(len(blocks)) if blocks[i] is not None]
+        if not active:
+            return
+        bound = min([tuple(blocks[i][-1]) for i in active])
+        parts = []
+        for i in active:
+            n = count_not_after(blocks[i], bound)
+            parts.append(blocks[i][:n])
+            blocks[i] = blocks[i][n:]
+            if len(blocks[i]) == 0:
+                blocks[i] = next(readers[i], None)
+        yield sort_postings(np.concatenate(parts))
+
+
+class BulkBuilder:
+    """
+    从记录文件离线建立索引数据库
+    urllist和wordlist的id在内存中分配，单词位置按 (单词id, 网页id, 位置) 分段排序后写入临时的有序段文件，
+    再多路归并，按顺序批量写入wordlocation；所有数据写完之后才建立索引，写入时不需要维护B树索引
+    先写入临时数据库，完成后改名为目标数据库
+    """
+    def __init__(self, db_name, run_rows=RUN_ROWS, tmp_dir=None):
+        """
+        :param db_name: 目标数据库，已经存在时被替换
+        :param run_rows: 每个有序段的单词位置数
+        :param tmp_dir: 有序段文件所在的目录，默认与目标数据库相同
+        """
+        self.db_name = db_name
+        self.run_rows = run_rows
+        self.tmp_dir = tmp_dir or os.path.dirname(os.path.abspath(db_name))
+        self.urls = {}  # url -> id
+        self.words = {}  # 单词 -> id
+        self.runs = []
+        self.buffer = []  # 尚未排序的单词位置数组
+        self.buffered = 0
+
+    def get_ids(self, entries, values):
+        """
+        按第一次出现的顺序分配id，与Crawler.get_entry_ids相同
+        :param entries: 条目 -> id
+        :param values: 条目列表
+        :return: id列表
+        """
+        setdefault = entries.setdefault
+        return [setdefault(value, len(entries) + 1) for value in values]  # 新条目的id为当前条目数+1
+
+    def new_run_path(self):
+        fd, path = tempfile.mkstemp(suffix='.run', dir=self.tmp_dir)
+        os.close(fd)
+        return path
+
+    def add_page(self, url_id, words):
+        locations = [i for i in range(len(words)) if words[i] not in IGNORE_WORDS]
+        postings = np.empty((len(locations), 3), dtype=np.uint32)
+        postings[:, 0] = self.get_ids(self.words, [words[i] for i in locations])
+        postings[:, 1] = url_id
+        postings[:, 2] = locations
+        self.buffer.append(postings)
+        self.buffered += len(locations)
+        if self.buffered >= self.run_rows:
+            self.flush_run()
+
+    def flush_run(self):
+        """
+        在内存中排序当前缓冲的单词位置，写出为一个有序段
+        """
+        if not self.buffered:
+            return
+        path = self.new_run_path()
+        write_run([sort_postings(np.concatenate(self.buffer))], path)
+        self.runs.append(path)
+        self.buffer = []
+        self.buffered = 0
+
+    def merge_all(self):
+        """
+        每趟最多归并FAN_IN个有序段，直到剩下不超过FAN_IN个
+        :return: 所有单词位置按顺序排列的数组迭代器
+        """
+        while len(self.runs) > FAN_IN:
+            merged = []
+            for start in range(0, len(self.runs), FAN_IN):
+                group = self.runs[start:start + FAN_IN]
+                path = self.new_run_path()
+                write_run(merge_runs(group), path)
+                for run in group:
+                    os.remove(run)
+                merged.append(path)
+            self.runs = merged
+        return merge_runs(self.runs)
+
+    def build(self, spool_paths):
+        """
+        读取记录文件建立索引数据库，同一个url只有第一次出现的记录建立索引
+        结果与Crawler以批量模式抓取同样的网页相同，之后可以用Crawler(db_name)计算PageRank或继续增量抓取
+        :param spool_paths: 记录文件或记录文件列表
+        :return: 各表的行数等统计
+        """
+        if isinstance(spool_paths, basestring):
+            spool_paths = [spool_paths]
+        tmp_db = self.db_name + '.tmp'
+        if os.path.exists(tmp_db):
+            os.remove(tmp_db)
+        crawler = Crawler(tmp_db)
+        crawler.con.execute('pragma synchronous=off')  # 失败时重新建立即可，不需要日志和同步
+        crawler.con.execute('pragma journal_mode=off')
+        crawler.create_tables()
+        generation = 1
+        indexed = set()
+        links = []
+        link_words = []
+        link_count = 0
+        try:
+            for path in spool_paths:
+                for (url, words, page_links) in read_spool(path):
+                    if url in indexed:
+                        continue
+                    indexed.add(url)
+                    url_id = self.get_ids(self.urls, [url])[0]
+                    self.add_page(url_id, words)
+
+                    # 与Crawler.add_link_refs相同：先分配所有目标url的id，再分配链接文字中单词的id
+                    to_ids = self.get_ids(self.urls, [to_url for (to_url, link_text) in page_links])
+                    kept = [n for n in range(len(page_links)) if to_ids[n] != url_id]
+                    all_words = separate_words_many([page_links[n][1] for n in kept])
+                    for i in range(len(kept)):
+                        link_count += 1
+                        links.append((link_count, url_id, to_ids[kept[i]], generation))
+                        words = [w for w in all_words[i] if w not in IGNORE_WORDS]
+                        for word_id in self.get_ids(self.words, words):
+                            link_words.append((word_id, link_count))
+                    if len(links) + len(link_words) >= LINK_ROWS:
+                        self.insert_links(crawler.con, links, link_words)
+                        links, link_words = [], []
+            self.insert_links(crawler.con, links, link_words)
+            self.flush_run()
+
+            crawler.con.executemany('insert into urllist(rowid, url) values (?, ?)',
+                                    sorted([(url_id, url) for (url, url_id) in self.urls.items()]))
+            crawler.con.executemany('insert into wordlist(rowid, word) values (?, ?)',
+                                    sorted([(word_id, word) for (word, word_id) in self.words.items()]))
+            for postings in self.merge_all():
+                crawler.con.executemany('insert into wordlocation(urlid, wordid, location) values (?, ?, ?)',
+                                        postings[:, [1, 0, 2]].tolist())
+            crawler.create_indexes()  # 数据全部写入之后再建立索引
+            crawler.set_info('crawl_generation', generation)
+            crawler.index_changed = True
+            crawler.db_commit()
+            stats = dict((table, crawler.con.execute('select count(*) from %s' % table).fetchone()[0])
+                         for table in ('urllist', 'wordlist', 'wordlocation', 'link', 'linkwords'))
+            stats['pages'] = len(indexed)
+        finally:
+            crawler.con.close()
+            for run in self.runs:
+                os.remove(run)
+            self.runs = []
+        os.rename(tmp_db, self.db_name)
+        return stats
+
+    def insert_links(self, con, links, link_words):
+        con.executemany('insert into link(rowid, fromid, toid, generation) values (?, ?, ?, ?)', links)
+        con.executemany('insert into linkwords(wordid, linkid) values (?, ?)', link_words)
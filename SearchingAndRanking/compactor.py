@@ -0,0 +1,62 @@
+# coding: utf-8
+# author: luyf
+# create date: 2016.12.16
+
+import threading
+from pysqlite2 import dbapi2 as sqlite
+from searchengine import Crawler
+
+
+COMPACT_INTERVAL = 60.0  # 检查墓碑数的间隔（秒）
+MIN_TOMBSTONES = 100  # 墓碑数达到该值时才合并
+
+
+class Compactor:
+    """
+    后台合并线程：定期检查墓碑数，达到min_tombstones时调用Crawler.compact物理删除失效的行
+    使用自己的数据库连接，与正在写入的Crawler争用写锁失败时放弃本次合并，下一个周期再试
+    合并之后需要重新导出索引文件，使用索引文件的Searcher才能看到合并后的结果
+    """
+    def __init__(self, db_name, interval=COMPACT_INTERVAL, min_tombstones=MIN_TOMBSTONES):
+        """
+        :param db_name: 数据库名称
+        :param interval: 检查间隔
+        :param min_tombstones: 合并时的最少墓碑数
+        """
+        self.db_name = db_name
+        self.interval = interval
+        self.min_tombstones = min_tombstones
+        self.compactions = 0  # 完成的合并次数
+        self.stopped = threading.Event()
+        self.thread = threading.Thread(target=self.run)
+        self.thread.daemon = True
+        self.thread.start()
+
+    def run(self):
+        crawler = Crawler(self.db_name)  # 数据库连接只能在创建它的线程中使用
+        while not self.stopped.wait(self.interval):
+            self.compact(crawler)
+
+    def compact(self, crawler):
+        """
+        墓碑数足够时合并一次
+        :param crawler: 本线程的Crawler
+        :return: 清除的墓碑数
+        """
+        try:
+            if crawler.get_tombstone_count() < self.min_tombstones:
+                return 0
+            count = crawler.compact()
+        except sqlite.OperationalError:  # 数据库被其他连接锁定
+            crawler.db_rollback()
+            return 0
+        self.compactions += 1
+        return count
+
+    def close(self):
+        """
+        停止后台线程，正在进行的合并会先完成
+        :return:
+        """
+        self.stopped.set()
+        self.thread.join()
@@ -0,0 +1,143 @@
+# coding: utf-8
+# author: luyf
+# create date: 2016.12.10
+
+import numpy as np
+from pysqlite2 import dbapi2 as sqlite
+
+
+def gather(values, url_ids):
+    """
+    按urlid取出数组中的值，超出数组范围的urlid取0
+    """
+    result = np.zeros(len(url_ids), dtype=values.dtype)
+    valid = url_ids < len(values)
+    result[valid] = values[url_ids[valid]]
+    return result
+
+
+class FeatureStore:
+    """
+    在内存中保存与查询无关的网页特征：PageRank值、外部回指链接数和url名称，都以urlid为下标存放在数组中
+    同时记录数据库中是否有预先计算的linktextscore表
+    Crawler每次提交对索引的修改都会增加indexinfo表中的index_generation，refresh发现代数变化时重新加载
+    """
+    def __init__(self, con):
+        self.con = con
+        self.generation = None
+        self.loaded = False
+        self.page_rank = np.zeros(1)  # urlid -> PageRank值，不存在时为0
+        self.inbound = np.zeros(1, dtype=np.int64)  # urlid -> 外部回指链接数
+        self.urls = [None]  # urlid -> url
+        self.link_text_index = False  # 是否已经建立了linktextscore表
+        self.tombstones = {}  # urlid -> (wordlocation的rowid上限, link的rowid上限)，不超过上限的行已失效
+        self.uncompacted = 0  # 失效的行还没有被合并删除的墓碑数
+        self.link_text_row = None  # 建立linktextscore表时link的最大rowid，旧版本建立的表没有记录
+        self.export_row = None  # 导出索引文件时wordlocation的最大rowid，之后写入的行不在文件中；没有导出过时为None
+        self.word_row = 0  # wordlocation的最大rowid
+
+    def get_generation(self):
+        return self.get_info('index_generation')
+
+    def get_info(self, name):
+        """
+        :return: indexinfo表中的一项元信息，不存在时返回None
+        """
+        try:
+            res = self.con.execute('select value from indexinfo where name=?', (name,)).fetchone()
+        except sqlite.OperationalError:  # 旧版本建立的数据库没有indexinfo表
+            return None
+        if res is None:
+            return None
+        return res[0]
+
+    def refresh(self):
+        """
+        索引代数发生变化时重新加载，每次查询前调用，只需要一次查询
+        :return: 是否重新加载
+        """
+        generation = self.get_generation()
+        if self.loaded and generation == self.generation:
+            return False
+        self.load()
+        self.generation = generation
+        return True
+
+    def load(self):
+        """
+        读取urllist、link、pagerank和tombstone表，建立以urlid为下标的数组，回指链接数不包括失效的链接
+        :return:
+        """
+        try:
+            rows = self.con.execute('select * from tombstone').fetchall()
+        except sqlite.OperationalError:  # 旧版本建立的数据库没有tombstone表
+            rows = []
+        self.tombstones = dict((row[0], (row[1], row[2])) for row in rows)
+        self.uncompacted = sum(1 for row in rows if len(row) < 4 or not row[3])  # 旧版本的墓碑表没有compacted字段
+
+        rows = self.con.execute('select rowid, url from urllist').fetchall()
+        size = max([row[0] for row in rows] + [0]) + 1
+        self.urls = [None] * size
+        for (url_id, url) in rows:
+            self.urls[url_id] = url
+
+        self.inbound = np.zeros(size, dtype=np.int64)
+        if self.tombstones:
+            cur = self.con.execute('select toid, count(*) from link where not (fromid in (select urlid from tombstone) '
+                                   'and rowid<=(select linkrow from tombstone where urlid=link.fromid)) group by toid')
+        else:
+            cur = self.con.execute('select toid, count(*) from link group by toid')
+        counts = np.array(cur.fetchall(), dtype=np.int64).reshape(-1, 2)
+        counts = counts[counts[:, 0] < size]
+        self.inbound[counts[:, 0]] = counts[:, 1]
+
+        self.page_rank = np.zeros(size)
+        try:
+            scores = np.array(self.con.execute('select urlid, score from pagerank').fetchall()).reshape(-1, 2)
+        except sqlite.OperationalError:  # 还没有计算过PageRank
+            scores = np.zeros((0, 2))
+        url_ids = scores[:, 0].astype(np.int64)
+        valid = url_ids < size
+        self.page_rank[url_ids[valid]] = scores[valid, 1]
+
+        self.link_text_index = self.con.execute(
+            "select count(*) from sqlite_master where type='table' and name='linktextscore'").fetchone()[0] > 0
+        self.link_text_row = self.get_info('linktext_linkrow')
+        self.export_row = self.get_info('export_wordrow')
+        self.word_row = self.con.execute('select max(rowid) from wordlocation').fetchone()[0] or 0
+        self.loaded = True
+
+    def get_page_rank(self, url_id):
+        if url_id < len(self.page_rank):
+            return float(self.page_rank[url_id])
+        return 0.0
+
+    def get_inbound(self, url_id):
+        if url_id < len(self.inbound):
+            return int(self.inbound[url_id])
+        return 0
+
+    def get_page_ranks(self, url_ids):
+        """
+        :param url_ids: urlid数组
+        :return: 对应的PageRank值数组，不存在时为0
+        """
+        return gather(self.page_rank, url_ids)
+
+    def get_inbounds(self, url_ids):
+        """
+        :param url_ids: urlid数组
+        :return: 对应的外部回指链接数数组，不存在时为0
+        """
+        return gather(self.inbound, url_ids)
+
+    def has_unexported_rows(self):
+        """
+        :return: 是否有导出索引文件之后写入的单词位置，使用索引文件的Searcher需要从数据库中补充读取
+        """
+        return self.export_row is not None and self.word_row > self.export_row
+
+    def get_url(self, url_id):
+        if url_id < len(self.urls):
+            return self.urls[url_id]
+        return None
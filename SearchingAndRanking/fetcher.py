@@ -0,0 +1,139 @@
+# coding: utf-8
+# author: luyf
+# create date: 2016.12.07
+
+import threading
+import time
+import urllib2
+from Queue import Queue
+from urlparse import urlparse
+
+
+FETCHERS = 8  # 抓取线程数
+PER_HOST = 2  # 每个站点同时进行的请求数上限
+DELAY = 0.0  # 同一站点相邻两次请求之间的最小间隔（秒）
+TIMEOUT = 10  # 请求超时（秒）
+QUEUE_SIZE = 64  # 结果队列长度，写入跟不上时抓取线程会阻塞等待
+
+
+def fetch_page(url, etag=None, modified=None, timeout=TIMEOUT):
+    """
+    下载网页，指定etag或modified时发送条件请求（If-None-Match、If-Modified-Since）
+    :param url: 网页url
+    :param etag: 上次下载时服务器返回的ETag
+    :param modified: 上次下载时服务器返回的Last-Modified
+    :param timeout: 请求超时
+    :return: (网页内容, ETag, Last-Modified)，没有的响应头为None；服务器返回304（网页没有变化）时返回None
+    """
+    request = urllib2.Request(url)
+    if etag is not None:
+        request.add_header('If-None-Match', etag)
+    if modified is not None:
+        request.add_header('If-Modified-Since', modified)
+    try:
+        response = urllib2.urlopen(request, timeout=timeout)
+    except urllib2.HTTPError as e:
+        if e.code == 304:
+            return None
+        raise
+    try:
+        headers = response.info()
+        return response.read(), headers.getheader('ETag'), headers.getheader('Last-Modified')
+    finally:
+        response.close()
+
+
+class FetchPool:
+    """
+    并发抓取网页的线程池
+    抓取线程从任务队列中取出url，遵守每个站点的并发数和请求间隔限制下载网页，
+    调用parse对网页进行解析，再把结果放入结果队列，由调用方（唯一持有数据库连接的写入者）依次取出处理
+    """
+    def __init__(self, parse, fetchers=FETCHERS, per_host=PER_HOST, delay=DELAY, timeout=TIMEOUT):
+        """
+        :param parse: 解析函数，参数为(url, 网页内容)，返回值原样放入结果队列，在抓取线程中执行
+        :param fetchers: 抓取线程数
+        :param per_host: 每个站点的并发请求数上限
+        :param delay: 同一站点相邻两次请求之间的最小间隔
+        :param timeout: 请求超时
+        """
+        self.parse = parse
+        self.per_host = per_host
+        self.delay = delay
+        self.timeout = timeout
+        self.closed = False
+        self.tasks = Queue()
+        self.results = Queue(QUEUE_SIZE)
+        self.lock = threading.Lock()
+        self.host_slots = {}  # 站点 -> 并发数信号量
+        self.host_next_time = {}  # 站点 -> 下一次允许发出请求的时间
+        self.threads = []
+        for i in range(fetchers):
+            thread = threading.Thread(target=self.worker)
+            thread.daemon = True
+            thread.start()
+            self.threads.append(thread)
+
+    def submit(self, url):
+        self.tasks.put(url)
+
+    def get_result(self):
+        """
+        取出一个抓取结果，没有结果时阻塞
+        :return: (url, 解析结果)，抓取或解析失败时解析结果为None
+        """
+        return self.results.get()
+
+    def close(self):
+        """
+        通知所有抓取线程退出，并等待其结束，尚未处理的任务和未取出的结果都被丢弃
+        :return:
+        """
+        self.closed = True
+        for thread in self.threads:
+            self.tasks.put(None)
+        for thread in self.threads:
+            while thread.is_alive():
+                while not self.results.empty():  # 避免抓取线程阻塞在已满的结果队列上
+                    self.results.get()
+                thread.join(0.1)
+
+    def wait_for_host(self, host):
+        """
+        占用站点的一个并发名额，并等待到满足请求间隔为止
+        :param host: 站点
+        :return: 该站点的信号量，请求结束后需要释放
+        """
+        with self.lock:
+            if host not in self.host_slots:
+                self.host_slots[host] = threading.Semaphore(self.per_host)
+                self.host_next_time[host] = 0.0
+            slot = self.host_slots[host]
+        slot.acquire()
+        with self.lock:
+            now = time.time()
+            start = max(now, self.host_next_time[host])
+            self.host_next_time[host] = start + self.delay
+        if start > now:
+            time.sleep(start - now)
+        return slot
+
+    def fetch(self, url):
+        slot = self.wait_for_host(urlparse(url).netloc)
+        try:
+            return urllib2.urlopen(url, timeout=self.timeout).read()
+        finally:
+            slot.release()
+
+    def worker(self):
+        while True:
+            url = self.tasks.get()
+            if url is None:
+                return
+            if self.closed:
+                continue
+            try:
+                result = self.parse(url, self.fetch(url))
+            except Exception:
+                result = None
+            self.results.put((url, result))
@@ -0,0 +1,169 @@
+# coding: utf-8
+# author: luyf
+# create date: 2016.12.13
+
+import hashlib
+import math
+import struct
+
+
+FRONTIER_CAPACITY = 100000  # 布隆过滤器的初始容量，url数超过容量时加倍重建
+ERROR_RATE = 1e-4  # 布隆过滤器的误判率
+
+PENDING = 0  # 等待抓取
+DONE = 1  # 已经抓取并建立索引
+FAILED = 2  # 下载或解析失败
+
+
+class BloomFilter:
+    """
+    布隆过滤器，用很少的内存判断url是否出现过
+    不在过滤器中的url一定没有出现过；在过滤器中的url有ERROR_RATE的概率是误判
+    """
+    def __init__(self, capacity, error_rate=ERROR_RATE):
+        self.capacity = capacity
+        self.size = int(math.ceil(-capacity * math.log(error_rate) / math.log(2) ** 2))  # 位数
+        self.hashes = max(1, int(round(float(self.size) / capacity * math.log(2))))  # 哈希函数个数
+        self.bits = bytearray((self.size + 7) // 8)
+        self.count = 0
+
+    def positions(self, key):
+        """
+        由md5的两个64位整数组合出hashes个位置（双重哈希）
+        """
+        if isinstance(key, unicode):
+            key = key.encode('utf-8')
+        h1, h2 = struct.unpack('<QQ', hashlib.md5(key).digest())
+        return [(h1 + i * h2) % self.size for i in range(self.hashes)]
+
+    def add(self, key):
+        for pos in self.positions(key):
+            self.bits[pos >> 3] |= 1 << (pos & 7)
+        self.count += 1
+
+    def __contains__(self, key):
+        for pos in self.positions(key):
+            if not self.bits[pos >> 3] & (1 << (pos & 7)):
+                return False
+        return True
+
+
+class Frontier:
+    """
+    保存在数据库frontier表中的待抓取url队列，记录每个url的深度、优先级和抓取状态
+    与索引使用同一个数据库连接，网页的索引、外链和状态变化在同一个事务内提交，中断后可以从上次提交处继续
+    出现过的url同时记录在内存中的布隆过滤器里，判断外链是否重复不需要查询数据库
+    """
+    def __init__(self, con, capacity=FRONTIER_CAPACITY):
+        """
+        :param con: 数据库连接
+        :param capacity: 布隆过滤器的初始容量
+        """
+        self.con = con
+        exists = self.con.execute(
+            "select count(*) from sqlite_master where type='table' and name='frontier'").fetchone()[0] > 0
+        if not exists:
+            self.create_tables()
+        self.load(capacity)
+
+    def create_tables(self):
+        """
+        创建frontier表，已经建立了索引的网页作为已抓取的url加入，旧版本建立的数据库也不会重复抓取
+        :return:
+        """
+        self.con.execute('create table frontier(url primary key, depth integer, priority real, state integer)')
+        self.con.execute('create index frontierstateidx on frontier(state, depth)')
+        self.con.execute('insert into frontier(url, depth, priority, state) '
+                         'select url, 0, 0, %d from urllist where rowid in (select urlid from wordlocation)' % DONE)
+
+    def load(self, capacity):
+        """
+        读取frontier表中所有url，建立布隆过滤器
+        :param capacity: 布隆过滤器的最小容量
+        :return:
+        """
+        urls = [row[0] for row in self.con.execute('select url from frontier')]
+        while capacity < 2 * len(urls):
+            capacity *= 2
+        self.bloom = BloomFilter(capacity)
+        for url in urls:
+            self.bloom.add(url)
+        self.deepest = self.con.execute('select max(depth) from frontier where state=%d' % PENDING).fetchone()[0]
+
+    def add_seeds(self, urls, priority=None):
+        """
+        把种子url作为深度0的待抓取url加入队列，不经过布隆过滤器：
+        已经抓取过或抓取失败的url也重新抓取，上次留下的待抓取url改为深度0
+        :param urls: url列表
+        :param priority: 计算优先级的函数，参数为(url, 深度)
+        :return:
+        """
+        for url in urls:
+            if url not in self.bloom:
+                self.bloom.add(url)
+        self.con.executemany('insert or replace into frontier(url, depth, priority, state) values (?, ?, ?, ?)',
+                             [(url, 0, priority(url, 0) if priority is not None else 0.0, PENDING) for url in urls])
+        if self.deepest is None and urls:
+            self.deepest = 0
+        if self.bloom.count > self.bloom.capacity:
+            self.load(self.bloom.capacity * 2)
+
+    def add(self, urls, depth, priority=None):
+        """
+        把没有出现过的url加入队列
+        布隆过滤器误判时url会被当作出现过而跳过，概率为ERROR_RATE
+        出现过的url只在队列中还有比depth更深的待抓取url时（上次抓取从其他种子开始）才查询数据库，
+        把其中待抓取的url改为depth，使这次抓取的深度限制对它们同样适用
+        :param urls: url列表
+        :param depth: 这些url的深度
+        :param priority: 计算优先级的函数，参数为(url, 深度)，同一深度内优先级高的先抓取，默认都为0
+        :return: 新加入的url数
+        """
+        rows = []
+        seen = []
+        for url in urls:
+            if url in self.bloom:
+                seen.append(url)
+                continue
+            self.bloom.add(url)
+            rows.append((url, depth, priority(url, depth) if priority is not None else 0.0, PENDING))
+        self.con.executemany('insert or ignore into frontier(url, depth, priority, state) values (?, ?, ?, ?)', rows)
+        if seen and self.deepest is not None and depth < self.deepest:
+            self.con.executemany('update frontier set depth=?, priority=? where url=? and state=? and depth>?',
+                                 [(depth, priority(url, depth) if priority is not None else 0.0, url, PENDING, depth)
+                                  for url in seen])
+        if rows and (self.deepest is None or depth > self.deepest):
+            self.deepest = depth
+        if self.bloom.count > self.bloom.capacity:  # 超过容量后误判率上升，加倍重建
+            self.load(self.bloom.capacity * 2)
+        return len(rows)
+
+    def next_depth(self):
+        """
+        :return: 还有待抓取url的最小深度，没有时返回None
+        """
+        return self.con.execute('select min(depth) from frontier where state=%d' % PENDING).fetchone()[0]
+
+    def pending(self, depth):
+        """
+        :param depth: 深度
+        :return: 该深度的所有待抓取url，按优先级从高到低排列
+        """
+        return [row[0] for row in self.con.execute(
+            'select url from frontier where state=? and depth=? order by priority desc, rowid', (PENDING, depth))]
+
+    def mark(self, url, state):
+        """
+        更新url的抓取状态，需要与该网页的索引一起提交
+        :param url: url
+        :param state: DONE或FAILED
+        :return:
+        """
+        self.con.execute('update frontier set state=? where url=?', (state, url))
+
+    def stats(self):
+        """
+        :return: 各状态的url数
+        """
+        counts = dict(self.con.execute('select state, count(*) from frontier group by state'))
+        return {'pending': counts.get(PENDING, 0), 'done': counts.get(DONE, 0), 'failed': counts.get(FAILED, 0)}
@@ -0,0 +1,224 @@
+# coding: utf-8
+# author: luyf
+# create date: 2016.12.09
+
+import mmap
+import os
+import struct
+from itertools import groupby
+
+
+MAGIC = 'PCIX'
+VERSION = 1
+HEADER = struct.Struct('<4sIIQQ')  # 魔数, 版本, 单词数, 单词表偏移, 按单词排序的下标表偏移
+ENTRY = struct.Struct('<IQIQII')  # 单词id, 单词偏移, 单词长度, 倒排列表偏移, 倒排列表长度, 网页数
+ORDER = struct.Struct('<I')
+
+
+def encode_varint(value, out):
+    """
+    以变长整数（每字节7位，最高位表示后面还有字节）编码非负整数，追加到out
+    :param value: 非负整数
+    :param out: bytearray
+    :return:
+    """
+    while value >= 0x80:
+        out.append((value & 0x7f) | 0x80)
+        value >>= 7
+    out.append(value)
+
+
+def decode_varint(data, pos):
+    """
+    从data的pos处解码一个变长整数
+    :param data: 映射的文件或字符串，按下标取出的是单个字符
+    :param pos: 起始位置
+    :return: (整数, 下一个位置)
+    """
+    result = 0
+    shift = 0
+    while True:
+        byte = ord(data[pos])
+        pos += 1
+        result |= (byte & 0x7f) << shift
+        if byte < 0x80:
+            return result, pos
+        shift += 7
+
+
+def encode_postings(rows):
+    """
+    编码一个单词的倒排列表：网页数，之后每个网页依次为 urlid差值、位置个数、各位置的差值
+    :param rows: 按(urlid, location)排序的 (urlid, location) 序列
+    :return: (编码结果, 网页数)
+    """
+    body = bytearray()
+    doc_count = 0
+    last_url_id = 0
+    for (url_id, url_rows) in groupby(rows, lambda row: row[0]):
+        locations = [row[1] for row in url_rows]
+        encode_varint(url_id - last_url_id, body)
+        encode_varint(len(locations), body)
+        last_location = 0
+        for location in locations:
+            encode_varint(location - last_location, body)
+            last_location = location
+        last_url_id = url_id
+        doc_count += 1
+    out = bytearray()
+    encode_varint(doc_count, out)
+    return out + body, doc_count
+
+
+def build_index_file(con, path):
+    """
+    把wordlocation表导出为紧凑的二进制倒排索引文件
+    文件依次为：文件头、所有倒排列表、单词字符串池、按单词id排序的单词表、按单词字符串排序的单词表下标
+    先写入临时文件再改名，正在读取旧文件的Searcher不受影响
+    :param con: 数据库连接
+    :param path: 索引文件路径
+    :return: 单词数
+    """
+    words = dict(con.execute('select rowid, word from wordlist'))
+    cur = con.execute('select wordid, urlid, location from wordlocation order by wordid, urlid, location')
+    groups = groupby(cur, lambda row: row[0])  # 逐个单词读取，不把整个wordlocation表读入内存
+    group = next(groups, None)
+
+    tmp_path = path + '.tmp'
+    out = open(tmp_path, 'wb')
+    out.write(HEADER.pack(MAGIC, VERSION, 0, 0, 0))
+    offset = HEADER.size
+    entries = []
+    for word_id in sorted(words):
+        while group is not None and group[0] < word_id:
+            group = next(groups, None)
+        rows = []
+        if group is not None and group[0] == word_id:
+            rows = group[1]
+        data, doc_count = encode_postings([row[1:] for row in rows])
+        out.write(data)
+        entries.append([word_id, 0, 0, offset, len(data), doc_count])
+        offset += len(data)
+
+    encoded_words = []
+    for entry in entries:
+        word = words[entry[0]]
+        if isinstance(word, unicode):
+            word = word.encode('utf-8')
+        else:
+            word = str(word)
+        entry[1] = offset
+        entry[2] = len(word)
+        out.write(word)
+        offset += len(word)
+        encoded_words.append(word)
+
+    entries_offset = offset
+    for entry in entries:
+        out.write(ENTRY.pack(*entry))
+    order_offset = entries_offset + ENTRY.size * len(entries)
+    for index in sorted(range(len(entries)), key=lambda k: encoded_words[k]):
+        out.write(ORDER.pack(index))
+
+    out.seek(0)
+    out.write(HEADER.pack(MAGIC, VERSION, len(entries), entries_offset, order_offset))
+    out.close()
+    os.rename(tmp_path, path)
+    return len(entries)
+
+
+class IndexFile:
+    """
+    以mmap方式打开build_index_file生成的索引文件，单词和倒排列表都直接从映射的文件中读取
+    """
+    def __init__(self, path):
+        self.file = open(path, 'rb')
+        self.data = mmap.mmap(self.file.fileno(), 0, access=mmap.ACCESS_READ)
+        magic, version, self.term_count, self.entries_offset, self.order_offset = HEADER.unpack_from(self.data, 0)
+        if magic != MAGIC or version != VERSION:
+            raise ValueError('%s is not a version %d index file' % (path, VERSION))
+
+    def close(self):
+        self.data.close()
+        self.file.close()
+
+    def get_entry(self, index):
+        return ENTRY.unpack_from(self.data, self.entries_offset + ENTRY.size * index)
+
+    def get_word(self, entry):
+        return self.data[entry[1]:entry[1] + entry[2]]
+
+    def find_word(self, word):
+        """
+        在按字符串排序的单词表中二分查找单词
+        :param word: 单词
+        :return: 单词id，不存在时返回None
+        """
+        if isinstance(word, unicode):
+            word = word.encode('utf-8')
+        lo = 0
+        hi = self.term_count
+        while lo < hi:
+            mid = (lo + hi) // 2
+            entry = self.get_entry(ORDER.unpack_from(self.data, self.order_offset + ORDER.size * mid)[0])
+            if self.get_word(entry) < word:
+                lo = mid + 1
+            else:
+                hi = mid
+        if lo < self.term_count:
+            entry = self.get_entry(ORDER.unpack_from(self.data, self.order_offset + ORDER.size * lo)[0])
+            if self.get_word(entry) == word:
+                return entry[0]
+        return None
+
+    def find_entry(self, word_id):
+        """
+        在按单词id排序的单词表中二分查找
+        :param word_id: 单词id
+        :return: 单词表的一项，不存在时返回None
+        """
+        lo = 0
+        hi = self.term_count
+        while lo < hi:
+            mid = (lo + hi) // 2
+            entry = self.get_entry(mid)
+            if entry[0] < word_id:
+                lo = mid + 1
+            elif entry[0] > word_id:
+                hi = mid
+            else:
+                return entry
+        return None
+
+    def get_postings(self, word_id):
+        """
+        解码单词的倒排列表，直接从映射的文件中读取，不复制倒排列表
+        :param word_id: 单词id
+        :return: (urlid列表, 与之对应的单词位置列表的列表)，与Searcher.get_postings相同
+        """
+        url_ids = []
+        locations = []
+        entry = self.find_entry(word_id)
+        if entry is None:
+            return url_ids, locations
+        data = self.data
+        doc_count, pos = decode_varint(data, entry[3])
+        url_id = 0
+        for i in range(doc_count):
+            delta, pos = decode_varint(data, pos)
+            url_id += delta
+            count, pos = decode_varint(data, pos)
+            url_locations = []
+            location = 0
+            for j in range(count):
+                byte = ord(data[pos])
+                if byte < 0x80:  # 大多数位置差只有一个字节，不调用decode_varint
+                    location += byte
+                    pos += 1
+                else:
+                    delta, pos = decode_varint(data, pos)
+                    location += delta
+                url_locations.append(location)
+            url_ids.append(url_id)
+            locations.append(url_locations)
+        return url_ids, locations
@@ -0,0 +1,229 @@
+# coding: utf-8
+# author: luyf
+# create date: 2016.12.14
+
+import inspect
+import json
+import threading
+import time
+from collections import deque
+from functools import wraps
+
+
+RECENT = 100  # 保留的最近记录数
+
+
+def timed(stage):
+    """
+    方法装饰器，记录方法的耗时，对象没有启用统计（instrument为None）时直接调用原方法
+    嵌套调用的阶段各自记录，外层阶段的耗时包含内层阶段
+    :param stage: 阶段名称
+    """
+    def decorator(method):
+        @wraps(method)
+        def wrapper(self, *args, **kwargs):
+            if self.instrument is None:
+                return method(self, *args, **kwargs)
+            with self.instrument.stage(stage):
+                return method(self, *args, **kwargs)
+        return wrapper
+    return decorator
+
+
+def recorded(kind):
+    """
+    方法装饰器，把一次调用期间各阶段的耗时、SQL语句数和读取的行数作为一条记录，
+    方法的第一个参数（查询字符串、url等）作为记录的键，可以按位置或按名称传入，嵌套调用时只有最外层产生记录
+    :param kind: 记录类型
+    """
+    def decorator(method):
+        key_name = inspect.getargspec(method).args[1]
+
+        @wraps(method)
+        def wrapper(self, *args, **kwargs):
+            if self.instrument is None:
+                return method(self, *args, **kwargs)
+            key = args[0] if args else kwargs.get(key_name)
+            with self.instrument.record(kind, key):
+                return method(self, *args, **kwargs)
+        return wrapper
+    return decorator
+
+
+class NullContext:
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        return False
+
+
+NULL_CONTEXT = NullContext()
+
+
+class StageTimer:
+    def __init__(self, instrument, stage):
+        self.instrument = instrument
+        self.stage = stage
+
+    def __enter__(self):
+        self.start = time.time()
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.instrument.add_stage(self.stage, time.time() - self.start)
+        return False
+
+
+class Record:
+    def __init__(self, instrument, kind, key):
+        self.instrument = instrument
+        self.kind = kind
+        self.key = key
+        self.nested = False
+
+    def __enter__(self):
+        local = self.instrument.local
+        if getattr(local, 'record', None) is not None:
+            self.nested = True
+            return self
+        self.start = time.time()
+        self.stages = {}
+        self.sql = 0
+        self.rows = 0
+        local.record = self
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        if self.nested:
+            return False
+        self.instrument.local.record = None
+        self.instrument.finish_record({
+            'kind': self.kind, 'key': self.key, 'time': self.start, 'seconds': time.time() - self.start,
+            'stages': self.stages, 'sql': self.sql, 'rows': self.rows, 'error': exc_type is not None})
+        return False
+
+
+class Instrument:
+    """
+    Crawler和Searcher的运行统计：各阶段的调用次数和耗时、执行的SQL语句数和读取的行数
+    每次查询或每个网页的统计作为一条记录，保存最近的记录，并可以按行写入JSON格式的日志
+    可以被多个线程同时使用，每个线程的记录分别统计
+    """
+    def __init__(self, log=None, recent=RECENT):
+        """
+        :param log: 日志文件路径或已打开的文件，为None时不写日志
+        :param recent: 保留的最近记录数
+        """
+        self.lock = threading.Lock()
+        self.local = threading.local()
+        self.log = open(log, 'a') if isinstance(log, basestring) else log
+        self.recent = deque(maxlen=recent)
+        self.reset()
+
+    def reset(self):
+        with self.lock:
+            self.stages = {}  # 阶段 -> [调用次数, 总耗时]
+            self.records = {}  # 记录类型 -> 记录数
+            self.sql = 0
+            self.rows = 0
+            self.recent.clear()
+
+    def stage(self, stage):
+        return StageTimer(self, stage)
+
+    def record(self, kind, key):
+        return Record(self, kind, key)
+
+    def add_stage(self, stage, seconds):
+        with self.lock:
+            total = self.stages.setdefault(stage, [0, 0.0])
+            total[0] += 1
+            total[1] += seconds
+        record = getattr(self.local, 'record', None)
+        if record is not None:
+            record.stages[stage] = record.stages.get(stage, 0.0) + seconds
+
+    def add_sql(self, statements, rows):
+        with self.lock:
+            self.sql += statements
+            self.rows += rows
+        record = getattr(self.local, 'record', None)
+        if record is not None:
+            record.sql += statements
+            record.rows += rows
+
+    def finish_record(self, data):
+        with self.lock:
+            self.records[data['kind']] = self.records.get(data['kind'], 0) + 1
+            self.recent.append(data)
+            if self.log is not None:
+                self.log.write(json.dumps(data) + '\n')
+                self.log.flush()
+
+    def stats(self):
+        """
+        :return: 各阶段的累计调用次数和耗时、SQL语句数、读取的行数、各类型的记录数和最近的记录
+        """
+        with self.lock:
+            return {'stages': dict((stage, {'count': count, 'seconds': seconds})
+                                   for (stage, (count, seconds)) in self.stages.items()),
+                    'sql': self.sql, 'rows': self.rows, 'records': dict(self.records),
+                    'recent': list(self.recent)}
+
+
+class InstrumentedCursor:
+    """
+    统计读取行数的游标
+    """
+    def __init__(self, cursor, instrument):
+        self.cursor = cursor
+        self.instrument = instrument
+
+    def __getattr__(self, name):
+        return getattr(self.cursor, name)
+
+    def __iter__(self):
+        rows = 0
+        try:
+            for row in self.cursor:
+                rows += 1
+                yield row
+        finally:
+            self.instrument.add_sql(0, rows)
+
+    def fetchone(self):
+        row = self.cursor.fetchone()
+        if row is not None:
+            self.instrument.add_sql(0, 1)
+        return row
+
+    def fetchmany(self, *args):
+        rows = self.cursor.fetchmany(*args)
+        self.instrument.add_sql(0, len(rows))
+        return rows
+
+    def fetchall(self):
+        rows = self.cursor.fetchall()
+        self.instrument.add_sql(0, len(rows))
+        return rows
+
+
+class InstrumentedConnection:
+    """
+    统计SQL语句数的数据库连接，其他属性和方法都交给原连接
+    """
+    def __init__(self, con, instrument):
+        self.con = con
+        self.instrument = instrument
+
+    def __getattr__(self, name):
+        return getattr(self.con, name)
+
+    def execute(self, *args):
+        self.instrument.add_sql(1, 0)
+        return InstrumentedCursor(self.con.execute(*args), self.instrument)
+
+    def executemany(self, *args):
+        self.instrument.add_sql(1, 0)
+        return InstrumentedCursor(self.con.executemany(*args), self.instrument)
@@ -2,20 +2,91 @@
 # author: luyf
 # create date: 2016.12.08
 
-from math import tanh
+import time
+from itertools import islice
+import numpy as np
 from pysqlite2 import dbapi2 as sqlite
+from weightstore import WeightStore, FLUSH_INTERVAL
+
+
+MINI_BATCH = 64  # 批量训练时每批的点击数
+LOG_EVERY = 100  # 批量训练时每隔多少批输出一次进度
 
 
 def dtanh(y):
     return 1.0 - y*y
 
 
+def format_click(word_ids, url_ids, selected_url):
+    """
+    点击日志的一行：查询单词id、返回的url id和被点击的url id，用制表符分隔，id之间用逗号分隔
+    :return: 不含换行符的字符串
+    """
+    return '%s\t%s\t%d' % (','.join(str(word_id) for word_id in word_ids),
+                            ','.join(str(url_id) for url_id in url_ids), selected_url)
+
+
+def read_click_log(path, bad_lines=None):
+    """
+    逐行读取点击日志，跳过空行和以#开头的注释行
+    格式错误或被点击的url不在结果中的记录也被跳过，不中断读取
+    :param path: format_click格式的日志文件
+    :param bad_lines: 列表，指定时追加被跳过的错误记录的行号
+    :return: 生成 (单词id列表, url id列表, 被点击的url id)
+    """
+    with open(path) as f:
+        for (line_number, line) in enumerate(f, 1):
+            line = line.strip()
+            if not line or line.startswith('#'):
+                continue
+            try:
+                words, urls, selected = line.split('\t')
+                word_ids = [int(word_id) for word_id in words.split(',')]
+                url_ids = [int(url_id) for url_id in urls.split(',')]
+                selected_url = int(selected)
+            except ValueError:
+                selected_url, url_ids = None, []
+            if selected_url not in url_ids:
+                if bad_lines is not None:
+                    bad_lines.append(line_number)
+                continue
+            yield word_ids, url_ids, selected_url
+
+
 class Searchnet:
-    def __init__(self, dbname):
+    def __init__(self, dbname, flush_interval=FLUSH_INTERVAL):
+        """
+        训练后的权重先保存在内存中，使用完毕后必须调用close写回数据库，不能依赖对象被回收
+        :param dbname: 数据库文件
+        :param flush_interval: 训练后的权重每累积多少次训练写回数据库
+        """
+        self.con = None
+        self.weights = None
         self.con = sqlite.connect(dbname)
+        self.weights = WeightStore(self.con, flush_interval)
 
     def __del__(self):
+        # 解释器退出时不保证调用__del__，这里只是补救，调用者应显式调用close
+        self.close()
+
+    def close(self):
+        """
+        写回还没有写回的权重并关闭数据库连接，可以重复调用
+        :return:
+        """
+        if self.con is None:
+            return
+        if self.weights is not None:
+            self.flush()
         self.con.close()
+        self.con = None
+
+    def flush(self):
+        """
+        把还没有写回的权重写入数据库并提交
+        :return: 写回的连接数
+        """
+        return self.weights.flush()
 
     def make_tables(self):
         """
@@ -30,44 +101,25 @@ class Searchnet:
 
     def get_strength(self, from_id, to_id, layer):
         """
-        判断当前连接的强度
+        判断当前连接的强度，从内存中的权重缓存读取
         链接不存在时，返回默认值，对于单词层到隐藏层，默认值-0.2；对于隐藏层到输出层，默认值0
         :param from_id: 输入连接
         :param to_id: 输出连接
         :param layer: 层标识，0表示单词层，其他为隐藏层，不需要表示第一层，即输入层，因为要查询的强度是从第二层存储的
         :return:
         """
-        if layer == 0:
-            table = 'wordhidden'
-        else:
-            table = 'hiddenurl'
-        result = self.con.execute('select strength from %s where fromid=%d and toid=%d' % (table, from_id, to_id)).fetchone()
-        if result is None:
-            if layer == 0:
-                return -0.2
-            if layer == 1:
-                return 0
-        return result[0]
+        return self.weights.get(from_id, to_id, layer)
 
     def set_strength(self, from_id, to_id, layer, strength):
         """
-        判断链接是否存在，并利用新的强度值更新连接或创建连接
+        利用新的强度值更新连接或创建连接，只修改内存中的缓存，写回时再判断链接是否存在
         :param from_id:
         :param to_id:
         :param layer:
         :param strength:
         :return:
         """
-        if layer == 0:
-            table = 'wordhidden'
-        else:
-            table = 'hiddenurl'
-        result = self.con.execute('select rowid from %s where fromid=%d and toid=%d' % (table, from_id, to_id)).fetchone()
-        if result is None:
-            self.con.execute('insert into %s(fromid,toid,strength) values (%d,%d,%f)' % (table, from_id, to_id, strength))
-        else:
-            rowid = result[0]
-            self.con.execute('update %s set strength=%f where rowid=%d' % (table, strength, rowid))
+        self.weights.set(from_id, to_id, layer, strength)
 
     def generate_hidden_node(self, word_ids, urls):
         """
@@ -86,35 +138,27 @@ class Searchnet:
         if result is None:
             cur = self.con.execute("insert into hiddennode (create_key) values('%s')" % create_key)
             hidden_id = cur.lastrowid
-            # 设置默认权重
+            # 设置默认权重，与新节点一起在下次写回时提交
+            self.weights.load(word_ids, urls)
             for word_id in word_ids:
                 self.set_strength(word_id, hidden_id, 0, 1.0/len(word_ids))  # 新建连接的默认值为1.0/len(word_ids)
             for url_id in urls:
                 self.set_strength(hidden_id, url_id, 1, 0.1)  # 新建连接的默认值为0.1
-            self.con.commit()
 
     def get_all_hidden_ids(self, word_ids, url_ids):
         """
         查询数据库中节点与连接的信息，从隐藏层中找出与某项查询相关的所有节点
         这些节点必须关联与查询条件中的某个单词，或者关联与查询结果中的某个URL
+        每层只需要一条查询读取还没有缓存的单词和URL的全部连接
         :param word_ids:
         :param url_ids:
-        :return:
+        :return: 按id排序的隐藏节点列表
         """
-        link_list = {}
-        for wordid in word_ids:
-            cur = self.con.execute('select toid from wordhidden where fromid=%d' % wordid)
-            for row in cur:
-                link_list[row[0]] = 1
-        for urlid in url_ids:
-            cur =self.con.execute('select fromid from hiddenurl where toid=%d' % urlid)
-            for row in cur:
-                link_list[row[0]] = 1
-        return link_list.keys()
+        return self.weights.get_hidden_ids(word_ids, url_ids)
 
     def setup_network(self, word_ids, url_ids):
         """
-        建立包括当前所有权重值在内的相应网络
+        建立包括当前所有权重值在内的相应网络，节点输出是NumPy向量，权重是NumPy矩阵
         :param word_ids:
         :param url_ids:
         :return:
@@ -125,17 +169,13 @@ class Searchnet:
         self.url_ids = url_ids  # url输出层
 
         # 节点输出
-        self.ai = [1.0]*len(self.word_ids)
-        self.ah = [1.0]*len(self.hidden_ids)
-        self.ao = [1.0]*len(self.url_ids)
-
-        # 建立权重矩阵
-        self.weight_i = [[self.get_strength(wordid, hiddenid, 0)
-                          for hiddenid in self.hidden_ids]
-                         for wordid in word_ids]
-        self.weight_o = [[self.get_strength(hiddenid, urlid, 1)
-                          for urlid in url_ids]
-                         for hiddenid in self.hidden_ids]
+        self.ai = np.ones(len(self.word_ids))
+        self.ah = np.ones(len(self.hidden_ids))
+        self.ao = np.ones(len(self.url_ids))
+
+        # 建立权重矩阵，weight_i[i, j]是单词i到隐藏节点j的强度，weight_o[j, k]是隐藏节点j到url k的强度
+        self.weight_i = self.weights.get_matrix(0, word_ids, self.hidden_ids)
+        self.weight_o = self.weights.get_matrix(1, self.hidden_ids, url_ids)
 
     def feed_forward(self):
         """
@@ -143,26 +183,18 @@ class Searchnet:
         循环遍历所有位于隐藏层的节点，并将所有来自输入层的输出结果乘以连接强度后累加起来
         每个节点的输出等于所有输入之和进过tanh函数计算后的结果，这一结果将被传给输出层
         输出层处理过程类似，将上一层输出结果乘以强度值，然后应用tanh函数给出最终结果
-        :return:
+        每一层的累加都是一次向量与矩阵的乘法
+        :return: 输出层节点的输出列表
         """
         # 查询单词是仅有的输入
-        for i in range(len(self.word_ids)):
-            self.ai[i] = 1.0
+        self.ai.fill(1.0)
 
         # 隐藏层节点的活跃程度
-        for j in range(len(self.hidden_ids)):
-            sum_result_1 = 0.0
-            for i in range(len(self.word_ids)):
-                sum_result_1 += self.ai[i] * self.weight_i[i][j]
-            self.ah[j] = tanh(sum_result_1)
+        self.ah = np.tanh(self.ai.dot(self.weight_i))
 
         # 输出层节点的活跃程度
-        for k in range(len(self.url_ids)):
-            sum_result_2 = 0.0
-            for j in range(len(self.hidden_ids)):
-                sum_result_2 += self.ah[j] * self.weight_o[j][k]
-            self.ao[k] = tanh(sum_result_2)
-        return self.ao[:]
+        self.ao = np.tanh(self.ah.dot(self.weight_o))
+        return self.ao.tolist()
 
     def get_result(self, word_ids, url_ids):
         """
@@ -176,36 +208,32 @@ class Searchnet:
 
     def back_propagate(self, targets, N=0.5):
         """
-        反向传播训练
-        :param targets:
-        :param N:
+        反向传播训练，误差的传递是矩阵与向量的乘法，权重的改变量是两层输出的外积
+        :param targets: 输出层各节点的期望输出
+        :param N: 学习速率
         :return:
         """
-        # 计算输出层的误差
-        output_deltas = [0.0] * len(self.url_ids)
-        for i in range(len(self.url_ids)):
-            error = targets[i] - self.ao[i]
-            output_deltas[i] = dtanh(self.ao[i]) * error
-
-        # 计算隐藏层的误差
-        hidden_deltas = [0.0] * len(self.hidden_ids)
-        for j in range(len(self.hidden_ids)):
-            error = 0.0
-            for k in range(len(self.url_ids)):
-                error += output_deltas[k] * self.weight_o[j][k]
-            hidden_deltas[j] = dtanh(self.ah[j]) * error
+        change_i, change_o = self.get_changes(targets)
 
         # 更新输出权重
-        for j in range(len(self.hidden_ids)):
-            for k in range((len(self.url_ids))):
-                change = output_deltas[k] * self.ah[j]
-                self.weight_o[j][k] += N * change
+        self.weight_o += N * change_o
 
         # 更新输入权重
-        for i in range(len(self.word_ids)):
-            for j in range(len(self.hidden_ids)):
-                change = hidden_deltas[j] * self.ai[i]
-                self.weight_i[i][j] += N * change
+        self.weight_i += N * change_i
+
+    def get_changes(self, targets):
+        """
+        计算当前网络对一组期望输出的权重改变量（负梯度），不修改权重
+        :param targets: 输出层各节点的期望输出
+        :return: (输入权重的改变量矩阵, 输出权重的改变量矩阵)
+        """
+        # 计算输出层的误差
+        output_deltas = dtanh(self.ao) * (np.asarray(targets, dtype=np.float64) - self.ao)
+
+        # 计算隐藏层的误差
+        hidden_deltas = dtanh(self.ah) * self.weight_o.dot(output_deltas)
+
+        return np.outer(self.ai, hidden_deltas), np.outer(self.ah, output_deltas)
 
     def train_query(self, word_ids, url_ids, selected_url):
         """
@@ -223,38 +251,109 @@ class Searchnet:
         self.back_propagate(targets)
         self.update_database()
 
-    def update_database(self):
+    def train_batch(self, examples, N=0.5):
         """
+        小批量训练：同一查询（单词和结果都相同）的点击只建立一次网络、做一次前馈，
+        所有点击的改变量都按批开始时的权重计算，取平均后一起更新，然后在一个事务中写回数据库
+        只有一条点击时与train_query的结果相同
+        :param examples: [(单词id列表, url id列表, 被点击的url id), ...]
+        :param N: 学习速率
+        :return: (训练的点击数, 训练前的误差之和)，误差是各输出节点与期望输出之差的平方和的一半
+        """
+        queries = {}
+        order = []
+        for (word_ids, url_ids, selected_url) in examples:
+            key = (tuple(word_ids), tuple(url_ids))
+            if key not in queries:
+                queries[key] = []
+                order.append(key)
+            queries[key].append(selected_url)
+
+        changes = []
+        loss = 0.0
+        for key in order:
+            word_ids, url_ids = list(key[0]), list(key[1])
+            self.generate_hidden_node(word_ids, url_ids)
+            self.setup_network(word_ids, url_ids)
+            self.feed_forward()
+            change_i = np.zeros(self.weight_i.shape)
+            change_o = np.zeros(self.weight_o.shape)
+            for selected_url in queries[key]:
+                targets = np.zeros(len(url_ids))
+                targets[url_ids.index(selected_url)] = 1.0
+                loss += 0.5 * float(((targets - self.ao) ** 2).sum())
+                query_change_i, query_change_o = self.get_changes(targets)
+                change_i += query_change_i
+                change_o += query_change_o
+            changes.append((word_ids, self.hidden_ids, url_ids, change_i, change_o))
+
+        rate = N / len(examples)
+        for (word_ids, hidden_ids, url_ids, change_i, change_o) in changes:
+            self.weights.add_matrix(1, hidden_ids, url_ids, rate * change_o)
+            self.weights.add_matrix(0, word_ids, hidden_ids, rate * change_i)
+        self.weights.flush()
+        return len(examples), loss
+
+    def train_click_log(self, path, batch_size=MINI_BATCH, N=0.5, log_every=LOG_EVERY):
+        """
+        从点击日志流式读取点击，按batch_size条一批调用train_batch，定期输出训练速度和平均误差
+        :param path: format_click格式的日志文件
+        :param batch_size: 每批的点击数
+        :param N: 学习速率
+        :param log_every: 每隔多少批输出一次进度，为0时不输出
+        :return: 训练统计 {'examples', 'batches', 'seconds', 'examples_per_second', 'loss', 'bad_lines'}，
+                 loss是每条点击的平均误差，bad_lines是被跳过的错误记录数
+        """
+        bad_lines = []
+        clicks = read_click_log(path, bad_lines)
+        start = time.time()
+        examples = batches = 0
+        loss = 0.0
+        while True:
+            batch = list(islice(clicks, batch_size))
+            if not batch:
+                break
+            count, batch_loss = self.train_batch(batch, N)
+            examples += count
+            loss += batch_loss
+            batches += 1
+            if log_every and batches % log_every == 0:
+                print 'batch %d: %d examples, %.0f examples/s, loss %.6f, %d bad lines' % (
+                    batches, examples, examples / max(time.time() - start, 1e-6), loss / examples, len(bad_lines))
+        seconds = time.time() - start
+        return {'examples': examples, 'batches': batches, 'seconds': seconds,
+                'examples_per_second': examples / seconds if seconds > 0 else 0.0,
+                'loss': loss / examples if examples else 0.0, 'bad_lines': len(bad_lines)}
 
+    def update_database(self):
+        """
+        将训练后的权重存入缓存，每累积flush_interval次训练批量写回数据库
         :return:
         """
-        # 将值存入数据库
-        for i in range(len(self.word_ids)):
-            for j in range(len(self.hidden_ids)):
-                self.set_strength(self.word_ids[i], self.hidden_ids[j], 0, self.weight_i[i][j])
-        for j in range(len(self.hidden_ids)):
-            for k in range(len(self.url_ids)):
-                self.set_strength(self.hidden_ids[j], self.url_ids[k], 1, self.weight_o[j][k])
-        self.con.commit()
+        self.weights.set_matrix(0, self.word_ids, self.hidden_ids, self.weight_i)
+        self.weights.set_matrix(1, self.hidden_ids, self.url_ids, self.weight_o)
+        self.weights.tick()
+
 
+if __name__ == '__main__':
+    my_net = Searchnet('nn.db')
+    # # my_net.make_tables()  # 第一次运行，创建数据库表
+    word_world, word_river, word_bank = 101, 102, 103
+    url_worldbank, url_river, url_earth = 201, 202, 203
+    # my_net.generate_hidden_node([word_world, word_bank], [url_worldbank, url_river, url_earth])
+    # for w in my_net.con.execute('select * from wordhidden'):
+    #     print w
+    # for u in my_net.con.execute('select * from hiddenurl'):
+    #     print u
+    my_net.train_query([word_world, word_bank], [url_worldbank, url_river, url_earth], url_worldbank)
+    print my_net.get_result([word_world, word_bank], [url_worldbank, url_river, url_earth])
 
-my_net = Searchnet('nn.db')
-# # my_net.make_tables()  # 第一次运行，创建数据库表
-word_world, word_river, word_bank = 101, 102, 103
-url_worldbank, url_river, url_earth = 201, 202, 203
-# my_net.generate_hidden_node([word_world, word_bank], [url_worldbank, url_river, url_earth])
-# for w in my_net.con.execute('select * from wordhidden'):
-#     print w
-# for u in my_net.con.execute('select * from hiddenurl'):
-#     print u
-my_net.train_query([word_world, word_bank], [url_worldbank, url_river, url_earth], url_worldbank)
-print my_net.get_result([word_world, word_bank], [url_worldbank, url_river, url_earth])
-
-all_urls = [url_worldbank, url_river, url_earth]
-for i in range(30):
-    my_net.train_query([word_world, word_bank], all_urls, url_worldbank)
-    my_net.train_query([word_river, word_bank], all_urls, url_river)
-    my_net.train_query([word_world], all_urls, url_earth)
-print my_net.get_result([word_world, word_bank], all_urls)
-print my_net.get_result([word_river, word_bank], all_urls)
-print my_net.get_result([word_bank], all_urls)
+    all_urls = [url_worldbank, url_river, url_earth]
+    for i in range(30):
+        my_net.train_query([word_world, word_bank], all_urls, url_worldbank)
+        my_net.train_query([word_river, word_bank], all_urls, url_river)
+        my_net.train_query([word_world], all_urls, url_earth)
+    print my_net.get_result([word_world, word_bank], all_urls)
+    print my_net.get_result([word_river, word_bank], all_urls)
+    print my_net.get_result([word_bank], all_urls)
+    my_net.close()
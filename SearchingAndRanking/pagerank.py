@@ -0,0 +1,216 @@
+# coding: utf-8
+# author: luyf
+# create date: 2016.12.06
+
+import numpy as np
+
+
+DAMPING = 0.85  # 阻尼因子
+ITERATIONS = 20  # 最大迭代次数
+TOLERANCE = 1e-6  # 两次迭代之间PageRank值的L1距离小于该值时认为已收敛
+RESIDUAL_THRESHOLD = 1e-4  # 增量更新时，残差绝对值小于该值的网页不再向外传播
+
+
+def gather_ranges(indptr, rows):
+    """
+    取出CSR结构中若干行的所有元素位置
+    :param indptr: CSR的行指针
+    :param rows: 行下标数组
+    :return: (元素位置数组, 每个元素所属行在rows中的序号)
+    """
+    starts = indptr[rows]
+    counts = indptr[rows + 1] - starts
+    segments = np.repeat(np.arange(len(rows)), counts)
+    offsets = np.arange(counts.sum()) - np.repeat(np.cumsum(counts) - counts, counts)
+    return starts[segments] + offsets, segments
+
+
+class PageRank:
+    """
+    基于稀疏矩阵的PageRank计算引擎
+    一次性将link表读入内存，按目标网页构造CSR形式的邻接结构（indptr/indices），并预先算好每个网页的外链数，
+    之后的每一轮迭代都是NumPy的向量运算，不再逐行查询数据库
+    """
+    def __init__(self, con):
+        self.con = con
+        self.url_ids = np.zeros(0, dtype=np.int64)  # 下标 -> urlid，升序
+        self.indptr = np.zeros(1, dtype=np.int64)  # 第i个网页的回指链接源为 indices[indptr[i]:indptr[i+1]]
+        self.indices = np.zeros(0, dtype=np.int64)
+        self.out_indptr = np.zeros(1, dtype=np.int64)  # 按链接源组织的CSR结构，增量更新时用于向外传播
+        self.out_indices = np.zeros(0, dtype=np.int64)
+        self.out_degree = np.zeros(0)
+        self.scores = np.zeros(0)
+        self.touched = np.zeros(0, dtype=bool)  # 增量更新中PageRank值发生过变化的网页
+
+    def index_of(self, url_ids):
+        """
+        将urlid数组转换为下标数组
+        :param url_ids: urlid数组
+        :return: 下标数组
+        """
+        return np.searchsorted(self.url_ids, url_ids)
+
+    def load_graph(self):
+        """
+        读取urllist和link表，建立CSR邻接结构
+        与原先逐行查询的算法保持一致：同一对网页之间的多条链接只算一次回指，
+        但链接源的外链总数按link表中的所有记录计算
+        :return:
+        """
+        url_ids = [row[0] for row in self.con.execute('select rowid from urllist order by rowid')]
+        edges = self.con.execute('select distinct fromid, toid from link').fetchall()
+        out_counts = self.con.execute('select fromid, count(*) from link group by fromid').fetchall()
+        self.build(url_ids, edges, out_counts)
+
+    def build(self, url_ids, edges, out_counts):
+        """
+        由网页、链接和外链数建立CSR邻接结构，分片索引计算全局PageRank时直接传入合并后的数据
+        :param url_ids: 升序排列的网页id
+        :param edges: 去重后的 (链接源id, 链接目标id) 列表
+        :param out_counts: (链接源id, 外链数) 列表
+        :return:
+        """
+        self.url_ids = np.array(url_ids, dtype=np.int64)
+        n = len(self.url_ids)
+
+        edges = np.array(edges, dtype=np.int64).reshape(-1, 2)
+        from_idx = self.index_of(edges[:, 0])
+        to_idx = self.index_of(edges[:, 1])
+
+        # 按目标网页排序，得到CSR结构
+        order = np.argsort(to_idx, kind='mergesort')
+        self.indices = from_idx[order]
+        self.indptr = np.zeros(n + 1, dtype=np.int64)
+        np.cumsum(np.bincount(to_idx, minlength=n), out=self.indptr[1:])
+
+        order = np.argsort(from_idx, kind='mergesort')
+        self.out_indices = to_idx[order]
+        self.out_indptr = np.zeros(n + 1, dtype=np.int64)
+        np.cumsum(np.bincount(from_idx, minlength=n), out=self.out_indptr[1:])
+
+        out_counts = np.array(out_counts, dtype=np.int64).reshape(-1, 2)
+        self.out_degree = np.zeros(n)
+        self.out_degree[self.index_of(out_counts[:, 0])] = out_counts[:, 1]
+
+        self.scores = np.ones(n)  # 最初将每个网页的PageRank值设置为1.0
+        self.touched = np.ones(n, dtype=bool)
+
+    def load_scores(self):
+        """
+        从pagerank表读取上一次的计算结果作为初始值（warm start），必须在load_graph之后调用
+        :return: 上一次计算时还不存在的网页的下标数组
+        """
+        rows = np.array(self.con.execute('select urlid, score from pagerank').fetchall()).reshape(-1, 2)
+        known = np.zeros(len(self.url_ids), dtype=bool)
+        if len(rows) > 0:
+            url_ids = rows[:, 0].astype(np.int64)
+            idx = np.minimum(self.index_of(url_ids), max(len(self.url_ids) - 1, 0))
+            valid = self.url_ids[idx] == url_ids  # 忽略已不在urllist中的网页
+            self.scores[idx[valid]] = rows[valid, 1]
+            known[idx[valid]] = True
+        self.touched = np.zeros(len(self.url_ids), dtype=bool)
+        return np.nonzero(~known)[0]
+
+    def propagate(self, scores):
+        """
+        进行一轮PageRank迭代：每个网页的值为 0.15 + 0.85 * sum(链接源的PageRank值 / 链接源的外链数)
+        :param scores: 当前各网页的PageRank值
+        :return: 新的PageRank值
+        """
+        result = np.empty(len(scores))
+        result.fill(1 - DAMPING)
+        if len(self.indices) == 0:
+            return result
+        contributions = (scores / np.maximum(self.out_degree, 1))[self.indices]
+        starts = self.indptr[:-1]
+        non_empty = starts < self.indptr[1:]
+        # 相邻两个非空行的起点之间恰好是前一行的所有回指链接
+        result[non_empty] += DAMPING * np.add.reduceat(contributions, starts[non_empty])
+        return result
+
+    def propagate_rows(self, scores, rows):
+        """
+        只对指定的网页进行一轮PageRank迭代
+        :param scores: 当前各网页的PageRank值
+        :param rows: 网页下标数组
+        :return: 这些网页的新PageRank值
+        """
+        positions, segments = gather_ranges(self.indptr, rows)
+        contributions = (scores / np.maximum(self.out_degree, 1))[self.indices[positions]]
+        return (1 - DAMPING) + DAMPING * np.bincount(segments, weights=contributions, minlength=len(rows))
+
+    def update(self, changed_url_ids, threshold=RESIDUAL_THRESHOLD, new_rows=None):
+        """
+        增量更新PageRank，以现有的PageRank值为起点，只从发生变化的网页向外传播
+        外链发生变化的网页会改变其所有链接目标的值，新网页本身也需要计算，
+        先求出这些网页的残差（一轮迭代后的值与当前值之差），然后不断把残差超过阈值的网页的残差
+        累加到其自身的值上，并按外链数分摊给它链接到的网页，直到所有残差都小于阈值
+        :param changed_url_ids: link记录发生变化的链接源urlid列表
+        :param threshold: 残差阈值
+        :param new_rows: 新网页的下标数组（load_scores的返回值）
+        :return: 传播的轮数
+        """
+        sources = self.index_of(np.array(changed_url_ids, dtype=np.int64))
+        positions, segments = gather_ranges(self.out_indptr, sources)
+        seeds = [self.out_indices[positions]]
+        if new_rows is not None:
+            seeds.append(new_rows)
+        seeds = np.unique(np.concatenate(seeds))
+
+        residual = np.zeros(len(self.url_ids))
+        residual[seeds] = self.propagate_rows(self.scores, seeds) - self.scores[seeds]
+        active = seeds[np.abs(residual[seeds]) > threshold]
+
+        rounds = 0
+        while len(active) > 0:
+            rounds += 1
+            delta = residual[active]
+            self.scores[active] += delta
+            self.touched[active] = True
+            residual[active] = 0
+
+            # 把残差沿外链传播给链接目标
+            positions, segments = gather_ranges(self.out_indptr, active)
+            targets = self.out_indices[positions]
+            np.add.at(residual, targets, DAMPING * (delta / np.maximum(self.out_degree[active], 1))[segments])
+            targets = np.unique(targets)
+            active = targets[np.abs(residual[targets]) > threshold]
+        print "Incremental update: %d seeds, %d rounds, %d pages changed" % (len(seeds), rounds, self.touched.sum())
+        return rounds
+
+    def iterate(self, iterations=ITERATIONS, tolerance=TOLERANCE):
+        """
+        迭代计算PageRank，直到收敛或达到最大迭代次数
+        :param iterations: 最大迭代次数
+        :param tolerance: 收敛阈值（L1距离）
+        :return: 实际迭代次数
+        """
+        for i in range(iterations):
+            new_scores = self.propagate(self.scores)
+            delta = np.abs(new_scores - self.scores).sum()
+            self.scores = new_scores
+            self.touched[:] = True
+            print "Iteration %d, delta %f" % (i, delta)
+            if delta < tolerance:
+                return i + 1
+        return iterations
+
+    def save(self):
+        """
+        清空pagerank表，并用一次批量插入写回所有网页的PageRank值，由调用者提交
+        不drop table再重建：pysqlite会立即提交建表、删表语句，并发查询的连接可能读到不存在或为空的表
+        :return:
+        """
+        self.con.execute('create table if not exists pagerank(urlid primary key, score)')
+        self.con.execute('delete from pagerank')
+        self.con.executemany('insert into pagerank(urlid, score) values (?, ?)',
+                             zip(self.url_ids.tolist(), self.scores.tolist()))
+
+    def save_changed(self):
+        """
+        只把增量更新中发生变化的网页写回pagerank表，由调用者提交
+        :return:
+        """
+        rows = np.nonzero(self.touched)[0]
+        self.con.executemany('insert or replace into pagerank(urlid, score) values (?, ?)',
+                             zip(self.url_ids[rows].tolist(), self.scores[rows].tolist()))
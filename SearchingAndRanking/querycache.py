@@ -0,0 +1,67 @@
+# coding: utf-8
+# author: luyf
+# create date: 2016.12.10
+
+from collections import OrderedDict
+
+
+CACHE_SIZE = 1000  # 缓存的查询结果数上限
+
+
+class QueryCache:
+    """
+    查询结果的LRU缓存
+    每个结果都记录了计算时的索引代数，代数变化说明Crawler提交了新数据或重新计算了PageRank，此时清空整个缓存
+    """
+    def __init__(self, capacity=CACHE_SIZE):
+        self.capacity = capacity
+        self.entries = OrderedDict()  # 键 -> 结果，按最近使用的顺序排列，最早使用的在前
+        self.generation = None
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def check_generation(self, generation):
+        if generation != self.generation:
+            self.entries.clear()
+            self.generation = generation
+
+    def get(self, key, generation):
+        """
+        查找缓存的结果
+        :param key: 查询的键
+        :param generation: 当前的索引代数
+        :return: 缓存的结果，不存在时返回None
+        """
+        self.check_generation(generation)
+        if key not in self.entries:
+            self.misses += 1
+            return None
+        self.hits += 1
+        result = self.entries.pop(key)
+        self.entries[key] = result  # 移到最近使用的位置
+        return result
+
+    def put(self, key, generation, result):
+        """
+        保存查询结果，超过容量时淘汰最久没有使用的结果，调用前应先用get查找过
+        :param key: 查询的键
+        :param generation: 计算完成后重新读取的索引代数，与get时不同说明计算期间索引已经更新
+        :param result: 查询结果
+        :return:
+        """
+        if self.capacity <= 0 or generation != self.generation:
+            return  # 计算期间索引已经更新，结果已过期
+        self.entries.pop(key, None)
+        self.entries[key] = result
+        while len(self.entries) > self.capacity:
+            self.entries.popitem(last=False)
+            self.evictions += 1
+
+    def stats(self):
+        """
+        :return: 缓存的使用情况
+        """
+        total = self.hits + self.misses
+        return {'size': len(self.entries), 'capacity': self.capacity, 'hits': self.hits, 'misses': self.misses,
+                'evictions': self.evictions, 'hit_rate': float(self.hits) / total if total else 0.0}
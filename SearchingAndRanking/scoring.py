@@ -0,0 +1,146 @@
+# coding: utf-8
+# author: luyf
+# create date: 2016.12.17
+
+import numpy as np
+
+
+VERY_SMALL = 0.00001  # 避免被0整除
+
+
+class Candidates:
+    """
+    一次查询的候选网页及其特征，每个特征是一列NumPy数组，与按升序排列的urlid数组对齐
+    归一化、按权重求和和选出前k名都是对整列的向量运算，不再为每个特征建立字典
+    """
+    def __init__(self, url_ids, frequency, location, distance, features):
+        """
+        :param url_ids: 升序排列的候选网页id
+        :param frequency: 单词频度（各单词出现次数之积）
+        :param location: 各单词最早出现位置之和
+        :param distance: 各单词依次出现的位置之间距离之和的最小值
+        :param features: FeatureStore，从中取出候选网页的PageRank值和外部回指链接数
+        """
+        self.url_ids = np.asarray(url_ids, dtype=np.int64)
+        self.frequency = np.asarray(frequency, dtype=np.float64)
+        self.location = np.asarray(location, dtype=np.float64)
+        self.distance = np.asarray(distance, dtype=np.float64)
+        self.page_rank = features.get_page_ranks(self.url_ids)
+        self.inbound = features.get_inbounds(self.url_ids)
+        self.link_text = np.zeros(len(self.url_ids))  # 链接文字的评价值，由add_link_text累加
+
+    @classmethod
+    def from_rows(cls, rows, features):
+        """
+        由get_match_rows返回的行集计算各网页的特征，与frequency_score、location_score和distance_score的定义相同
+        :param rows: 行集，每一行的第一项是urlid，后面紧跟的是各待查找单词的位置
+        :param features: FeatureStore
+        :return: Candidates
+        """
+        rows = np.array(rows, dtype=np.int64).reshape(len(rows), -1)
+        url_ids, inverse = np.unique(rows[:, 0], return_inverse=True)
+        frequency = np.bincount(inverse, minlength=len(url_ids))
+        location = np.empty(len(url_ids))
+        location.fill(np.inf)
+        np.minimum.at(location, inverse, rows[:, 1:].sum(axis=1))
+        distance = np.zeros(len(url_ids))  # 最多只有一个单词时距离都为0
+        if rows.shape[1] > 2:
+            distance.fill(np.inf)
+            np.minimum.at(distance, inverse, np.abs(np.diff(rows[:, 1:], axis=1)).sum(axis=1))
+        return cls(url_ids, frequency, location, distance, features)
+
+    def __len__(self):
+        return len(self.url_ids)
+
+    def index_of(self, url_ids):
+        """
+        :param url_ids: urlid数组，候选网页不能为空
+        :return: (下标数组, 是否为候选网页的布尔数组)
+        """
+        positions = np.minimum(np.searchsorted(self.url_ids, url_ids), len(self.url_ids) - 1)
+        return positions, self.url_ids[positions] == url_ids
+
+    def add_link_text(self, rows):
+        """
+        按顺序把链接文字的评价值累加到链接目标上，不是候选网页的目标被忽略
+        :param rows: Searcher.get_link_text_rows的返回值 [(链接目标urlid, 评价值), ...]
+        :return:
+        """
+        if not rows or not len(self.url_ids):
+            return
+        rows = np.array(rows, dtype=np.float64).reshape(-1, 2)
+        positions, valid = self.index_of(rows[:, 0].astype(np.int64))
+        np.add.at(self.link_text, positions[valid], rows[valid, 1])
+
+    def get_features(self, url_id):
+        """
+        :param url_id: 候选网页id
+        :return: 该网页的特征值字典
+        """
+        n = self.index_of(np.array([url_id], dtype=np.int64))[0][0]
+        return {'frequency': int(self.frequency[n]), 'location': int(self.location[n]),
+                'distance': int(self.distance[n]), 'inbound': int(self.inbound[n]),
+                'page_rank': float(self.page_rank[n]), 'link_text': float(self.link_text[n])}
+
+    def get_bounds(self, weights):
+        """
+        归一化所需的各特征在候选网页中的最值，位置和距离取最小值，其他特征取最大值
+        :param weights: 各特征的权重，权重为0的PageRank、距离和回指链接数不需要计算
+        :return: {特征: 最值}
+        """
+        bounds = {'frequency': float(self.frequency.max()),
+                  'location': float(self.location.min()),
+                  'link_text': float(self.link_text.max()) + VERY_SMALL,
+                  'page_rank': 0.0}
+        if weights.get('page_rank'):
+            bounds['page_rank'] = float(self.page_rank.max())
+        if weights.get('distance'):
+            bounds['distance'] = float(self.distance.min())
+        if weights.get('inbound'):
+            bounds['inbound'] = float(self.inbound.max())
+        return bounds
+
+    def score(self, bounds, weights):
+        """
+        用给定的最值归一化各特征，按权重求和
+        频度、回指链接数、PageRank和链接文字越大越好，除以最大值；位置和距离越小越好，用最小值除以它
+        距离的最小值为0时（如只有一个单词），距离为0的网页得1分，其他网页得0分
+        :param bounds: get_bounds或merge_bounds的返回值
+        :param weights: 各特征的权重
+        :return: 与url_ids对齐的评价值数组
+        """
+        scores = (weights.get('frequency', 0) * self.frequency / (bounds['frequency'] or VERY_SMALL) +
+                  weights.get('location', 0) * float(bounds['location']) / np.maximum(VERY_SMALL, self.location) +
+                  weights.get('link_text', 0) * (self.link_text + VERY_SMALL) / bounds['link_text'])
+        if weights.get('distance'):
+            if bounds['distance'] == 0:
+                scores += weights['distance'] * (self.distance == 0)
+            else:
+                scores += weights['distance'] * bounds['distance'] / np.maximum(VERY_SMALL, self.distance)
+        if weights.get('inbound'):
+            scores += weights['inbound'] * self.inbound / (bounds['inbound'] or VERY_SMALL)
+        if weights.get('page_rank'):
+            scores += weights['page_rank'] * self.page_rank / (bounds['page_rank'] or 1.0)
+        return scores
+
+    def top_k(self, scores, k):
+        """
+        选出评价值最高的k个网页，评价值相同时urlid大的在前
+        先用np.partition找出第k大的值，只对不小于它的网页排序
+        不再按得分上限提前结束（MaxScore）：PageRank在构造时已经整列取出，对全部候选网页打分并选出前k名
+        只需要线性时间的向量运算，而先算不含PageRank的部分得分再按上限筛选本身就要同样的时间；
+        默认权重下几乎筛不掉网页，反而更慢，见benchmark.py --scoring（100万个候选网页：44ms对70ms，
+        PageRank权重为0.1时筛掉99.9%的网页也只是43ms对42ms）
+        :param scores: score的返回值
+        :param k: 结果数
+        :return: 按评价值从高到低排列的 [(评价值, urlid), ...]
+        """
+        n = len(scores)
+        if k <= 0 or n == 0:
+            return []
+        if n > k:
+            selected = np.nonzero(scores >= np.partition(scores, n - k)[n - k])[0]
+        else:
+            selected = np.arange(n)
+        selected = selected[np.lexsort((self.url_ids[selected], scores[selected]))[::-1][:k]]
+        return zip(scores[selected].tolist(), self.url_ids[selected].tolist())
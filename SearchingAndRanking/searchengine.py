@@ -3,13 +3,29 @@
 # create date: 2016.12.05
 
 import urllib2
+import os
 
 import re
+import time
+import hashlib
+from bisect import bisect_left
+from itertools import groupby
 from bs4 import BeautifulSoup
 from urlparse import urljoin
 from pysqlite2 import dbapi2 as sqlite
 import chardet
-import jieba
+import numpy as np
+from multiprocessing import Pool
+from pagerank import PageRank, TOLERANCE, RESIDUAL_THRESHOLD
+from fetcher import FetchPool, FETCHERS, PER_HOST, DELAY, fetch_page
+from indexfile import IndexFile, build_index_file
+from featurestore import FeatureStore
+from scoring import Candidates
+from suggest import PrefixIndex, SUGGESTIONS
+from querycache import QueryCache, CACHE_SIZE
+from frontier import Frontier, DONE, FAILED
+from instrument import timed, recorded, InstrumentedConnection, NULL_CONTEXT
+from tokenizer import extract_text, separate_words, separate_words_many, create_tokenize_pool, TOKENIZERS
 
 
 # 构造一个单词列表，这些单词被忽略
@@ -17,18 +33,172 @@ IGNORE_WORDS = set(['the', 'of', 'to', 'and', 'a', 'in', 'is', 'it',
                     u'是', u'的', u'它', u'他', u'她', u'也'])
 CRAWLER_DEPTH = 3  # 爬虫深度
 ITERATIONS = 20  # 计算PageRank的迭代次数
+BATCH_SIZE = 500  # 批量查询时每条SQL绑定的参数个数上限（SQLite默认上限为999）
+BATCH_PAGES = 50  # 并发抓取时每次提交事务写入的网页数
+TOP_K = 10  # 查询返回的结果数
+DEADLINE_CHECK = 1024  # 设置了查询期限时，每处理多少个网页检查一次是否超时
+# 各评价特征的默认权重，权重必须非负，查询时可以传入其他权重
+DEFAULT_WEIGHTS = {'frequency': 1.0, 'location': 1.0, 'page_rank': 1.0, 'link_text': 1.0,
+                   'distance': 0.0, 'inbound': 0.0}
+
+
+def merge_bounds(bounds_list):
+    """
+    合并多个分片的特征最值（Searcher.get_bounds的返回值），使各分片用相同的标准归一化
+    :param bounds_list: 最值字典列表
+    :return: 合并后的最值字典
+    """
+    merged = dict(bounds_list[0])
+    for bounds in bounds_list[1:]:
+        for (feature, value) in bounds.items():
+            if feature in ('location', 'distance'):
+                merged[feature] = min(merged[feature], value)
+            else:
+                merged[feature] = max(merged[feature], value)
+    return merged
+
+
+def page_digest(html):
+    """
+    :param html: 网页内容，unicode按UTF-8编码后计算
+    :return: 网页内容的散列值，重新抓取时据此判断网页是否变化
+    """
+    if isinstance(html, unicode):
+        html = html.encode('utf-8')
+    return hashlib.md5(html).hexdigest()
+
+
+class QueryTimeout(Exception):
+    """
+    查询超过了Searcher.deadline
+    """
+    pass
+
+
+batch_searcher = None  # top_k_many并行计算时每个进程中的Searcher
+
+
+def init_batch_worker(db_name, index_file):
+    global batch_searcher
+    batch_searcher = Searcher(db_name, index_file=index_file, cache_size=0)
+    batch_searcher.refresh()
+
+
+def batch_worker_top_k(args):
+    word_lists, k, weights = args
+    return batch_searcher.rank_many(word_lists, k, weights)
 
 
 class Crawler:
     # 初始化Crawler类并传入数据库名称
-    def __init__(self, dbname):
+    def __init__(self, dbname, bulk_index=False, instrument=None):
+        """
+        :param dbname: 数据库名称
+        :param bulk_index: 是否使用批量索引模式，批量模式下在内存中缓存 条目->rowid 的映射，
+                           并以executemany批量写入wordlocation、link和linkwords
+        :param instrument: instrument.Instrument对象，指定后统计每个网页各阶段的耗时和SQL语句数
+        """
+        self.instrument = instrument
         self.con = sqlite.connect(dbname)
+        if instrument is not None:
+            self.con = InstrumentedConnection(self.con, instrument)
+        self.con.execute('create table if not exists indexinfo(name primary key, value)')
+        self.con.execute('create table if not exists pagestate(urlid integer primary key, etag, modified, digest)')
+        # 墓碑：网页被删除或更新时记录当时wordlocation和link的最大rowid，该网页rowid不超过这两个值的行都已失效
+        # compacted表示失效的行已经被合并删除，导出过索引文件时墓碑要保留到下次导出
+        self.con.execute('create table if not exists tombstone(urlid integer primary key, wordrow integer, linkrow integer, '
+                         'compacted integer default 0)')
+        if 'compacted' not in [row[1] for row in self.con.execute('pragma table_info(tombstone)')]:
+            self.con.execute('alter table tombstone add column compacted integer default 0')
+        self.index_changed = False  # 当前事务是否修改了查询用到的表，提交时据此决定是否增加索引代数
+        self.bulk_index = bulk_index
+        self.entry_cache = {'wordlist': {}, 'urllist': {}}  # 表名 -> {条目: rowid}
+        self.generation = None  # 本次抓取的代数，写入link表，用于找出上次计算PageRank之后新增的链接
+        self.tokenize_pool = None  # 并发抓取时用于分词的进程池
 
     def __del__(self):
         self.con.close()
 
+    def get_stats(self):
+        """
+        :return: Instrument.stats()的返回值，没有启用统计时返回None
+        """
+        if self.instrument is None:
+            return None
+        return self.instrument.stats()
+
+    def timer(self, stage):
+        """
+        :return: 记录代码块耗时的上下文管理器，没有启用统计时什么都不做
+        """
+        if self.instrument is None:
+            return NULL_CONTEXT
+        return self.instrument.stage(stage)
+
+    def record(self, page):
+        """
+        :return: 把一个网页的处理过程作为一条记录的上下文管理器，没有启用统计时什么都不做
+        """
+        if self.instrument is None:
+            return NULL_CONTEXT
+        return self.instrument.record('page', page)
+
+    @timed('db_commit')
     def db_commit(self):
+        """
+        提交事务，如果修改了单词位置、链接、墓碑或评价值，同时把索引代数index_generation加1，
+        Searcher据此判断缓存的数据是否过期；只写入frontier、pagestate或抓取代数时索引代数不变，Searcher不必重新加载
+        :return:
+        """
+        if self.index_changed:
+            self.set_info('index_generation', self.get_info('index_generation', 0) + 1)
         self.con.commit()
+        self.index_changed = False
+
+    # 放弃当前事务
+    def db_rollback(self):
+        self.con.rollback()
+        self.index_changed = False
+        self.generation = None  # 回滚的事务中可能开始了新的一代，下次写入链接时重新开始
+
+    # 读取索引的元信息
+    def get_info(self, name, default=None):
+        """
+        从indexinfo表中读取一项元信息，如抓取代数crawl_generation、计算PageRank时的代数pagerank_generation
+        :param name: 名称
+        :param default: 不存在时的默认值
+        :return: 值
+        """
+        res = self.con.execute('select value from indexinfo where name=?', (name,)).fetchone()
+        if res is None:
+            return default
+        return res[0]
+
+    # 写入索引的元信息
+    def set_info(self, name, value):
+        self.con.execute('insert or replace into indexinfo(name, value) values (?, ?)', (name, value))
+
+    # 开始新一代抓取
+    def start_generation(self):
+        """
+        抓取代数加1，此后新增的链接都记录为这一代
+        对于旧版本建立的数据库，补建indexinfo表和link表的generation字段
+        不单独提交，与当前事务一起提交：第一次写入链接时才开始新的一代，提交会把网页写了一半的索引一起提交
+        :return: 新的抓取代数
+        """
+        columns = [row[1] for row in self.con.execute('pragma table_info(link)')]
+        if 'generation' not in columns:
+            self.con.execute('alter table link add column generation integer default 0')
+            self.con.execute('create index linkgenidx on link(generation)')
+        self.generation = self.get_info('crawl_generation', 0) + 1
+        self.set_info('crawl_generation', self.generation)
+        return self.generation
+
+    # 当前的抓取代数，第一次写入链接时开始新的一代
+    def get_generation(self):
+        if self.generation is None:
+            self.start_generation()
+        return self.generation
 
     # 辅助函数，用于获取条目的id，并且如果条目不存在，就将其加入到数据库中
     def get_entry_id(self, table, file_id, value, create_new=True):
@@ -52,6 +222,44 @@ class Crawler:
         else:
             return res[0]
 
+    # 批量获取条目的id，不存在的条目批量插入数据库
+    def get_entry_ids(self, table, file_id, values):
+        """
+        get_entry_id的批量版本，先查内存缓存，未命中的条目分批用in查询，仍不存在的用executemany一次插入
+        新插入的行在同一事务内连续分配rowid，因此可以由插入前的max(rowid)直接推算，无需逐条回查
+        :param table: 表名
+        :param file_id: 字段名
+        :param values: 值列表，可以有重复
+        :return: 与values一一对应的id列表
+        """
+        cache = self.entry_cache.setdefault(table, {})
+        missing = []  # 按首次出现的顺序去重，新条目的rowid顺序与逐条插入时一致
+        seen = set()
+        for v in values:
+            if v not in cache and v not in seen:
+                seen.add(v)
+                missing.append(v)
+
+        # 分批查询数据库中已存在的条目
+        for start in range(0, len(missing), BATCH_SIZE):
+            chunk = missing[start:start+BATCH_SIZE]
+            cur = self.con.execute(
+                'select rowid, %s from %s where %s in (%s)' % (file_id, table, file_id, ','.join(['?']*len(chunk))),
+                chunk
+            )
+            for (rowid, value) in cur:
+                cache[value] = rowid
+
+        # 批量插入新条目
+        new_values = [v for v in missing if v not in cache]
+        if new_values:
+            max_rowid = self.con.execute('select max(rowid) from %s' % table).fetchone()[0] or 0
+            self.con.executemany('insert into %s (%s) values (?)' % (table, file_id),
+                                 [(v,) for v in new_values])
+            for i in range(len(new_values)):
+                cache[new_values[i]] = max_rowid + i + 1
+        return [cache[v] for v in values]
+
     # 为每个网页建立索引
     def add_to_index(self, url, soup):
         """
@@ -64,14 +272,30 @@ class Crawler:
         """
         if self.is_indexed(url):
             return
-        print 'Indexing %s' % url
 
         # 获取每个单词
         text = self.get_text_only(soup)
         words = self.separte_words(text)
+        self.index_words(url, words)
+
+    # 将网页的单词列表写入索引
+    @timed('index_words')
+    def index_words(self, url, words):
+        """
+        将网页及其所有单词加入索引
+        :param url: 网页url
+        :param words: 网页的单词列表，下标即单词位置
+        :return:
+        """
+        print 'Indexing %s' % url
 
         # 得到url的id
         url_id = self.get_entry_id('urllist', 'url', url)
+        self.index_changed = True
+
+        if self.bulk_index:
+            self.add_words_bulk(url_id, words)
+            return
 
         # 将每个单词与该url关联
         for i in range(len(words)):
@@ -81,37 +305,38 @@ class Crawler:
             word_id = self.get_entry_id('wordlist', 'word', word)
             self.con.execute('insert into wordlocation(urlid, wordid, location) values(%d, %d, %d)' %(url_id, word_id, i))
 
+    # 批量模式下将一个网页的所有单词与url关联
+    def add_words_bulk(self, url_id, words):
+        """
+        一次解析网页中所有单词的id，并用一条executemany写入wordlocation
+        :param url_id: 网页的id
+        :param words: 网页的单词列表，下标即单词位置
+        :return:
+        """
+        locations = [i for i in range(len(words)) if words[i] not in IGNORE_WORDS]
+        word_ids = self.get_entry_ids('wordlist', 'word', [words[i] for i in locations])
+        self.con.executemany('insert into wordlocation(urlid, wordid, location) values(?, ?, ?)',
+                             [(url_id, word_ids[n], locations[n]) for n in range(len(locations))])
+
     # 从一个HTML网页中获取文字（不带标签的）
+    @timed('get_text_only')
     def get_text_only(self, soup):
         """
-        递归向下的方式获取网页中的文字，保留了文字出现的前后顺序
+        获取网页中的文字，保留了文字出现的前后顺序
         :param soup: 含有标签的网页
         :return:网页中的文字
         """
-        text = soup.string  # 只有一个子节点的时候，获取第该节点的内容，否则返回None
-        if text is None:
-            next_contents = soup.contents  # 返回该节点的子节点列表
-            result_text = ''
-            for content_item in next_contents:
-                sub_text = self.get_text_only(content_item)
-                result_text += sub_text + '\n'
-            return result_text
-        else:
-            return text.strip()  # 移除字符串头尾指定的字符，默认为空格
+        return extract_text(soup)
 
     # 根据任何非空白字符进行分词处理
+    @timed('separte_words')
     def separte_words(self, text):
         """
-        将字符串拆分成一组独立的单词
+        将字符串拆分成一组独立的单词，只有含汉字的片段使用结巴分词
         :param text: 待拆分的字符串
         :return: 单词list
         """
-        result_list = []
-        splitter = re.compile(ur'[^a-zA-Z0-9_\u4e00-\u9fa5]')  # python2.7中要使用‘ur’匹配任意不是字母，数字，下划线，汉字的字符
-        for s in splitter.split(text):  # 使用结巴分词，处理中文分词
-            if s != '':
-                result_list.extend(jieba.lcut(s.lower()))
-        return result_list
+        return separate_words(text)
 
     # 如果url已经建立索引，返回true
     def is_indexed(self, url):
@@ -154,7 +379,8 @@ class Crawler:
         toid = self.get_entry_id('urllist', 'url', url_to)
         if fromid == toid:
             return
-        cur = self.con.execute("insert into link(fromid,toid) values (%d,%d)" % (fromid, toid))
+        cur = self.con.execute("insert into link(fromid,toid,generation) values (%d,%d,%d)"
+                               % (fromid, toid, self.get_generation()))
         linkid = cur.lastrowid
         for word in words:
             if word in IGNORE_WORDS:
@@ -162,40 +388,383 @@ class Crawler:
             wordid = self.get_entry_id('wordlist', 'word', word)
             self.con.execute("insert into linkwords(linkid,wordid) values (%d,%d)" % (linkid, wordid))
 
-    # 从一小组网页开始进行广度优先搜索，直至某一给定深度
-    def crawl(self, pages, depth=CRAWLER_DEPTH):
+    # 批量添加一个网页的所有外链
+    def add_link_refs(self, url_from, links):
+        """
+        add_link_ref的批量版本，一次解析所有目标url和链接文字中单词的id，
+        再用executemany写入link和linkwords
+        :param url_from: 当前页面链接
+        :param links: (关联到的链接, 链接的文字) 列表
+        :return:
+        """
+        fromid = self.get_entry_ids('urllist', 'url', [url_from])[0]
+        toids = self.get_entry_ids('urllist', 'url', [url_to for (url_to, link_text) in links])
+        kept = [n for n in range(len(links)) if toids[n] != fromid]
+        if not kept:
+            return
+        link_words = separate_words_many([links[n][1] for n in kept])  # 一次为所有链接文字分词
+        link_rows = [(toids[kept[i]], [w for w in link_words[i] if w not in IGNORE_WORDS])
+                     for i in range(len(kept))]  # (toid, 链接文字中的单词列表)
+
+        max_linkid = self.con.execute('select max(rowid) from link').fetchone()[0] or 0
+        generation = self.get_generation()
+        self.con.executemany('insert into link(fromid,toid,generation) values (?,?,?)',
+                             [(fromid, toid, generation) for (toid, words) in link_rows])
+
+        all_words = [w for (toid, words) in link_rows for w in words]
+        word_ids = iter(self.get_entry_ids('wordlist', 'word', all_words))
+        linkwords = []
+        for n in range(len(link_rows)):
+            linkid = max_linkid + n + 1  # 同一事务内link的rowid连续分配
+            for word in link_rows[n][1]:
+                linkwords.append((linkid, next(word_ids)))
+        self.con.executemany('insert into linkwords(linkid,wordid) values (?,?)', linkwords)
+
+    # 添加一个网页的所有外链
+    @timed('add_page_links')
+    def add_page_links(self, page, links):
+        """
+        批量模式下一次写入所有外链，否则逐条调用add_link_ref
+        :param page: 当前页面链接
+        :param links: (关联到的链接, 链接的文字) 列表
+        :return:
+        """
+        if links:
+            self.index_changed = True
+        if self.bulk_index:
+            if links:
+                self.add_link_refs(page, links)
+        else:
+            for (url, link_text) in links:
+                self.add_link_ref(page, url, link_text)
+
+    # 获取网页中的所有外链
+    @timed('get_page_links')
+    def get_page_links(self, page, soup):
+        """
+        找到网页中所有带href属性的超链接，转换为去掉位置部分的绝对路径
+        :param page: 当前页面链接
+        :param soup: 网页
+        :return: (链接, 链接的文字) 列表
+        """
+        page_links = []
+        links = soup.find_all('a')  # 找到所有超链接标签
+        for link in links:
+            if 'href' in dict(link.attrs):  # 获取link的属性字典
+                url = urljoin(page, link['href'])  # 从相对路径获取绝对路径, page+相对路径地址
+                if url.find("'") != -1:  # 存在不合法字符
+                    continue
+                url = url.split('#')[0]  # 去掉位置部分
+                page_links.append((url, self.get_text_only(link)))
+        return page_links
+
+    # 解析下载的网页，在抓取线程中执行
+    @timed('parse_page')
+    def parse_page(self, url, html):
+        """
+        解析网页，得到单词列表和外链，不访问数据库
+        :param url: 网页url
+        :param html: 网页内容
+        :return: (单词列表, (链接, 链接的文字) 列表)
+        """
+        soup = BeautifulSoup(html, 'lxml')
+        text = self.get_text_only(soup)
+        if self.tokenize_pool is not None:  # 在其他进程中分词，不占用当前进程的GIL
+            words = self.tokenize_pool.apply(separate_words, (text,))
+        else:
+            words = self.separte_words(text)
+        return words, self.get_page_links(url, soup)
+
+    # 解析网页并计算网页内容的散列值，在抓取线程中执行
+    def parse_page_digest(self, url, html):
+        """
+        :return: (单词列表, (链接, 链接的文字) 列表, 网页内容的散列值)
+        """
+        words, page_links = self.parse_page(url, html)
+        return words, page_links, page_digest(html)
+
+    # 读取网页上次抓取时的响应头和散列值
+    def get_page_state(self, url_id):
+        """
+        :param url_id: 网页id
+        :return: (ETag, Last-Modified, 散列值)，没有记录时返回None
+        """
+        return self.con.execute('select etag, modified, digest from pagestate where urlid=?', (url_id,)).fetchone()
+
+    # 记录网页本次抓取时的响应头和散列值
+    def set_page_state(self, url, etag, modified, digest):
+        """
+        :param url: 网页url
+        :param etag: 响应头ETag
+        :param modified: 响应头Last-Modified
+        :param digest: 网页内容的散列值
+        :return:
+        """
+        url_id = self.get_entry_id('urllist', 'url', url)
+        self.con.execute('insert or replace into pagestate(urlid, etag, modified, digest) values (?, ?, ?, ?)',
+                         (url_id, etag, modified, digest))
+
+    # 把网页现有的单词位置和外链标记为失效
+    def add_tombstone(self, url_id):
+        """
+        只写入墓碑表的一行，不扫描wordlocation和link；查询时跳过失效的行，compact时再物理删除
+        之后为该网页写入的行rowid更大，不受这个墓碑影响
+        :param url_id: 网页id
+        :return:
+        """
+        word_row = self.con.execute('select max(rowid) from wordlocation').fetchone()[0] or 0
+        link_row = self.con.execute('select max(rowid) from link').fetchone()[0] or 0
+        self.con.execute('insert or replace into tombstone(urlid, wordrow, linkrow, compacted) values (?, ?, ?, 0)',
+                         (url_id, word_row, link_row))
+        self.index_changed = True
+
+    # 网页是否有还没有失效的单词位置或外链
+    def has_live_rows(self, url_id):
+        """
+        依次检查pagestate、link和wordlocation，前两张表按主键或索引查找，只有都没有时才扫描wordlocation，
+        与is_indexed相同
+        :param url_id: 网页id
+        :return: 是否有墓碑之后写入的行
         """
-        循环遍历网页列表，针对每个网页调用add_to_index函数，添加索引。
-        利用BeautifulSoup抓取网页中的所有链接，将这些链接添加到new_pages集合中
-        一定深度循环结束之前，将new_page赋给pages,这一过程再次循环，知道depth结束
-        :param pages:网页列表
-        :param depth:循环深度
+        if self.con.execute('select 1 from pagestate where urlid=?', (url_id,)).fetchone() is not None:
+            return True
+        tombstone = self.con.execute('select wordrow, linkrow from tombstone where urlid=?', (url_id,)).fetchone() or (0, 0)
+        if self.con.execute('select 1 from link where fromid=? and rowid>? limit 1',
+                            (url_id, tombstone[1])).fetchone() is not None:
+            return True
+        return self.con.execute('select 1 from wordlocation where urlid=? and rowid>? limit 1',
+                                (url_id, tombstone[0])).fetchone() is not None
+
+    # 从索引中删除一个网页
+    def delete_page(self, url):
+        """
+        删除网页的单词位置和外链，提交后查询立即不再返回该网页，url本身和指向它的链接保留
+        :param url: 网页url
+        :return: 网页是否存在
+        """
+        url_row = self.con.execute('select rowid from urllist where url=?', (url,)).fetchone()
+        if url_row is None:
+            return False
+        self.add_tombstone(url_row[0])
+        self.con.execute('delete from pagestate where urlid=?', (url_row[0],))
+        self.db_commit()
+        return True
+
+    # 用新的网页内容替换网页的索引和外链
+    def update_page(self, url, html, etag=None, modified=None):
+        """
+        原有的单词位置和外链由墓碑标记为失效，再写入新的，在一个事务内提交，出错时回滚，不会留下只替换了一部分的网页
+        没有建立过索引的网页不写墓碑，之后的合并和增量PageRank不受影响
+        :param url: 网页url
+        :param html: 新的网页内容
+        :param etag: 响应头ETag
+        :param modified: 响应头Last-Modified
         :return:
         """
-        for i in range(depth):
-            new_pages = set()
-            for page in pages:
+        digest = page_digest(html)
+        with self.timer('parse'):
+            soup = BeautifulSoup(html, 'lxml')
+        words = self.separte_words(self.get_text_only(soup))
+        page_links = self.get_page_links(url, soup)
+        try:
+            url_row = self.con.execute('select rowid from urllist where url=?', (url,)).fetchone()
+            if url_row is not None and self.has_live_rows(url_row[0]):
+                self.add_tombstone(url_row[0])
+            self.index_words(url, words)
+            self.add_page_links(url, page_links)
+            self.set_page_state(url, etag, modified, digest)
+            self.db_commit()
+        except:
+            self.db_rollback()
+            raise
+
+    def get_tombstone_count(self):
+        """
+        :return: 还没有合并的墓碑数
+        """
+        return self.con.execute('select count(*) from tombstone where compacted=0').fetchone()[0]
+
+    # 合并：物理删除墓碑标记失效的行
+    @timed('compact')
+    def compact(self):
+        """
+        删除墓碑标记失效的单词位置、链接和链接文字，并从linktextscore中减去失效链接的评价值，在一个事务内完成
+        每张表只顺序扫描一次，行的urlid在墓碑表的主键上查找，不需要wordlocation和link上的urlid索引
+        从没有导出过索引文件时清空墓碑表；否则已导出的索引文件中仍有这些网页，墓碑只标记为已合并，
+        Searcher继续据此跳过文件中的这些网页，直到export_index_file导出新文件后再清除
+        :return: 合并的墓碑数
+        """
+        count = self.get_tombstone_count()
+        if count == 0:
+            return 0
+        self.index_changed = True
+        dead_links = ('select rowid from link where fromid in (select urlid from tombstone) '
+                      'and rowid<=(select linkrow from tombstone where urlid=link.fromid)')
+        self.subtract_link_text(dead_links)
+        self.con.execute('delete from linkwords where linkid in (%s)' % dead_links)
+        self.con.execute('delete from link where rowid in (%s)' % dead_links)
+        self.con.execute('delete from wordlocation where urlid in (select urlid from tombstone) '
+                         'and rowid<=(select wordrow from tombstone where urlid=wordlocation.urlid)')
+        if self.get_info('export_generation') is None:
+            self.con.execute('delete from tombstone')
+        else:
+            self.con.execute('update tombstone set compacted=1')
+        self.db_commit()
+        return count
+
+    def subtract_link_text(self, dead_links):
+        """
+        从linktextscore中减去即将被删除的链接的评价值，只减去建表时已经存在的链接，之后新增的链接本来就没有计入
+        :param dead_links: 选出失效链接rowid的SQL语句
+        :return:
+        """
+        if self.con.execute("select count(*) from sqlite_master where type='table' and name='linktextscore'").fetchone()[0] == 0:
+            return
+        rows = self.con.execute('select sum(pagerank.score), linkwords.wordid, link.toid from linkwords, link, pagerank '
+                                'where linkwords.linkid=link.rowid and pagerank.urlid=link.fromid '
+                                'and link.rowid in (%s) and link.rowid<=coalesce(?, link.rowid) '
+                                'group by linkwords.wordid, link.toid' % dead_links,
+                                (self.get_info('linktext_linkrow'),)).fetchall()
+        self.con.executemany('update linktextscore set score=score-? where wordid=? and toid=?', rows)
+
+    # 重新抓取已经建立索引的网页，只更新发生了变化的网页
+    def recrawl(self, pages=None):
+        """
+        带上次记录的ETag和Last-Modified发送条件请求，服务器返回304时不下载网页；
+        下载后网页内容的散列值与上次相同时也不解析、不写索引，只更新变化了的响应头；
+        网页变化时由update_page替换该网页的单词位置和外链，其他网页的索引不受影响
+        外链中新出现的url不会被抓取，需要时再调用crawl；之后需要重新计算PageRank、导出索引文件
+        :param pages: 要重新抓取的url列表，默认为所有已经建立索引且没有被删除的网页
+        :return: {'unchanged': 没有变化的网页数, 'changed': 重新建立索引的网页数, 'failed': 下载失败的网页数}
+        """
+        self.generation = None  # 重新写入的链接属于新的一代，没有网页变化时不开始新的一代
+        if pages is None:
+            pages = [row[0] for row in self.con.execute(
+                'select url from urllist where rowid in (select urlid from wordlocation '
+                'where urlid not in (select urlid from tombstone) '
+                'or rowid>(select wordrow from tombstone where urlid=wordlocation.urlid))')]
+        counts = {'unchanged': 0, 'changed': 0, 'failed': 0}
+        for page in pages:
+            with self.record(page):
+                url_id = self.get_entry_id('urllist', 'url', page)
+                state = self.get_page_state(url_id) or (None, None, None)
                 try:
-                    url_response = urllib2.urlopen(page)
+                    with self.timer('fetch'):
+                        fetched = fetch_page(page, state[0], state[1])
                 except:
                     print 'Could not open %s' % page
+                    counts['failed'] += 1
                     continue
-                soup = BeautifulSoup(url_response.read(), 'lxml')
-                self.add_to_index(page, soup)
-
-                links = soup.find_all('a')  # 找到所有超链接标签
-                for link in links:
-                    if 'href' in dict(link.attrs):  # 获取link的属性字典
-                        url = urljoin(page, link['href'])  # 从相对路径获取绝对路径, page+相对路径地址
-                        if url.find("'") != -1:  # 存在不合法字符
-                            continue
-                        url = url.split('#')[0]  # 去掉位置部分
-                        if url[0:4] == 'http' and not self.is_indexed(url):
-                            new_pages.add(url)
-                        link_text = self.get_text_only(link)
-                        self.add_link_ref(page, url, link_text)
-                self.db_commit()
-            pages = new_pages
+                if fetched is None:  # 304
+                    counts['unchanged'] += 1
+                    continue
+                html, etag, modified = fetched
+                digest = page_digest(html)
+                if digest == state[2]:
+                    counts['unchanged'] += 1
+                    if (etag, modified) != state[0:2]:
+                        self.set_page_state(page, etag, modified, digest)
+                        self.db_commit()
+                    continue
+                self.update_page(page, html, etag, modified)
+                counts['changed'] += 1
+        return counts
+
+    # 从一小组网页开始进行广度优先搜索，直至某一给定深度
+    def crawl(self, pages, depth=CRAWLER_DEPTH, priority=None):
+        """
+        按深度从小到大依次取出frontier中待抓取的网页，针对每个网页调用add_to_index函数，添加索引。
+        利用BeautifulSoup抓取网页中的所有链接，没有出现过的链接以下一层的深度加入frontier，
+        网页的索引、外链和抓取状态在一个事务内提交，中断后再次调用会从上次提交处继续，除种子外不会重复抓取
+        :param pages:网页列表，作为深度0的网页加入frontier，已经抓取过或抓取失败的网页也重新抓取
+        :param depth:循环深度，只抓取深度小于depth的网页
+        :param priority:计算优先级的函数，参数为(url, 深度)，同一深度内优先级高的先抓取
+        :return:
+        """
+        self.start_generation()
+        frontier = Frontier(self.con)
+        frontier.add_seeds(pages, priority)
+        self.db_commit()
+        level = frontier.next_depth()
+        while level is not None and level < depth:
+            for page in frontier.pending(level):
+                with self.record(page):
+                    try:
+                        with self.timer('fetch'):
+                            html, etag, modified = fetch_page(page)
+                    except:
+                        print 'Could not open %s' % page
+                        frontier.mark(page, FAILED)
+                        self.db_commit()
+                        continue
+                    with self.timer('parse'):
+                        soup = BeautifulSoup(html, 'lxml')
+                    self.add_to_index(page, soup)
+                    self.set_page_state(page, etag, modified, page_digest(html))
+
+                    page_links = self.get_page_links(page, soup)
+                    frontier.add([url for (url, link_text) in page_links if url[0:4] == 'http'], level + 1, priority)
+                    self.add_page_links(page, page_links)
+                    frontier.mark(page, DONE)
+                    self.db_commit()  # 每个网页的所有写入在一个事务内提交
+            level = frontier.next_depth()
+
+    # 并发抓取，多个线程下载和解析网页，当前线程作为唯一的写入者建立索引
+    def crawl_concurrent(self, pages, depth=CRAWLER_DEPTH, fetchers=FETCHERS, per_host=PER_HOST,
+                         delay=DELAY, batch_pages=BATCH_PAGES, tokenizers=TOKENIZERS, priority=None):
+        """
+        与crawl相同的广度优先搜索，但网页的下载和解析由FetchPool中的线程并发完成，
+        解析结果通过队列交给当前线程，只有当前线程访问数据库，每batch_pages个网页提交一次事务
+        每一层的所有网页处理完之后才开始下一层，保证与crawl相同的深度语义，同样可以中断后继续
+        :param pages: 网页列表
+        :param depth: 循环深度
+        :param fetchers: 抓取线程数
+        :param per_host: 每个站点的并发请求数上限
+        :param delay: 同一站点相邻两次请求之间的最小间隔（秒）
+        :param batch_pages: 每提交一次事务写入的网页数
+        :param tokenizers: 分词进程数，为0时在抓取线程中分词
+        :param priority: 计算优先级的函数，参数为(url, 深度)，同一深度内优先级高的先提交下载
+        :return:
+        """
+        self.start_generation()
+        frontier = Frontier(self.con)
+        frontier.add_seeds(pages, priority)
+        if tokenizers > 0:  # 先创建进程池，再启动抓取线程
+            self.tokenize_pool = create_tokenize_pool(tokenizers)
+        pool = FetchPool(self.parse_page_digest, fetchers, per_host, delay)
+        uncommitted = 0
+        try:
+            level = frontier.next_depth()
+            while level is not None and level < depth:
+                pages = frontier.pending(level)
+                for page in pages:
+                    pool.submit(page)
+                for n in range(len(pages)):
+                    page, result = pool.get_result()
+                    if result is None:
+                        print 'Could not open %s' % page
+                        frontier.mark(page, FAILED)
+                        continue
+                    words, page_links, digest = result
+                    with self.record(page):  # 下载和解析在抓取线程中完成，解析耗时只计入parse_page阶段的累计值
+                        if not self.is_indexed(page):
+                            self.index_words(page, words)
+                        self.set_page_state(page, None, None, digest)  # FetchPool不返回响应头，只记录散列值
+                        frontier.add([url for (url, link_text) in page_links if url[0:4] == 'http'], level + 1,
+                                     priority)
+                        self.add_page_links(page, page_links)
+                        frontier.mark(page, DONE)
+                    uncommitted += 1
+                    if uncommitted >= batch_pages:
+                        self.db_commit()
+                        uncommitted = 0
+                level = frontier.next_depth()
+        finally:
+            self.db_commit()
+            pool.close()
+            if self.tokenize_pool is not None:
+                self.tokenize_pool.terminate()
+                self.tokenize_pool = None
 
     # 创建数据库表
     def create_index_tables(self):
@@ -203,55 +772,181 @@ class Crawler:
         为数据库的所有表建立schema，并建立一些只在加快搜索速度的索引
         :return:
         """
+        self.create_tables()
+        self.create_indexes()
+
+    def create_tables(self):
+        """
+        只建立表，离线批量建立索引时先写入数据，再调用create_indexes
+        :return:
+        """
         self.con.execute('create table urllist(url)')
         self.con.execute('create table wordlist(word)')
         self.con.execute('create table wordlocation(urlid, wordid, location)')
-        self.con.execute('create table link(fromid integer, toid integer)')
+        self.con.execute('create table link(fromid integer, toid integer, generation integer default 0)')
         self.con.execute('create table linkwords(wordid, linkid)')
+        self.con.execute('create table if not exists indexinfo(name primary key, value)')
+
+    def create_indexes(self):
+        """
+        建立加快搜索速度的索引
+        :return:
+        """
         self.con.execute('create index wordidx on wordlist(word)')
         self.con.execute('create index urlidx on urllist(url)')
         self.con.execute('create index wordurlidx on wordlocation(wordid)')
         self.con.execute('create index urltoidx on link(toid)')
         self.con.execute('create index urlfromidx on link(fromid)')
+        self.con.execute('create index linkgenidx on link(generation)')
 
-    def calculate_page_rank(self, iterations=ITERATIONS):
+    # 导出紧凑的倒排索引文件
+    def export_index_file(self, path):
+        """
+        把wordlocation表导出为可以用mmap直接读取的二进制索引文件，供Searcher(db_name, index_file=path)使用
+        导出前先合并，文件中不含失效的行，导出后清除墓碑；之后产生的墓碑使Searcher跳过文件中该网页的所有单词位置
+        同时记录导出时wordlocation的最大rowid，之后新建或更新的网页的单词位置由Searcher从数据库中补充读取，
+        重新导出之前查询结果与不使用索引文件时相同；Searcher在索引代数变化时发现文件被替换，会重新打开
+        :param path: 索引文件路径
+        :return: 单词数
+        """
+        self.compact()
+        self.db_commit()
+        word_row = self.con.execute('select max(rowid) from wordlocation').fetchone()[0] or 0
+        count = build_index_file(self.con, path)
+        self.con.execute('delete from tombstone where compacted=1')
+        self.set_info('export_wordrow', word_row)
+        self.index_changed = True  # 使Searcher重新打开索引文件
+        self.set_info('export_generation', self.get_info('index_generation', 0))
+        self.db_commit()
+        return count
+
+    # 建立保存评价值的表
+    def create_score_tables(self):
+        """
+        pagerank和linktextscore表不存在时建立，必须在写入评价值的事务开始之前调用
+        重新计算时不再drop table/create table：pysqlite在事务之外执行建表、删表语句时立即提交，
+        并发的只读Searcher会读到不存在或为空的表，因此表只建立一次，之后在一个事务中delete再insert
+        还没有计算过PageRank时所有链接源的PageRank值都为0，空表与没有表时的评价值相同
+        :return:
+        """
+        self.con.execute('create table if not exists pagerank(urlid primary key, score)')
+        self.con.execute('create table if not exists linktextscore(wordid, toid, score)')
+        self.con.execute('create index if not exists linktextidx on linktextscore(wordid)')
+
+    # 预先计算链接文字的评价值
+    def build_link_text_index(self):
+        """
+        重写linktextscore表：对每个单词和链接目标，累加链接文字中含有该单词的所有链接源的PageRank值，
+        使Searcher.link_text_score对每个查询单词只需要一次索引查询
+        依赖pagerank表，每次计算PageRank之后重写，由调用者与pagerank表一起提交，提交之前其他连接读到的是完整的旧表
+        :return:
+        """
+        self.con.execute('delete from linktextscore')
+        self.con.execute('insert into linktextscore(wordid, toid, score) '
+                         'select linkwords.wordid, link.toid, sum(pagerank.score) from linkwords, link, pagerank '
+                         'where linkwords.linkid=link.rowid and pagerank.urlid=link.fromid '
+                         'group by linkwords.wordid, link.toid')
+        self.set_info('linktext_linkrow', self.con.execute('select max(rowid) from link').fetchone()[0] or 0)
+        self.index_changed = True
+
+    @timed('calculate_page_rank')
+    def calculate_page_rank(self, iterations=ITERATIONS, tolerance=TOLERANCE,
+                            incremental=False, threshold=RESIDUAL_THRESHOLD):
         """
         预先为每个url计算PageRank值，并将结果存入数据表中，每次执行期间重新计算所有PageRank值
         最初将每个网页的PageRank值设置为1.0，然后遍历每个url，并针对每个外部回指链接，得到其PageRank值与链接总数
-        :param iterations: 迭代次数
+        计算由PageRank引擎完成：link表只读取一次，迭代在内存中的稀疏矩阵上进行，收敛后提前结束
+        增量模式下以pagerank表中的现有值为起点，只从上次计算之后新增了链接的网页向外传播变化，
+        没有可用的上次结果时退回到完整计算
+        计算前先合并，失效的链接不参与计算；合并删除了链接时增量更新无法反映减少的回指，
+        改为以上次的结果为初值完整迭代
+        pagerank表和linktextscore表在同一个事务中重写并提交
+        :param iterations: 最大迭代次数
+        :param tolerance: 收敛阈值，两次迭代之间PageRank值的L1距离小于该值时停止
+        :param incremental: 是否增量更新
+        :param threshold: 增量更新的残差阈值
         :return:
         """
-        # 清除当前的PageRank表
-        self.con.execute('drop table if exists pagerank')
-        self.con.execute('create table pagerank(urlid primary key, score)')
+        compacted = self.compact()
+        self.create_score_tables()
+        crawl_generation = self.get_info('crawl_generation', 0)
+        pagerank_generation = self.get_info('pagerank_generation')
 
-        # 初始化每个url，令其PageRank值为1
-        self.con.execute('insert into pagerank select rowid, 1.0 from urllist')
+        engine = PageRank(self.con)
+        engine.load_graph()
+        if incremental and pagerank_generation is not None and compacted:
+            engine.load_scores()
+            engine.iterate(iterations, tolerance)
+            engine.save()
+        elif incremental and pagerank_generation is not None:
+            new_rows = engine.load_scores()
+            changed = [row[0] for row in self.con.execute(
+                'select distinct fromid from link where generation>?', (pagerank_generation,))]
+            engine.update(changed, threshold, new_rows)
+            engine.save_changed()
+        else:
+            engine.iterate(iterations, tolerance)
+            engine.save()
+        self.build_link_text_index()
+        self.set_info('pagerank_generation', crawl_generation)
         self.db_commit()
-
-        for i in range(iterations):
-            print "Iteration %d" % i
-            for (url_id,) in self.con.execute('select rowid from urllist'):
-                pr = 0.15
-
-                # 循环遍历指向当前网页的所有网页
-                for (linker,) in self.con.execute('select distinct fromid from link where toid=%d' % url_id):
-                    # 得到链接源对应网页的PageRank值
-                    linking_pr = self.con.execute('select score from pagerank where urlid=%d' % linker).fetchone()[0]
-
-                    # 根据链接源，求得总的连接数
-                    linking_count = self.con.execute('select count(*) from link where fromid=%d' % linker).fetchone()[0]
-                    pr += 0.85*(linking_pr/linking_count)  # 回指链接的计算公式
-                self.con.execute('update pagerank set score=%f where urlid=%d' % (pr, url_id))
-            self.db_commit()
+        self.generation = None  # 之后新增的链接属于新的一代
 
 
 class Searcher:
-    def __init__(self, db_name):
-        self.con = sqlite.connect(db_name)
+    def __init__(self, db_name, index_file=None, cache_size=CACHE_SIZE, read_only=False, instrument=None):
+        """
+        :param db_name: 数据库名称
+        :param index_file: Crawler.export_index_file导出的索引文件，指定后单词和倒排列表从该文件中读取
+        :param cache_size: 缓存的查询结果数，为0时不缓存
+        :param read_only: 以只读方式打开数据库，连接可以由连接池交给其他线程使用（同一时间只能有一个线程使用）
+        :param instrument: instrument.Instrument对象，指定后统计每次查询各阶段的耗时和SQL语句数
+        """
+        self.instrument = instrument
+        if read_only:
+            self.con = sqlite.connect(db_name, check_same_thread=False)
+            self.con.execute('pragma query_only=1')
+        else:
+            self.con = sqlite.connect(db_name)
+        if instrument is not None:
+            self.con = InstrumentedConnection(self.con, instrument)
+        self.features = FeatureStore(self.con)  # PageRank值、回指链接数和url名称
+        self.cache = QueryCache(cache_size)
+        self.db_name = db_name
+        self.index_file_path = index_file
+        self.index_file = None
+        if index_file is not None:
+            self.index_file = IndexFile(index_file)
+            self.index_file_inode = os.fstat(self.index_file.file.fileno()).st_ino
+        self.prefix_index = None  # 自动补全使用的前缀索引，第一次调用suggest时建立
+        self.prefix_generation = None
+        self.deadline = None  # 查询期限（time.time()的值），超过后在Python中的计算循环里抛出QueryTimeout
 
     def __del__(self):
         self.con.close()
+        if self.index_file is not None:
+            self.index_file.close()
+
+    def refresh(self):
+        """
+        索引代数变化时重新加载网页特征；索引文件被重新导出（改名替换）时重新打开，
+        export_index_file在替换文件之后才清除墓碑并提交，因此不会用旧文件配上已清除的墓碑
+        :return:
+        """
+        if not self.features.refresh() or self.index_file is None:
+            return
+        if os.stat(self.index_file_path).st_ino != self.index_file_inode:
+            self.index_file.close()
+            self.index_file = IndexFile(self.index_file_path)
+            self.index_file_inode = os.fstat(self.index_file.file.fileno()).st_ino
+
+    def check_deadline(self):
+        """
+        超过查询期限时抛出QueryTimeout；con.interrupt只能中断SQL，读取倒排列表和计算特征的循环需要自己检查
+        :return:
+        """
+        if self.deadline is not None and time.time() > self.deadline:
+            raise QueryTimeout()
 
     def normalize_scores(self, scores, small_is_better=0):
         """
@@ -273,12 +968,14 @@ class Searcher:
             return dict([(u, float(c)/max_score)
                              for (u, c) in scores.items()])
 
+    @timed('get_match_rows')
     def get_match_rows(self, q):
         """
         查询函数，接受一个查询字符串，将其拆分成多个单词，构造SQL查询
         :param q:查询字符串
         :return:元祖(单词所在urlid(所有查询的单词出现在同一个url中), 单词1在网页的位置，单词2在网页的位置...), 单词所在位置id
         """
+        self.refresh()
         # 构造查询的字符串
         field_list = 'w0.urlid'
         table_list = ''
@@ -312,46 +1009,466 @@ class Searcher:
 
         return url_locations, word_ids
 
-    def get_scored_list(self, url_locations, word_ids):
+    def normalize_query(self, q):
         """
-        接受查询请求，将获取到的行集置于字典中，并以格式化列表的形式显示输出
-        :param url_locations:
-        :param word_ids:
-        :return:
+        将查询字符串按空白拆分，并转为小写（与建立索引时的分词一致）
+        :param q: 查询字符串
+        :return: 单词元组
         """
-        total_scores = dict([(row[0], 0) for row in url_locations])  # 键：单词所在url的id，值：0
+        return tuple([word.lower() for word in q.split()])
 
-        weights = [(1.0, self.frequency_score(url_locations)),
-                   (1.0, self.location_score(url_locations)),
-                   (1.0, self.page_rank_score(url_locations)),
-                   (1.0, self.link_text_score(url_locations, word_ids))]
-        for (weight, scores) in weights:
-            for url in total_scores:
-                total_scores[url] += weight*scores[url]
-        return total_scores
+    def get_word_ids(self, q):
+        """
+        将查询字符串拆分成单词，查询每个单词的ID，忽略不在索引中的单词
+        :param q: 查询字符串
+        :return: 单词id列表
+        """
+        word_ids = []
+        for word in self.normalize_query(q):
+            if self.index_file is not None:
+                word_id = self.index_file.find_word(word)
+                if word_id is not None:
+                    word_ids.append(word_id)
+                    continue
+                if not self.features.has_unexported_rows():  # 导出之后新增的单词不在文件中
+                    continue
+            word_row = self.con.execute('select rowid from wordlist where word=?', (word,)).fetchone()
+            if word_row is not None:
+                word_ids.append(word_row[0])
+        return word_ids
+
+    def get_word_id_map(self, words):
+        """
+        一次查询多个单词的ID
+        :param words: 单词列表
+        :return: {单词: 单词id}，不包含不在索引中的单词
+        """
+        word_ids = {}
+        words = list(words)
+        if self.index_file is not None:
+            for word in words:
+                word_id = self.index_file.find_word(word)
+                if word_id is not None:
+                    word_ids[word] = word_id
+            if not self.features.has_unexported_rows():
+                return word_ids
+            words = [word for word in words if word not in word_ids]
+        for start in range(0, len(words), BATCH_SIZE):
+            chunk = words[start:start + BATCH_SIZE]
+            word_ids.update(self.con.execute('select word, rowid from wordlist where word in (%s)'
+                                             % ','.join(['?'] * len(chunk)), chunk))
+        return word_ids
+
+    def get_postings(self, word_id):
+        """
+        读取单词的倒排列表，按urlid排序
+        使用索引文件时，导出之后新建或更新的网页的单词位置不在文件中，从数据库中读取后合并
+        :param word_id: 单词id
+        :return: (urlid列表, 与之对应的单词位置列表的列表)
+        """
+        if self.index_file is None:
+            return self.get_table_postings(word_id)
+        url_ids, locations = self.index_file.get_postings(word_id)
+        tombstones = self.features.tombstones
+        if tombstones:
+            # 导出索引文件前已经合并并清除了墓碑，现有的墓碑都是导出之后产生的，文件中这些网页的所有行都已失效
+            kept = [n for n in range(len(url_ids)) if url_ids[n] not in tombstones]
+            url_ids, locations = [url_ids[n] for n in kept], [locations[n] for n in kept]
+        if self.features.has_unexported_rows():
+            new_url_ids, new_locations = self.get_table_postings(word_id, self.features.export_row)
+            for n in range(len(new_url_ids)):
+                pos = bisect_left(url_ids, new_url_ids[n])
+                if pos < len(url_ids) and url_ids[pos] == new_url_ids[n]:
+                    locations[pos] = sorted(locations[pos] + new_locations[n])
+                else:
+                    url_ids.insert(pos, new_url_ids[n])
+                    locations.insert(pos, new_locations[n])
+        return url_ids, locations
+
+    def get_table_postings(self, word_id, min_row=0):
+        """
+        从wordlocation表读取单词的倒排列表，跳过墓碑标记失效的行
+        :param word_id: 单词id
+        :param min_row: 只读取rowid大于该值的行，wordurlidx索引中含有rowid，按范围查找
+        :return: 与get_postings相同
+        """
+        tombstones = self.features.tombstones
+        cur = self.con.execute('select urlid, location, rowid from wordlocation where wordid=? and rowid>? '
+                               'order by urlid, location', (word_id, min_row))
+        url_ids = []
+        locations = []
+        try:
+            for (url_id, rows) in groupby(cur, lambda row: row[0]):
+                if len(url_ids) % DEADLINE_CHECK == 0:
+                    self.check_deadline()
+                if url_id in tombstones:  # 跳过被删除或更新前的行
+                    word_row = tombstones[url_id][0]
+                    url_locations = [row[1] for row in rows if row[2] > word_row]
+                    if not url_locations:
+                        continue
+                else:
+                    url_locations = [row[1] for row in rows]
+                url_ids.append(url_id)
+                locations.append(url_locations)
+        finally:
+            cur.close()  # 超时提前退出时也结束语句，连接不会停留在读事务中
+        return url_ids, locations
+
+    def intersect_postings(self, postings):
+        """
+        求多个倒排列表的交集，以最短的列表为基准，在其他列表中用galloping（指数步长+二分）查找
+        :param postings: get_postings的返回值列表
+        :return: [(urlid, [单词1的位置列表, 单词2的位置列表, ...]), ...]
+        """
+        order = sorted(range(len(postings)), key=lambda k: len(postings[k][0]))
+        shortest = postings[order[0]][0]
+        cursors = [0] * len(postings)
+        matched = []
+        for i in range(len(shortest)):
+            url_id = shortest[i]
+            cursors[order[0]] = i
+            found = True
+            for k in order[1:]:
+                url_ids = postings[k][0]
+                lo = cursors[k]
+                step = 1
+                while lo + step < len(url_ids) and url_ids[lo + step] < url_id:
+                    step *= 2
+                pos = bisect_left(url_ids, url_id, lo, min(lo + step + 1, len(url_ids)))
+                cursors[k] = pos
+                if pos == len(url_ids) or url_ids[pos] != url_id:
+                    found = False
+                    break
+            if found:
+                matched.append((url_id, [postings[k][1][cursors[k]] for k in range(len(postings))]))
+        return matched
+
+    def min_distance(self, location_lists):
+        """
+        计算各单词依次出现的位置之间距离之和的最小值，即distance_score中对所有位置组合求的最小值
+        逐个单词递推：到达单词k的位置p的最小距离为 min(best(p') + |p - p'|)，p'为单词k-1的位置，
+        因为位置有序，分别从左向右、从右向左扫描一遍即可求出，不需要枚举位置组合
+        :param location_lists: 各单词的位置列表（有序）
+        :return: 最小距离
+        """
+        previous = location_lists[0]
+        best = [0] * len(previous)
+        for locations in location_lists[1:]:
+            current = [0] * len(locations)
+            j = 0
+            left_best = None  # min(best(p') - p')，p' <= p
+            for i in range(len(locations)):
+                while j < len(previous) and previous[j] <= locations[i]:
+                    if left_best is None or best[j] - previous[j] < left_best:
+                        left_best = best[j] - previous[j]
+                    j += 1
+                current[i] = left_best + locations[i] if left_best is not None else None
+            j = len(previous) - 1
+            right_best = None  # min(best(p') + p')，p' >= p
+            for i in range(len(locations) - 1, -1, -1):
+                while j >= 0 and previous[j] >= locations[i]:
+                    if right_best is None or best[j] + previous[j] < right_best:
+                        right_best = best[j] + previous[j]
+                    j -= 1
+                if right_best is not None and (current[i] is None or right_best - locations[i] < current[i]):
+                    current[i] = right_best - locations[i]
+            previous = locations
+            best = current
+        return min(best)
 
+    @timed('get_matches')
+    def get_matches(self, q):
+        """
+        get_match_rows的倒排列表版本：读取每个单词按urlid排序的倒排列表并求交集，
+        直接计算每个url的特征值，不生成所有位置组合的行集
+        :param q: 查询字符串
+        :return: (Candidates, 单词id列表)
+        """
+        self.refresh()
+        word_ids = self.get_word_ids(q)
+        return self.match_postings([self.get_postings(word_id) for word_id in word_ids]), word_ids
+
+    def match_postings(self, postings):
+        """
+        求倒排列表的交集，并计算每个url的特征值
+        :param postings: 各查询单词的倒排列表
+        :return: Candidates，特征为频度、最小位置之和与最小距离
+        """
+        url_ids = []
+        frequencies = []
+        location_sums = []
+        distances = []
+        if postings:
+            for (url_id, location_lists) in self.intersect_postings(postings):
+                if len(url_ids) % DEADLINE_CHECK == 0:
+                    self.check_deadline()
+                frequency = 1
+                for locations in location_lists:
+                    frequency *= len(locations)  # 与行集的行数相同
+                url_ids.append(url_id)
+                frequencies.append(frequency)
+                location_sums.append(sum([locations[0] for locations in location_lists]))
+                distances.append(self.min_distance(location_lists))
+        return Candidates(url_ids, frequencies, location_sums, distances, self.features)
+
+    @timed('get_scored_matches')
+    def get_scored_matches(self, candidates, word_ids, weights=None):
+        """
+        与get_scored_list相同的评价，但使用get_matches计算好的特征值
+        :param candidates: get_matches返回的Candidates
+        :param word_ids: 单词id列表
+        :param weights: 各特征的权重，默认为DEFAULT_WEIGHTS
+        :return: {urlid: 评价值}
+        """
+        if weights is None:
+            weights = DEFAULT_WEIGHTS
+        if not len(candidates):
+            return {}
+        if weights.get('link_text'):
+            self.add_link_text(candidates, word_ids)
+        scores = candidates.score(candidates.get_bounds(weights), weights)
+        return dict(zip(candidates.url_ids.tolist(), scores.tolist()))
+
+    @timed('get_scored_list')
+    def get_scored_list(self, url_locations, word_ids, weights=None):
+        """
+        接受查询请求，由行集计算各网页的特征列，归一化后按权重求和，都是向量运算
+        :param url_locations: get_match_rows返回的行集
+        :param word_ids: 单词id列表
+        :param weights: 各特征的权重，默认为DEFAULT_WEIGHTS，
+                        distance和inbound分别对应distance_score和inbound_link_score
+        :return: {urlid: 评价值}
+        """
+        if not url_locations:
+            return {}
+        return self.get_scored_matches(Candidates.from_rows(url_locations, self.features), word_ids, weights)
+
+    @timed('get_url_name')
     def get_url_name(self, id):
         """
         通过url的id查询url的名称
         :param id:url的id
         :return:url 名称
         """
-        return self.con.execute(
-            "select url from urllist where rowid=%d" % id
-        ).fetchone()[0]
+        return self.features.get_url(id)
 
+    @recorded('query')
     def query(self, q):
         """
         查询多字符
         :param q:待查询字符串
         :return:查询结果，评分 url
         """
-        url_locations, word_ids = self.get_match_rows(q)  # 获得单词的位置和url 查询结果
-        scores = self.get_scored_list(url_locations, word_ids)
-        ranked_scores = sorted([(score, url_id) for (url_id, score) in scores.items()], reverse=1)
-        for (score, url_id) in ranked_scores[0:10]:
+        for (score, url_id) in self.top_k(q):
             print '%f\t%s' % (score, self.get_url_name(url_id))
 
+    def query_many(self, queries, k=TOP_K):
+        """
+        批量查询，依次输出每个查询的结果
+        :param queries: 查询字符串列表
+        :param k: 每个查询的结果数
+        :return:
+        """
+        for (q, results) in zip(queries, self.top_k_many(queries, k)):
+            print q
+            for (score, url_id) in results:
+                print '%f\t%s' % (score, self.get_url_name(url_id))
+
+    def suggest(self, q, n=SUGGESTIONS):
+        """
+        输入时的自动补全，索引代数变化后先增量更新前缀索引
+        :param q: 用户正在输入的查询字符串
+        :param n: 建议数
+        :return: PrefixIndex.suggest的返回值
+        """
+        generation = self.features.get_generation()
+        if self.prefix_index is None:
+            self.prefix_index = PrefixIndex(self.con)
+        elif generation != self.prefix_generation:
+            self.prefix_index.update(self.con)
+        self.prefix_generation = generation
+        return self.prefix_index.suggest(q, n)
+
+    def cache_stats(self):
+        """
+        :return: 查询结果缓存的命中次数、未命中次数等
+        """
+        return self.cache.stats()
+
+    def get_stats(self):
+        """
+        :return: Instrument.stats()的返回值，没有启用统计时返回None
+        """
+        if self.instrument is None:
+            return None
+        return self.instrument.stats()
+
+    def get_page_rank(self, url_id):
+        return self.features.get_page_rank(url_id)
+
+    @recorded('query')
+    def top_k(self, q, k=TOP_K, weights=None):
+        """
+        返回评价值最高的k个结果
+        候选网页的各特征保存为按urlid对齐的NumPy列，归一化、按权重求和和选出前k名都是向量运算
+        结果按 (单词, k, 权重) 缓存，索引代数变化时缓存失效
+        :param q: 查询字符串
+        :param k: 结果数
+        :param weights: 各特征的权重，默认为DEFAULT_WEIGHTS
+        :return: 按评价值从高到低排列的 [(评价值, urlid), ...]
+        """
+        if weights is None:
+            weights = DEFAULT_WEIGHTS
+        key = (self.normalize_query(q), k, tuple(sorted(weights.items())))
+        generation = self.features.get_generation()
+        result = self.cache.get(key, generation)
+        if result is None:
+            result = self.rank_top_k(q, k, weights)
+            self.cache.put(key, self.features.get_generation(), result)
+        return list(result)
+
+    def rank_top_k(self, q, k, weights):
+        """
+        不经过缓存，计算top_k的结果
+        """
+        candidates = self.get_candidates(q, weights)
+        if not len(candidates) or k <= 0:
+            return []
+        self.check_deadline()
+        return self.rank_candidates(candidates, self.get_bounds(candidates, weights), k, weights)
+
+    @timed('top_k_many')
+    def top_k_many(self, queries, k=TOP_K, weights=None, workers=0):
+        """
+        批量执行top_k，结果与逐个调用top_k相同，同样经过查询缓存
+        相同的查询只计算一次；所有查询的单词一次查询ID，每个单词的倒排列表和链接文字只读取一次，由各查询共用
+        :param queries: 查询字符串列表
+        :param k: 结果数
+        :param weights: 各特征的权重，默认为DEFAULT_WEIGHTS
+        :param workers: 并行计算的进程数，为0时在当前进程中计算，否则把查询分成workers组，每组由一个进程批量计算
+        :return: 与queries一一对应的 [(评价值, urlid), ...] 列表
+        """
+        if weights is None:
+            weights = DEFAULT_WEIGHTS
+        weight_key = tuple(sorted(weights.items()))
+        self.refresh()
+        generation = self.features.get_generation()
+        keys = [(self.normalize_query(q), k, weight_key) for q in queries]
+        results = {}  # 键 -> 结果
+        missing = []  # 需要计算的不同的键
+        for key in keys:
+            if key in results:
+                continue
+            results[key] = self.cache.get(key, generation)
+            if results[key] is None:
+                missing.append(key)
+
+        if workers > 0 and len(missing) > 1:
+            size = (len(missing) + workers - 1) // workers
+            chunks = [missing[start:start + size] for start in range(0, len(missing), size)]
+            pool = Pool(len(chunks), initializer=init_batch_worker, initargs=(self.db_name, self.index_file_path))
+            try:
+                ranked = pool.map(batch_worker_top_k, [([key[0] for key in chunk], k, weights) for chunk in chunks])
+            finally:
+                pool.terminate()
+            computed = [result for chunk_results in ranked for result in chunk_results]
+        else:
+            computed = self.rank_many([key[0] for key in missing], k, weights)
+        generation = self.features.get_generation()
+        for n in range(len(missing)):
+            results[missing[n]] = computed[n]
+            self.cache.put(missing[n], generation, computed[n])
+        return [list(results[key]) for key in keys]
+
+    def rank_many(self, word_lists, k, weights):
+        """
+        不经过缓存，批量计算多个查询的结果
+        :param word_lists: 每个查询normalize_query后的单词元组
+        :param k: 结果数
+        :param weights: 各特征的权重
+        :return: 与之对应的 [(评价值, urlid), ...] 列表
+        """
+        word_id_map = self.get_word_id_map(set([word for words in word_lists for word in words]))
+        word_id_lists = [[word_id_map[word] for word in words if word in word_id_map] for words in word_lists]
+        remaining = {}  # 单词id -> 还要用到它的查询数，减到0时释放它的倒排列表和链接文字
+        for word_ids in word_id_lists:
+            for word_id in set(word_ids):
+                remaining[word_id] = remaining.get(word_id, 0) + 1
+        postings = {}  # 单词id -> 倒排列表
+        link_text_rows = {}  # 单词id -> 链接文字
+        results = []
+        for word_ids in word_id_lists:
+            self.check_deadline()
+            for word_id in word_ids:
+                if word_id not in postings:
+                    postings[word_id] = self.get_postings(word_id)
+            candidates = self.match_postings([postings[word_id] for word_id in word_ids])
+            if not len(candidates) or k <= 0:
+                results.append([])
+            else:
+                if weights.get('link_text'):
+                    for word_id in word_ids:
+                        if word_id not in link_text_rows:
+                            link_text_rows[word_id] = self.get_link_text_rows(word_id)
+                    self.add_link_text(candidates, word_ids, link_text_rows)
+                results.append(self.rank_candidates(candidates, self.get_bounds(candidates, weights), k, weights))
+            for word_id in set(word_ids):
+                remaining[word_id] -= 1
+                if remaining[word_id] == 0:
+                    postings.pop(word_id, None)
+                    link_text_rows.pop(word_id, None)
+        return results
+
+    def get_candidates(self, q, weights):
+        """
+        求交集得到候选网页及其频度、位置和距离，并累加链接文字的评价值
+        :param q: 查询字符串
+        :param weights: 各特征的权重
+        :return: Candidates
+        """
+        candidates, word_ids = self.get_matches(q)
+        if len(candidates) and weights.get('link_text'):
+            self.add_link_text(candidates, word_ids)
+        return candidates
+
+    @timed('add_link_text')
+    def add_link_text(self, candidates, word_ids, link_text_rows=None):
+        """
+        对每个候选网页，累加链接文字中含有查询单词的所有回指链接源的PageRank值
+        :param candidates: Candidates
+        :param word_ids: 单词ID列表
+        :param link_text_rows: 已经读取的 {单词id: get_link_text_rows的返回值}，批量查询时多个查询共用
+        :return:
+        """
+        for word_id in word_ids:
+            if link_text_rows is not None:
+                candidates.add_link_text(link_text_rows[word_id])
+            else:
+                candidates.add_link_text(self.get_link_text_rows(word_id))
+
+    @timed('get_bounds')
+    def get_bounds(self, candidates, weights):
+        """
+        归一化所需的各特征在候选网页中的最值，分片查询时先用merge_bounds合并各分片的最值，再用于排名
+        :param candidates: Candidates
+        :param weights: 各特征的权重
+        :return: {特征: 最值}，位置和距离取最小值，其他特征取最大值
+        """
+        return candidates.get_bounds(weights)
+
+    @timed('rank_candidates')
+    def rank_candidates(self, candidates, bounds, k, weights):
+        """
+        用给定的最值归一化各特征，选出评价值最高的k个候选网页
+        :param candidates: Candidates
+        :param bounds: get_bounds或merge_bounds的返回值
+        :param k: 结果数
+        :param weights: 各特征的权重
+        :return: 按评价值从高到低排列的 [(评价值, urlid), ...]
+        """
+        return candidates.top_k(candidates.score(bounds, weights), k)
+
+    @timed('frequency_score')
     def frequency_score(self, rows):
         """
         单词频度度量函数，根据查询条件中的单词在网页中出现的次数对网页进行评价
@@ -363,6 +1480,7 @@ class Searcher:
             counts[row[0]] += 1
         return self.normalize_scores(counts)
 
+    @timed('location_score')
     def location_score(self, rows):
         """
         文档位置度量函数，搜索单词在网页中的出现位置
@@ -378,6 +1496,7 @@ class Searcher:
                 locations[row[0]] = loc
         return self.normalize_scores(locations, small_is_better=1)
 
+    @timed('distance_score')
     def distance_score(self, rows):
         """
         单词距离度量函数
@@ -397,6 +1516,7 @@ class Searcher:
                 min_distance[row[0]] = dist
             return self.normalize_scores(min_distance, small_is_better=1)
 
+    @timed('inbound_link_score')
     def inbound_link_score(self, rows):
         """
         简单计数，处理外部回指链接
@@ -404,23 +1524,22 @@ class Searcher:
         :return: 归一化处理后的评价结果，外部回指链接数
         """
         unique_urls = set([row[0] for row in rows])
-        inbound_count = dict([(u, self.con.execute(
-            'select count(*) from link where toid=%d' % u
-        ).fetchone()[0]) for u in unique_urls])
+        inbound_count = dict([(u, self.features.get_inbound(u)) for u in unique_urls])
         return self.normalize_scores(inbound_count)
 
+    @timed('page_rank_score')
     def page_rank_score(self, rows):
         """
         PageRank评价函数
         :param rows:
         :return:
         """
-        page_ranks = dict([(row[0], self.con.execute('select score from pagerank where urlid=%d' % row[0]).fetchone()[0])
-                           for row in rows])
-        max_rank = max(page_ranks.values())
-        normalized_scores = dict([(u, float(1)/max_rank) for (u, l) in page_ranks.items()])  # 归一化处理
+        page_ranks = dict([(u, self.features.get_page_rank(u)) for u in set([row[0] for row in rows])])
+        max_rank = max(max(page_ranks.values()), 0.00001)  # 刚抓取、还没有计算PageRank时全部为0
+        normalized_scores = dict([(u, float(l)/max_rank) for (u, l) in page_ranks.items()])  # 归一化处理
         return normalized_scores
 
+    @timed('link_text_score')
     def link_text_score(self, rows, word_ids):
         """
         利用链接文本排名
@@ -431,22 +1550,62 @@ class Searcher:
         :return:
         """
         link_scores = dict([(row[0], 0.00001) for row in rows])
-        for word_id in word_ids:
-            cur = self.con.execute('select link.fromid, link.toid from linkwords,link '
-                                   'where wordid=%d and linkwords.linkid=link.rowid' % word_id)
-            for (from_id, to_id) in cur:
-                if to_id in link_scores:
-                    pr = self.con.execute('select score from pagerank where urlid=%d' % from_id).fetchone()[0]
-                    link_scores[to_id] += pr
+        for (to_id, score) in self.get_link_text_totals(word_ids, link_scores).items():
+            link_scores[to_id] += score
         max_score = max(link_scores.values())
-        normalized_scores = dict([(u, float(1)/max_score) for (u, l) in link_scores.items()])
+        normalized_scores = dict([(u, float(l)/max_score) for (u, l) in link_scores.items()])
         return normalized_scores
 
+    @timed('get_link_text_totals')
+    def get_link_text_totals(self, word_ids, url_ids, link_text_rows=None):
+        """
+        对url_ids中的每个网页，累加链接文字中含有查询单词的所有回指链接源的PageRank值
+        :param word_ids: 单词ID列表
+        :param url_ids: 候选网页id的集合或字典
+        :param link_text_rows: 已经读取的 {单词id: get_link_text_rows的返回值}，批量查询时多个查询共用
+        :return: {urlid: PageRank值之和}，只包含有这类回指链接的网页
+        """
+        totals = {}
+        for word_id in word_ids:
+            if link_text_rows is not None:
+                rows = link_text_rows[word_id]
+            else:
+                rows = self.get_link_text_rows(word_id)
+            for (to_id, score) in rows:
+                if to_id in url_ids:
+                    totals[to_id] = totals.get(to_id, 0) + score
+        return totals
+
+    def get_link_text_rows(self, word_id):
+        """
+        链接文字中含有该单词的所有链接
+        linktextscore表在计算PageRank时重建，其中含有之后被删除或更新的网页的链接，
+        合并时会从表中减去；还没有合并时读取这些失效的链接，以负的评价值抵消
+        :param word_id: 单词ID
+        :return: [(链接目标urlid, 链接源的PageRank值), ...]，有linktextscore表时同一目标的链接已经合并
+        """
+        tombstones = self.features.tombstones
+        if self.features.link_text_index:  # 使用预先计算的linktextscore表
+            rows = self.con.execute('select toid, score from linktextscore where wordid=?', (word_id,)).fetchall()
+            if not self.features.uncompacted:
+                return rows
+            link_text_row = self.features.link_text_row
+            cur = self.con.execute('select link.fromid, link.toid, link.rowid from linkwords,link '
+                                   'where wordid=? and linkwords.linkid=link.rowid '
+                                   'and link.fromid in (select urlid from tombstone)', (word_id,))
+            return rows + [(to_id, -self.features.get_page_rank(from_id)) for (from_id, to_id, link_id) in cur
+                           if from_id in tombstones and link_id <= tombstones[from_id][1] and (link_text_row is None or link_id <= link_text_row)]
+        cur = self.con.execute('select link.fromid, link.toid, link.rowid from linkwords,link '
+                               'where wordid=%d and linkwords.linkid=link.rowid' % word_id)
+        return [(to_id, self.features.get_page_rank(from_id)) for (from_id, to_id, link_id) in cur
+                if from_id not in tombstones or link_id > tombstones[from_id][1]]
+
 # crawler_obj = Crawler('search_index.db')
 # crawler_obj.create_index_tables()  # 首次运行程序，创建数据库表
 # page_list = ['http://www.csdn.net']
 # crawler_obj.crawl(page_list)  # 首次运行程序，抓取page_list中的网页
 # crawler_obj.calculate_page_rank()  # 计算PageRank，只有在更新索引的时候才需要运行该函数
 
-search_obj = Searcher('search_index.db')
-search_obj.query('python')
+if __name__ == '__main__':
+    search_obj = Searcher('search_index.db')
+    search_obj.query('python')
@@ -0,0 +1,248 @@
+# coding: utf-8
+# author: luyf
+# create date: 2016.12.12
+
+import json
+import sys
+import threading
+import time
+import BaseHTTPServer
+import SocketServer
+from Queue import Queue, Empty
+from urlparse import urlparse, parse_qs
+
+from pysqlite2 import dbapi2 as sqlite
+from searchengine import Searcher, QueryTimeout, TOP_K
+from suggest import PrefixIndex, SUGGESTIONS
+
+
+CONNECTIONS = 8  # 只读连接数，即同时执行的查询数
+MAX_PENDING = 256  # 正在执行和等待执行的查询数上限，超过时直接拒绝
+TIMEOUT = 2.0  # 查询超时（秒），包括等待空闲连接的时间
+MAX_K = 100  # 一次查询最多返回的结果数
+
+
+class ServiceOverloaded(Exception):
+    pass
+
+
+class SearchTimeout(Exception):
+    pass
+
+
+class SearchService:
+    """
+    可以被多个线程同时调用的查询服务
+    持有一组只读的Searcher，每个Searcher有自己的数据库连接，查询时取出一个空闲的Searcher，用完放回。
+    数据库使用WAL模式，Crawler写入数据的同时可以继续查询
+    """
+    def __init__(self, db_name, connections=CONNECTIONS, max_pending=MAX_PENDING, timeout=TIMEOUT, index_file=None):
+        con = sqlite.connect(db_name, isolation_level=None)  # 不能在事务中切换日志模式
+        con.execute('pragma journal_mode=wal')  # WAL模式会保存在数据库文件中，之后所有连接都使用WAL
+        con.close()
+
+        self.max_pending = max_pending
+        self.timeout = timeout
+        self.idle = Queue()
+        for i in range(connections):
+            self.idle.put(Searcher(db_name, index_file=index_file, read_only=True))
+        self.lock = threading.Lock()
+        self.pending = 0
+        self.served = 0
+        self.rejected = 0
+        self.timed_out = 0
+        self.prefix_index = None  # 所有连接共用的前缀索引
+        self.prefix_generation = None
+        self.prefix_lock = threading.Lock()
+
+    def search(self, q, k=TOP_K):
+        """
+        执行查询
+        正在执行和等待的查询数达到上限时抛出ServiceOverloaded，
+        超时后中断正在执行的SQL并抛出SearchTimeout；Python中的计算由Searcher.deadline限制
+        timer只在本次查询结束之前中断连接，已经触发但还没有执行到中断的timer不会中断之后使用这个连接的查询
+        :param q: 查询字符串
+        :param k: 结果数
+        :return: [(评价值, url), ...]
+        """
+        with self.lock:
+            if self.pending >= self.max_pending:
+                self.rejected += 1
+                raise ServiceOverloaded()
+            self.pending += 1
+        try:
+            deadline = time.time() + self.timeout
+            try:
+                searcher = self.idle.get(timeout=self.timeout)
+            except Empty:
+                self.count_timeout()
+                raise SearchTimeout()
+            running = [True]  # 本次查询是否还在执行，在interrupt_lock中读写
+            interrupt_lock = threading.Lock()
+
+            def interrupt():
+                with interrupt_lock:
+                    if running[0]:
+                        searcher.con.interrupt()
+
+            timer = threading.Timer(max(deadline - time.time(), 0), interrupt)
+            timer.start()
+            searcher.deadline = deadline
+            try:
+                results = [(score, searcher.get_url_name(url_id)) for (score, url_id) in searcher.top_k(q, k)]
+            except QueryTimeout:
+                self.count_timeout()
+                raise SearchTimeout()
+            except sqlite.OperationalError:
+                if time.time() >= deadline:  # 被timer中断
+                    self.count_timeout()
+                    raise SearchTimeout()
+                raise
+            finally:
+                with interrupt_lock:
+                    running[0] = False
+                timer.cancel()
+                searcher.deadline = None
+                self.idle.put(searcher)
+            with self.lock:
+                self.served += 1
+            return results
+        finally:
+            with self.lock:
+                self.pending -= 1
+
+    def suggest(self, q, n=SUGGESTIONS):
+        """
+        输入时的自动补全，所有连接共用一个前缀索引，索引代数变化后借用一个空闲连接增量更新
+        :param q: 用户正在输入的查询字符串
+        :param n: 建议数
+        :return: [(建议的查询字符串, 文档频率), ...]
+        """
+        try:
+            searcher = self.idle.get(timeout=self.timeout)
+        except Empty:
+            self.count_timeout()
+            raise SearchTimeout()
+        try:
+            generation = searcher.features.get_generation()
+            with self.prefix_lock:
+                if self.prefix_index is None:
+                    self.prefix_index = PrefixIndex(searcher.con)
+                elif generation != self.prefix_generation:
+                    self.prefix_index.update(searcher.con)
+                self.prefix_generation = generation
+        finally:
+            self.idle.put(searcher)
+        return self.prefix_index.suggest(q, n)
+
+    def count_timeout(self):
+        with self.lock:
+            self.timed_out += 1
+
+    def stats(self):
+        """
+        :return: 查询服务的运行情况
+        """
+        with self.lock:
+            return {'pending': self.pending, 'idle_connections': self.idle.qsize(), 'served': self.served,
+                    'rejected': self.rejected, 'timed_out': self.timed_out}
+
+
+class SearchHandler(BaseHTTPServer.BaseHTTPRequestHandler):
+    """
+    GET /search?q=查询字符串&k=结果数  返回JSON格式的查询结果
+    GET /suggest?q=输入的字符串&n=建议数 返回自动补全的建议
+    GET /stats                      返回查询服务的运行情况
+    """
+    def do_GET(self):
+        url = urlparse(self.path)
+        params = parse_qs(url.query)
+        if url.path == '/stats':
+            self.send_json(200, self.server.service.stats())
+            return
+        if url.path == '/suggest':
+            self.do_suggest(params)
+            return
+        if url.path != '/search':
+            self.send_json(404, {'error': 'not found'})
+            return
+
+        q = self.get_query(params)
+        if q is None:
+            return
+        try:
+            k = min(int(params.get('k', [TOP_K])[0]), MAX_K)
+        except ValueError:
+            self.send_json(400, {'error': 'k must be an integer'})
+            return
+        start = time.time()
+        try:
+            results = self.server.service.search(q, k)
+        except ServiceOverloaded:
+            self.send_json(503, {'error': 'overloaded'})
+            return
+        except SearchTimeout:
+            self.send_json(504, {'error': 'timeout'})
+            return
+        self.send_json(200, {'query': q, 'elapsed_ms': (time.time() - start) * 1000,
+                             'results': [{'score': score, 'url': url} for (score, url) in results]})
+
+    def do_suggest(self, params):
+        q = self.get_query(params)
+        if q is None:
+            return
+        try:
+            n = min(int(params.get('n', [SUGGESTIONS])[0]), MAX_K)
+        except ValueError:
+            self.send_json(400, {'error': 'n must be an integer'})
+            return
+        try:
+            suggestions = self.server.service.suggest(q, n)
+        except SearchTimeout:
+            self.send_json(504, {'error': 'timeout'})
+            return
+        self.send_json(200, {'query': q, 'suggestions': [{'query': s, 'frequency': count}
+                                                         for (s, count) in suggestions]})
+
+    def get_query(self, params):
+        """
+        :return: 解码后的查询字符串，不是合法的UTF-8时返回400并返回None
+        """
+        try:
+            return params.get('q', [''])[0].decode('utf-8')
+        except UnicodeDecodeError:
+            self.send_json(400, {'error': 'q must be UTF-8'})
+            return None
+
+    def send_json(self, status, data):
+        body = json.dumps(data)
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json; charset=utf-8')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        pass
+
+
+class SearchServer(SocketServer.ThreadingMixIn, BaseHTTPServer.HTTPServer):
+    """
+    每个请求一个线程的HTTP服务，实际执行查询的数量由SearchService的连接数限制
+    """
+    daemon_threads = True
+    request_queue_size = 512  # 允许排队的TCP连接数
+
+    def __init__(self, address, service):
+        BaseHTTPServer.HTTPServer.__init__(self, address, SearchHandler)
+        self.service = service
+
+
+def serve(db_name, host='127.0.0.1', port=8000, connections=CONNECTIONS, max_pending=MAX_PENDING, timeout=TIMEOUT):
+    server = SearchServer((host, port), SearchService(db_name, connections, max_pending, timeout))
+    print 'Serving %s on http://%s:%d/search?q=' % (db_name, host, port)
+    server.serve_forever()
+
+
+if __name__ == '__main__':
+    serve(sys.argv[1] if len(sys.argv) > 1 else 'search_index.db')
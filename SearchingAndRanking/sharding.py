@@ -0,0 +1,289 @@
+# coding: utf-8
+# author: luyf
+# create date: 2016.12.11
+
+import os
+import zlib
+from multiprocessing import Process, Queue, Pipe
+
+from pysqlite2 import dbapi2 as sqlite
+from searchengine import Crawler, Searcher, merge_bounds, CRAWLER_DEPTH, ITERATIONS, BATCH_PAGES, TOP_K, \
+    DEFAULT_WEIGHTS
+from pagerank import PageRank, TOLERANCE
+from fetcher import FetchPool, FETCHERS, PER_HOST, DELAY
+
+
+SHARDS = 4  # 分片数
+
+
+def shard_of(url, shards):
+    """
+    根据url的哈希值决定网页所在的分片，使用crc32保证不同进程、不同机器上结果一致
+    :param url: 网页url
+    :param shards: 分片数
+    :return: 分片编号
+    """
+    if isinstance(url, unicode):
+        url = url.encode('utf-8')
+    return (zlib.crc32(url) & 0xffffffff) % shards
+
+
+def shard_path(db_name, shard):
+    """
+    分片数据库的文件名，如 search_index.db 的第0个分片为 search_index.0.db
+    """
+    root, ext = os.path.splitext(db_name)
+    return '%s.%d%s' % (root, shard, ext)
+
+
+def shard_writer(path, shard, inbox, outboxes, results, batch_pages):
+    """
+    分片写入进程，是该分片数据库唯一的写入者
+    收到网页时解析并建立索引，再把网页的外链按链接目标所在的分片转发，链接保存在目标网页所在的分片中，
+    这样回指链接数和链接文字都可以在分片内计算
+    结束时先收到flush，报告向每个分片转发了多少批链接，再收到stop和应当收到的链接批数，全部处理完后退出
+    :param path: 分片数据库
+    :param shard: 分片编号
+    :param inbox: 本分片的消息队列
+    :param outboxes: 所有分片的消息队列
+    :param results: 向主进程报告结果的队列
+    :param batch_pages: 每提交一次事务写入的网页数
+    :return:
+    """
+    crawler = Crawler(path, bulk_index=True)
+    crawler.start_generation()
+    sent = [0] * len(outboxes)
+    received = 0
+    expected = None
+    uncommitted = 0
+    while expected is None or received < expected:
+        message = inbox.get()
+        if message[0] == 'page':
+            url, html = message[1], message[2]
+            try:
+                words, page_links = crawler.parse_page(url, html)
+            except Exception:
+                results.put(('failed', url, []))
+                continue
+            if not crawler.is_indexed(url):
+                crawler.index_words(url, words)
+            grouped = {}
+            for (to_url, link_text) in page_links:
+                grouped.setdefault(shard_of(to_url, len(outboxes)), []).append((to_url, link_text))
+            for (target, links) in grouped.items():
+                outboxes[target].put(('links', url, links))
+                sent[target] += 1
+            results.put(('done', url, [to_url for (to_url, link_text) in page_links]))
+            uncommitted += 1
+        elif message[0] == 'links':
+            crawler.add_page_links(message[1], message[2])
+            received += 1
+            uncommitted += 1
+        elif message[0] == 'flush':
+            results.put(('sent', shard, sent))
+        elif message[0] == 'stop':
+            expected = message[1]
+        if uncommitted >= batch_pages:
+            crawler.db_commit()
+            uncommitted = 0
+    crawler.db_commit()
+    results.put(('stopped', shard, None))
+
+
+class ShardedCrawler:
+    """
+    按url的哈希值把网页分到多个分片数据库中，每个分片由一个独立的写入进程建立索引
+    """
+    def __init__(self, db_name, shards=SHARDS):
+        self.shards = shards
+        self.paths = [shard_path(db_name, i) for i in range(shards)]
+
+    def create_index_tables(self):
+        for path in self.paths:
+            Crawler(path).create_index_tables()
+
+    def is_indexed(self, cons, url):
+        """
+        在url所在的分片中检查网页是否已经建立了索引，与Crawler.is_indexed相同
+        """
+        return cons[shard_of(url, self.shards)].execute(
+            'select 1 from urllist, wordlocation where urllist.url=? and wordlocation.urlid=urllist.rowid limit 1',
+            (url,)).fetchone() is not None
+
+    def crawl(self, pages, depth=CRAWLER_DEPTH, fetchers=FETCHERS, per_host=PER_HOST, delay=DELAY,
+              batch_pages=BATCH_PAGES):
+        """
+        与Crawler.crawl_concurrent相同的逐层广度优先搜索，由主进程中的线程下载网页，
+        按url交给所在分片的写入进程解析和建立索引
+        :param pages: 网页列表
+        :param depth: 循环深度
+        :param fetchers: 抓取线程数
+        :param per_host: 每个站点的并发请求数上限
+        :param delay: 同一站点相邻两次请求之间的最小间隔（秒）
+        :param batch_pages: 写入进程每提交一次事务写入的网页数
+        :return:
+        """
+        inboxes = [Queue() for i in range(self.shards)]
+        results = Queue()
+        writers = [Process(target=shard_writer, args=(self.paths[i], i, inboxes[i], inboxes, results, batch_pages))
+                   for i in range(self.shards)]
+        for writer in writers:  # 先启动写入进程，再启动抓取线程和打开数据库连接
+            writer.start()
+        pool = FetchPool(lambda url, html: html, fetchers, per_host, delay)
+        cons = [sqlite.connect(path) for path in self.paths]
+        try:
+            seen = set(pages)
+            for i in range(depth):
+                for page in pages:
+                    pool.submit(page)
+                pending = 0
+                for n in range(len(pages)):
+                    page, html = pool.get_result()
+                    if html is None:
+                        print 'Could not open %s' % page
+                        continue
+                    inboxes[shard_of(page, self.shards)].put(('page', page, html))
+                    pending += 1
+
+                new_pages = set()
+                for n in range(pending):
+                    status, page, links = results.get()
+                    if status == 'failed':
+                        print 'Could not parse %s' % page
+                    for url in links:
+                        if url[0:4] == 'http' and url not in seen and not self.is_indexed(cons, url):
+                            new_pages.add(url)
+                            seen.add(url)
+                pages = new_pages
+        finally:
+            pool.close()
+            for con in cons:
+                con.close()
+            for inbox in inboxes:
+                inbox.put(('flush',))
+            expected = [0] * self.shards
+            flushed = 0
+            while flushed < self.shards:
+                status, shard, sent = results.get()
+                if status != 'sent':  # 出错中断时队列中可能还有未取出的结果
+                    continue
+                flushed += 1
+                for target in range(self.shards):
+                    expected[target] += sent[target]
+            for shard in range(self.shards):
+                inboxes[shard].put(('stop', expected[shard]))
+            for writer in writers:
+                writer.join()
+
+    def calculate_page_rank(self, iterations=ITERATIONS, tolerance=TOLERANCE):
+        """
+        计算全局PageRank：按url合并所有分片的网页和链接，统一计算后写回每个分片的pagerank表，
+        每个分片中从其他分片链接过来的网页也有全局的PageRank值，链接文字的评价值因此与单个数据库时一致
+        :param iterations: 最大迭代次数
+        :param tolerance: 收敛阈值
+        :return:
+        """
+        crawlers = [Crawler(path) for path in self.paths]
+        global_ids = {}  # url -> 全局id
+        local_to_global = []  # 每个分片：本地urlid -> 全局id
+        edges = set()
+        out_counts = {}
+        for crawler in crawlers:
+            mapping = {}
+            for (url_id, url) in crawler.con.execute('select rowid, url from urllist'):
+                if url not in global_ids:
+                    global_ids[url] = len(global_ids) + 1
+                mapping[url_id] = global_ids[url]
+            local_to_global.append(mapping)
+            for (from_id, to_id) in crawler.con.execute('select distinct fromid, toid from link'):
+                edges.add((mapping[from_id], mapping[to_id]))
+            for (from_id, count) in crawler.con.execute('select fromid, count(*) from link group by fromid'):
+                out_counts[mapping[from_id]] = out_counts.get(mapping[from_id], 0) + count
+
+        engine = PageRank(None)
+        engine.build(range(1, len(global_ids) + 1), list(edges), out_counts.items())
+        engine.iterate(iterations, tolerance)
+
+        for i in range(self.shards):
+            crawler = crawlers[i]
+            crawler.create_score_tables()
+            crawler.con.execute('delete from pagerank')
+            crawler.con.executemany('insert into pagerank(urlid, score) values (?, ?)',
+                                    [(url_id, float(engine.scores[global_id - 1]))
+                                     for (url_id, global_id) in local_to_global[i].items()])
+            crawler.build_link_text_index()
+            crawler.set_info('pagerank_generation', crawler.get_info('crawl_generation', 0))
+            crawler.db_commit()
+
+
+def shard_searcher(path, con):
+    """
+    分片查询进程，持有一个分片的Searcher
+    查询分两步：先返回本分片候选网页的特征最值，再用合并后的全局最值排名，返回前k名及其特征值
+    :param path: 分片数据库
+    :param con: 与前端通信的管道
+    :return:
+    """
+    searcher = Searcher(path, cache_size=0)
+    candidates = None
+    while True:
+        message = con.recv()
+        if message[0] == 'bounds':
+            q, weights = message[1], message[2]
+            candidates = searcher.get_candidates(q, weights)
+            con.send(searcher.get_bounds(candidates, weights) if len(candidates) else None)
+        elif message[0] == 'rank':
+            bounds, k, weights = message[1], message[2], message[3]
+            ranked = []
+            for (score, url_id) in searcher.rank_candidates(candidates, bounds, k, weights):
+                ranked.append((score, searcher.get_url_name(url_id), candidates.get_features(url_id)))
+            con.send(ranked)
+        else:
+            return
+
+
+class ShardedSearcher:
+    """
+    分片查询的前端，每个分片一个查询进程，查询同时发给所有分片，合并各分片的前k名
+    """
+    def __init__(self, db_name, shards=SHARDS):
+        self.connections = []
+        self.workers = []
+        for i in range(shards):
+            front, back = Pipe()
+            worker = Process(target=shard_searcher, args=(shard_path(db_name, i), back))
+            worker.daemon = True
+            worker.start()
+            self.connections.append(front)
+            self.workers.append(worker)
+
+    def close(self):
+        for con in self.connections:
+            con.send(('stop',))
+        for worker in self.workers:
+            worker.join()
+
+    def top_k(self, q, k=TOP_K, weights=None):
+        """
+        返回所有分片中评价值最高的k个结果
+        :param q: 查询字符串
+        :param k: 结果数
+        :param weights: 各特征的权重，默认为DEFAULT_WEIGHTS
+        :return: 按评价值从高到低排列的 [(评价值, url, 特征值字典), ...]
+        """
+        if weights is None:
+            weights = DEFAULT_WEIGHTS
+        for con in self.connections:
+            con.send(('bounds', q, weights))
+        bounds = [con.recv() for con in self.connections]
+        active = [self.connections[i] for i in range(len(bounds)) if bounds[i] is not None]
+        if not active or k <= 0:
+            return []
+        merged = merge_bounds([b for b in bounds if b is not None])
+        for con in active:
+            con.send(('rank', merged, k, weights))
+        results = []
+        for con in active:
+            results.extend(con.recv())
+        results.sort(key=lambda result: (result[0], result[1]), reverse=True)
+        return results[:k]
@@ -0,0 +1,195 @@
+# coding: utf-8
+# author: luyf
+# create date: 2016.12.18
+
+from bisect import bisect_left
+import numpy as np
+from pysqlite2 import dbapi2 as sqlite
+
+
+SUGGESTIONS = 10  # 返回的补全数
+SCAN_LIMIT = 256  # 以某个前缀开头的单词数超过该值时，预先计算该前缀的补全结果
+
+
+def prefix_end(prefix):
+    """
+    :param prefix: 非空前缀
+    :return: 大于所有以prefix开头的字符串的最小字符串（最后一个字符加1）
+    """
+    return prefix[:-1] + unichr(ord(prefix[-1]) + 1)
+
+
+class PrefixIndex:
+    """
+    单词前缀索引，用于输入时的自动补全
+    wordlist中的单词按字典序排列，以某个前缀开头的单词在数组中是连续的一段，用二分查找找到这一段，
+    再按文档频率（含有该单词的网页数）从高到低选出前几个；匹配单词很多的短前缀预先计算好结果
+    英文单词和结巴分词得到的中文词语一样处理，数据库更新后只读取新增的单词和单词位置
+    所有数据保存在一个元组中，更新时整体替换，查询可以与更新同时进行
+    """
+    def __init__(self, con, suggestions=SUGGESTIONS, scan_limit=SCAN_LIMIT):
+        """
+        :param con: 数据库连接，也可以在更新时传入其他连接
+        :param suggestions: 预先计算的补全数
+        :param scan_limit: 预先计算补全结果的单词数阈值
+        """
+        self.suggestions = suggestions
+        self.scan_limit = scan_limit
+        self.state = None  # (单词列表, 单词id数组, 文档频率数组, 预先计算的 {前缀: 补全结果})
+        self.frequency_of_id = np.zeros(1, dtype=np.int64)  # 单词id -> 文档频率
+        self.word_row = 0  # 已读取的wordlist的最大rowid
+        self.location_row = 0  # 已读取的wordlocation的最大rowid
+        self.tombstones = None  # 读取时墓碑表的状态
+        self.build(con)
+
+    def get_tombstones(self, con):
+        """
+        :return: 墓碑表的 (行数, 最大的wordrow, 已合并的墓碑数)，网页被删除、更新或合并之后会发生变化
+        """
+        try:
+            return con.execute('select count(*), max(wordrow), total(compacted) from tombstone').fetchone()
+        except sqlite.OperationalError:  # 旧版本建立的数据库没有tombstone表或compacted字段
+            pass
+        try:
+            return con.execute('select count(*), max(wordrow), 0 from tombstone').fetchone()
+        except sqlite.OperationalError:
+            return (0, None, 0)
+
+    def build(self, con):
+        """
+        读取全部单词和文档频率，重建索引，不计算已失效（被删除或更新前）的单词位置
+        :param con: 数据库连接
+        :return:
+        """
+        self.tombstones = self.get_tombstones(con)
+        self.location_row = con.execute('select max(rowid) from wordlocation').fetchone()[0] or 0
+        rows = con.execute('select rowid, word from wordlist order by rowid').fetchall()
+        self.word_row = rows[-1][0] if rows else 0
+        self.frequency_of_id = np.zeros(self.word_row + 1, dtype=np.int64)
+        if self.tombstones[0]:
+            self.add_frequencies(con, 'select wordid, count(distinct urlid) from wordlocation '
+                                      'where rowid<=? and not (urlid in (select urlid from tombstone) and '
+                                      'rowid<=(select wordrow from tombstone where urlid=wordlocation.urlid)) '
+                                      'group by wordid', (self.location_row,))
+        else:
+            self.add_frequencies(con, 'select wordid, count(distinct urlid) from wordlocation '
+                                      'where rowid<=? group by wordid', (self.location_row,))
+        rows.sort(key=lambda row: row[1])
+        self.set_state([row[1] for row in rows], np.array([row[0] for row in rows], dtype=np.int64))
+
+    def update(self, con):
+        """
+        只读取上次之后新增的单词和单词位置，累加新网页的文档频率，再与已有的单词合并
+        有网页被删除、更新或合并过时，已计算的文档频率不再准确，改为重建
+        :param con: 数据库连接
+        :return: 新增的单词数
+        """
+        location_row = con.execute('select max(rowid) from wordlocation').fetchone()[0] or 0
+        if self.get_tombstones(con) != self.tombstones or location_row < self.location_row:
+            words = len(self.state[0])
+            self.build(con)
+            return len(self.state[0]) - words
+        rows = con.execute('select rowid, word from wordlist where rowid>? order by rowid',
+                           (self.word_row,)).fetchall()
+        if rows:
+            self.word_row = rows[-1][0]
+            frequency_of_id = np.zeros(self.word_row + 1, dtype=np.int64)
+            frequency_of_id[:len(self.frequency_of_id)] = self.frequency_of_id
+            self.frequency_of_id = frequency_of_id
+        if location_row > self.location_row:
+            self.add_frequencies(con, 'select wordid, count(distinct urlid) from wordlocation '
+                                      'where rowid>? and rowid<=? group by wordid', (self.location_row, location_row))
+            self.location_row = location_row
+        elif not rows:
+            return 0
+        words, word_ids = self.state[0], self.state[1]
+        if rows:  # 两段有序的列表，排序时只需要合并
+            rows.sort(key=lambda row: row[1])
+            merged = sorted(zip(words, word_ids.tolist()) + [(word, word_id) for (word_id, word) in rows])
+            words = [word for (word, word_id) in merged]
+            word_ids = np.array([word_id for (word, word_id) in merged], dtype=np.int64)
+        self.set_state(words, word_ids)
+        return len(rows)
+
+    def add_frequencies(self, con, sql, args):
+        counts = np.array(con.execute(sql, args).fetchall(), dtype=np.int64).reshape(-1, 2)
+        counts = counts[counts[:, 0] < len(self.frequency_of_id)]
+        np.add.at(self.frequency_of_id, counts[:, 0], counts[:, 1])
+
+    def set_state(self, words, word_ids):
+        """
+        计算与单词对齐的文档频率，以及所有匹配单词数超过scan_limit的前缀的补全结果
+        从空前缀开始，只把匹配单词过多的前缀按下一个字符继续拆分
+        :param words: 排好序的单词列表
+        :param word_ids: 对应的单词id数组
+        :return:
+        """
+        frequency = self.frequency_of_id[word_ids]
+        hot = {}
+        ranges = [(u'', 0, len(words))]
+        while ranges:
+            prefix, lo, hi = ranges.pop()
+            if hi - lo <= self.scan_limit:
+                continue
+            hot[prefix] = self.top_in_range(words, frequency, lo, hi, self.suggestions)
+            i = lo
+            while i < hi:
+                if len(words[i]) == len(prefix):  # 单词本身就是前缀
+                    i += 1
+                    continue
+                child = words[i][:len(prefix) + 1]
+                j = bisect_left(words, prefix_end(child), i, hi)
+                ranges.append((child, i, j))
+                i = j
+        self.state = (words, word_ids, frequency, hot)
+
+    def top_in_range(self, words, frequency, lo, hi, n):
+        """
+        在words[lo:hi]中选出文档频率最高的n个单词，频率相同时按字典序，不包括频率为0的单词
+        :return: [(单词, 文档频率), ...]
+        """
+        counts = frequency[lo:hi]
+        selected = np.nonzero(counts > 0)[0]
+        if len(selected) > n:
+            kth = np.partition(counts[selected], len(selected) - n)[len(selected) - n]
+            selected = selected[counts[selected] >= kth]
+        selected = selected[np.argsort(-counts[selected], kind='mergesort')[:n]]
+        return [(words[lo + i], int(counts[i])) for i in selected.tolist()]
+
+    def complete(self, prefix, n=SUGGESTIONS):
+        """
+        返回以prefix开头、文档频率最高的n个单词
+        :param prefix: 前缀，转为小写后匹配
+        :param n: 补全数
+        :return: 按文档频率从高到低排列的 [(单词, 文档频率), ...]
+        """
+        if not isinstance(prefix, unicode):
+            prefix = prefix.decode('utf-8')
+        prefix = prefix.lower()
+        words, word_ids, frequency, hot = self.state
+        if n <= self.suggestions and prefix in hot:
+            return hot[prefix][:n]
+        if prefix:
+            lo = bisect_left(words, prefix)
+            hi = bisect_left(words, prefix_end(prefix), lo)
+        else:
+            lo, hi = 0, len(words)
+        return self.top_in_range(words, frequency, lo, hi, n)
+
+    def suggest(self, q, n=SUGGESTIONS):
+        """
+        查询建议：补全查询字符串的最后一个单词，前面的单词保持不变；以空白结尾时补全下一个单词
+        :param q: 用户正在输入的查询字符串
+        :param n: 建议数
+        :return: [(建议的查询字符串, 补全单词的文档频率), ...]
+        """
+        if not isinstance(q, unicode):
+            q = q.decode('utf-8')
+        words = q.split()
+        if not words or q[-1].isspace():
+            words.append(u'')
+        head = u' '.join(words[:-1] + [u''])
+        return [(head + word, count) for (word, count) in self.complete(words[-1], n)]
+
+    def size(self):
+        return len(self.state[0])
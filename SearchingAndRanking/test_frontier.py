@@ -0,0 +1,75 @@
+# coding: utf-8
+# author: luyf
+# create date: 2016.12.21
+
+import os
+import shutil
+import tempfile
+import unittest
+
+from benchmark import CorpusServer
+from frontier import Frontier, PENDING, DONE, FAILED
+from searchengine import Crawler
+
+
+class FrontierTest(unittest.TestCase):
+    """
+    作为种子再次传入的url总是重新抓取，不被布隆过滤器跳过
+    """
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+        self.server = CorpusServer(self.dir)
+        self.crawler = Crawler(os.path.join(self.dir, 'index.db'))
+        self.crawler.create_index_tables()
+
+    def tearDown(self):
+        del self.crawler
+        self.server.close()
+        shutil.rmtree(self.dir)
+
+    def write_page(self, name, text, links=()):
+        with open(os.path.join(self.dir, name), 'w') as f:
+            f.write('<html><body>%s %s</body></html>' % (
+                text, ' '.join('<a href="%s">%s</a>' % (self.server.url(link), link) for link in links)))
+
+    def get_indexed(self):
+        return set(os.path.basename(row[0]) for row in self.crawler.con.execute(
+            'select url from urllist where rowid in (select urlid from wordlocation)'))
+
+    def get_state(self, name):
+        return self.crawler.con.execute('select depth, state from frontier where url=?',
+                                        (self.server.url(name),)).fetchone()
+
+    def test_reseed_known_url(self):
+        self.write_page('a.html', 'apple', ['c.html'])
+        self.write_page('c.html', 'cherry', ['d.html'])
+        self.write_page('d.html', 'date')
+        self.crawler.crawl([self.server.url('a.html')], depth=2)
+        self.assertEqual(self.get_indexed(), set(['a.html', 'c.html']))
+        self.assertEqual(self.get_state('d.html'), (2, PENDING))
+
+        self.crawler.crawl([self.server.url('c.html')], depth=2)
+        self.assertEqual(self.get_indexed(), set(['a.html', 'c.html', 'd.html']))
+        self.assertEqual(self.get_state('c.html'), (0, DONE))
+        self.assertEqual(self.get_state('d.html'), (1, DONE))
+
+    def test_reseed_failed_url(self):
+        self.crawler.crawl([self.server.url('b.html')], depth=1)
+        self.assertEqual(self.get_state('b.html'), (0, FAILED))
+        self.assertEqual(self.get_indexed(), set())
+
+        self.write_page('b.html', 'banana')
+        self.crawler.crawl([self.server.url('b.html')], depth=1)
+        self.assertEqual(self.get_state('b.html'), (0, DONE))
+        self.assertEqual(self.get_indexed(), set(['b.html']))
+
+    def test_add_skips_seen_url(self):
+        frontier = Frontier(self.crawler.con)
+        frontier.add_seeds(['http://a/'])
+        self.assertEqual(frontier.add(['http://a/', 'http://b/'], 1), 1)
+        self.assertEqual(frontier.pending(0), ['http://a/'])
+        self.assertEqual(frontier.pending(1), ['http://b/'])
+
+
+if __name__ == '__main__':
+    unittest.main()
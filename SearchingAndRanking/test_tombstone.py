@@ -0,0 +1,180 @@
+# coding: utf-8
+# author: luyf
+# create date: 2016.12.20
+
+import os
+import shutil
+import tempfile
+import unittest
+
+from pysqlite2 import dbapi2 as sqlite
+from pagerank import PageRank
+from searchengine import Crawler, Searcher, page_digest
+
+PAGES = [
+    ('http://a.example/', '<html><body>apple banana <a href="http://c.example/">banana</a></body></html>'),
+    ('http://b.example/', '<html><body>apple cherry <a href="http://c.example/">cherry</a></body></html>'),
+    ('http://c.example/', '<html><body>banana date</body></html>'),
+]
+
+
+class TombstoneTest(unittest.TestCase):
+    """
+    删除网页之后，无论是否合并、是否使用索引文件，查询都不再返回该网页，链接文字也不再计分
+    """
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+        self.db = os.path.join(self.dir, 'index.db')
+        self.index_file = os.path.join(self.dir, 'index.idx')
+        self.crawler = Crawler(self.db)
+        self.crawler.create_index_tables()
+        for (url, html) in PAGES:
+            self.crawler.update_page(url, html)
+        self.crawler.calculate_page_rank()
+        self.crawler.export_index_file(self.index_file)
+
+    def tearDown(self):
+        del self.crawler
+        shutil.rmtree(self.dir)
+
+    def get_url_id(self, url):
+        return self.crawler.con.execute('select rowid from urllist where url=?', (url,)).fetchone()[0]
+
+    def get_urls(self, searcher, q):
+        return set(searcher.features.get_url(url_id) for (score, url_id) in searcher.top_k(q))
+
+    def get_link_text(self, searcher, word, url):
+        word_id = searcher.get_word_ids(word)[0]
+        return sum(score for (to_id, score) in searcher.get_link_text_rows(word_id) if to_id == self.get_url_id(url))
+
+    def test_delete_compact_query_index_file(self):
+        searchers = [Searcher(self.db, cache_size=0), Searcher(self.db, index_file=self.index_file, cache_size=0)]
+        for searcher in searchers:
+            self.assertEqual(self.get_urls(searcher, u'apple'), set(['http://a.example/', 'http://b.example/']))
+
+        self.crawler.delete_page('http://a.example/')
+        for searcher in searchers:
+            self.assertEqual(self.get_urls(searcher, u'apple'), set(['http://b.example/']))
+
+        self.crawler.compact()
+        for searcher in searchers:
+            self.assertEqual(self.get_urls(searcher, u'apple'), set(['http://b.example/']))
+
+        self.crawler.export_index_file(self.index_file)
+        self.assertEqual(self.crawler.con.execute('select count(*) from tombstone').fetchone()[0], 0)
+        for searcher in searchers:
+            self.assertEqual(self.get_urls(searcher, u'apple'), set(['http://b.example/']))
+
+    def test_update_index_file(self):
+        searchers = [Searcher(self.db, cache_size=0), Searcher(self.db, index_file=self.index_file, cache_size=0)]
+        self.crawler.update_page('http://a.example/', '<html><body>cherry fig</body></html>')
+        self.crawler.update_page('http://d.example/', '<html><body>apple fig</body></html>')
+        for searcher in searchers:
+            self.assertEqual(self.get_urls(searcher, u'apple'), set(['http://b.example/', 'http://d.example/']))
+            self.assertEqual(self.get_urls(searcher, u'cherry'), set(['http://a.example/', 'http://b.example/']))
+            self.assertEqual(self.get_urls(searcher, u'fig'), set(['http://a.example/', 'http://d.example/']))
+            self.assertEqual(searcher.top_k_many([u'apple', u'fig']), [searcher.top_k(u'apple'), searcher.top_k(u'fig')])
+
+        self.crawler.compact()
+        self.crawler.update_page('http://a.example/', '<html><body>apple</body></html>')
+        for searcher in searchers:
+            self.assertEqual(self.get_urls(searcher, u'apple'),
+                             set(['http://a.example/', 'http://b.example/', 'http://d.example/']))
+            self.assertEqual(self.get_urls(searcher, u'fig'), set(['http://d.example/']))
+
+        self.crawler.export_index_file(self.index_file)
+        for searcher in searchers:
+            self.assertEqual(self.get_urls(searcher, u'apple'),
+                             set(['http://a.example/', 'http://b.example/', 'http://d.example/']))
+            self.assertEqual(self.get_urls(searcher, u'fig'), set(['http://d.example/']))
+        self.assertFalse(searchers[1].features.has_unexported_rows())
+
+    def test_deleted_link_text_source(self):
+        searcher = Searcher(self.db, cache_size=0)
+        searcher.refresh()
+        self.assertTrue(searcher.features.link_text_index)
+        self.assertGreater(self.get_link_text(searcher, u'banana', 'http://c.example/'), 0)
+        cherry = self.get_link_text(searcher, u'cherry', 'http://c.example/')
+
+        self.crawler.delete_page('http://a.example/')
+        searcher.refresh()
+        self.assertAlmostEqual(self.get_link_text(searcher, u'banana', 'http://c.example/'), 0)
+
+        self.crawler.compact()
+        searcher.refresh()
+        self.assertAlmostEqual(self.get_link_text(searcher, u'banana', 'http://c.example/'), 0)
+        self.assertAlmostEqual(self.get_link_text(searcher, u'cherry', 'http://c.example/'), cherry)
+
+    def test_update_unicode_html(self):
+        html = u'<html><body>apple \u82f9\u679c <a href="http://c.example/">\u9999\u8549</a></body></html>'
+        self.crawler.update_page('http://a.example/', html)
+        searcher = Searcher(self.db, cache_size=0)
+        self.assertEqual(self.get_urls(searcher, u'\u82f9\u679c'), set(['http://a.example/']))
+        self.assertEqual(self.get_urls(searcher, u'banana'), set(['http://c.example/']))
+        self.assertEqual(self.crawler.get_page_state(self.get_url_id('http://a.example/'))[2],
+                         page_digest(html.encode('utf-8')))
+
+    def get_page_ranks(self):
+        return dict(self.crawler.con.execute('select urllist.url, pagerank.score from urllist, pagerank '
+                                             'where urllist.rowid=pagerank.urlid'))
+
+    def test_update_new_url(self):
+        updates = []
+        update = PageRank.update
+
+        def spy(engine, *args):
+            updates.append(args)
+            return update(engine, *args)
+        PageRank.update = spy
+        try:
+            self.crawler.update_page('http://d.example/', '<html><body>elder <a href="http://c.example/">c</a></body></html>')
+            self.assertEqual(self.crawler.con.execute('select count(*) from tombstone').fetchone()[0], 0)
+            self.crawler.calculate_page_rank(incremental=True)
+        finally:
+            PageRank.update = update
+        self.assertEqual(len(updates), 1)
+        self.assertEqual(self.get_urls(Searcher(self.db, cache_size=0), u'elder'), set(['http://d.example/']))
+
+    def test_compact_incremental_page_rank(self):
+        self.crawler.update_page('http://a.example/', '<html><body>apple</body></html>')
+        self.crawler.delete_page('http://b.example/')
+        self.crawler.calculate_page_rank(incremental=True)
+        self.assertEqual(self.crawler.get_tombstone_count(), 0)
+        incremental = self.get_page_ranks()
+        self.crawler.calculate_page_rank(iterations=100)
+        for (url, score) in self.get_page_ranks().items():
+            self.assertAlmostEqual(incremental[url], score, places=5)
+        self.assertAlmostEqual(incremental['http://c.example/'], 0.15)
+
+    def test_recrawl_update_one_transaction(self):
+        reader = sqlite.connect(self.db)
+        visible = []
+        add_page_links = self.crawler.add_page_links
+
+        def spy(url, links):
+            add_page_links(url, links)
+            visible.append(reader.execute('select count(*) from tombstone').fetchone()[0])
+        self.crawler.add_page_links = spy
+        self.crawler.generation = None  # 与recrawl相同，第一次写入链接时开始新的一代
+        self.crawler.update_page('http://a.example/', '<html><body>cherry <a href="http://b.example/">b</a></body></html>')
+        self.assertEqual(visible, [0])
+        self.assertEqual(reader.execute('select count(*) from tombstone').fetchone()[0], 1)
+        reader.close()
+
+    def test_update_rollback(self):
+        searcher = Searcher(self.db, cache_size=0)
+        generation = self.crawler.get_info('index_generation')
+
+        def fail(url, links):
+            raise IOError()
+        self.crawler.add_page_links = fail
+        self.assertRaises(IOError, self.crawler.update_page, 'http://a.example/', '<html><body>cherry</body></html>')
+        del self.crawler.add_page_links
+        self.crawler.db_commit()
+        self.assertEqual(self.crawler.get_info('index_generation'), generation)
+        self.assertEqual(self.get_urls(searcher, u'apple'), set(['http://a.example/', 'http://b.example/']))
+        self.assertEqual(self.get_urls(searcher, u'cherry'), set(['http://b.example/']))
+
+
+if __name__ == '__main__':
+    unittest.main()
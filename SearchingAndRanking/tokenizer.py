@@ -0,0 +1,121 @@
+# coding: utf-8
+# author: luyf
+# create date: 2016.12.13
+
+import re
+from multiprocessing import Pool
+import jieba
+from bs4 import NavigableString
+
+
+SPLITTER = re.compile(ur'[^a-zA-Z0-9_\u4e00-\u9fa5]')  # 任意不是字母，数字，下划线，汉字的字符
+HAN = re.compile(ur'[\u4e00-\u9fa5]')
+UNDERSCORES = re.compile(r'(_+)')  # 结巴分词把连续的下划线作为一个词
+TOKENIZERS = 0  # 并发抓取时的分词进程数，为0时不使用进程池
+SEPARATOR = u'\n'  # 批量分词时片段之间的分隔符，结巴分词会把它作为单独的一个词返回
+
+
+def extract_text(soup):
+    """
+    按文字出现的前后顺序获取网页中的文字，结果与原来递归拼接字符串的Crawler.get_text_only完全相同，
+    但各部分先放入列表最后一次拼接，耗时与网页大小成线性关系
+    :param soup: 含有标签的网页
+    :return: 网页中的文字
+    """
+    parts = []
+    collect_text(soup, parts)
+    return u''.join(parts)
+
+
+def collect_text(node, parts):
+    if isinstance(node, NavigableString):
+        parts.append(node.strip())
+        return
+    text = node.string  # 只有一个子节点的时候，获取该节点的内容，否则返回None
+    if text is not None:
+        parts.append(text.strip())
+        return
+    for content_item in node.contents:
+        collect_text(content_item, parts)
+        parts.append(u'\n')
+
+
+def split_fragments(text):
+    """
+    按非单词字符拆分字符串，并把片段转换为小写
+    :param text: 待拆分的字符串
+    :return: [(片段, 是否含有汉字), ...]
+    """
+    fragments = []
+    for s in SPLITTER.split(text):
+        if s != '':
+            s = s.lower()
+            if not isinstance(s, unicode):
+                s = unicode(s)
+            fragments.append((s, HAN.search(s) is not None))
+    return fragments
+
+
+def split_ascii(s):
+    """
+    不含汉字的片段只由字母、数字和下划线组成，不需要调用结巴分词，
+    结果与jieba.lcut相同：以连续的下划线为界拆开，下划线本身也是一个词
+    """
+    if '_' not in s:
+        return [s]
+    return [w for w in UNDERSCORES.split(s) if w]
+
+
+def segment_han(fragments):
+    """
+    用一次jieba.lcut对多个含有汉字的片段分词，片段之间以换行符分隔
+    :param fragments: 片段列表
+    :return: 与片段一一对应的分词结果列表
+    """
+    results = [[]]
+    if not fragments:
+        return []
+    for word in jieba.lcut(SEPARATOR.join(fragments)):
+        if word == SEPARATOR:
+            results.append([])
+        else:
+            results[-1].append(word)
+    return results
+
+
+def separate_words(text):
+    """
+    将字符串拆分成一组独立的单词，结果与原来对每个片段都调用jieba.lcut的方式相同
+    :param text: 待拆分的字符串
+    :return: 单词list
+    """
+    return separate_words_many([text])[0]
+
+
+def separate_words_many(texts):
+    """
+    separate_words的批量版本，所有文本中含有汉字的片段一起交给结巴分词
+    :param texts: 字符串列表
+    :return: 与之对应的单词list的列表
+    """
+    all_fragments = [split_fragments(text) for text in texts]
+    han = iter(segment_han([s for fragments in all_fragments for (s, is_han) in fragments if is_han]))
+    results = []
+    for fragments in all_fragments:
+        words = []
+        for (s, is_han) in fragments:
+            if is_han:
+                words.extend(next(han))
+            else:
+                words.extend(split_ascii(s))
+        results.append(words)
+    return results
+
+
+def create_tokenize_pool(processes):
+    """
+    创建分词进程池，每个进程启动时先加载结巴分词的词典
+    :param processes: 进程数
+    :return: multiprocessing.Pool
+    """
+    return Pool(processes, initializer=jieba.initialize)
@@ -0,0 +1,154 @@
+# coding: utf-8
+# author: luyf
+# create date: 2016.12.19
+
+import numpy as np
+
+
+FLUSH_INTERVAL = 100  # 累积多少次训练后把修改过的权重写回数据库
+BATCH_SIZE = 500  # 一条select语句中in列表的长度上限，不超过SQLite的参数个数限制
+DEFAULT_STRENGTH = (-0.2, 0.0)  # 连接不存在时的默认强度，单词层到隐藏层为-0.2，隐藏层到输出层为0
+TABLES = ('wordhidden', 'hiddenurl')
+
+
+class WeightStore:
+    """
+    Searchnet的连接强度在内存中的缓存，按层保存为 {(fromid, toid): 强度} 的稀疏字典
+    单词层到隐藏层按单词（fromid）整片读取，隐藏层到输出层按url（toid）整片读取，每次读取只需要一条查询，
+    读过的片一直留在内存中，因此与查询相关的隐藏节点也不必再查数据库
+    修改只记录在内存中并标记为脏，每累积flush_interval次训练用executemany批量写回，一次提交
+    假定只有这一个连接在修改这两张表
+    """
+    def __init__(self, con, flush_interval=FLUSH_INTERVAL):
+        """
+        :param con: 数据库连接
+        :param flush_interval: 写回间隔（训练次数），不大于1时每次训练都写回
+        """
+        self.con = con
+        self.flush_interval = flush_interval
+        self.strengths = ({}, {})  # 每层 (fromid, toid) -> 强度
+        self.rowids = ({}, {})  # 每层 (fromid, toid) -> 数据库中的rowid，新建的连接写回之前没有rowid
+        self.links = ({}, {})  # 单词 -> 相连的隐藏节点集合，url -> 相连的隐藏节点集合，只包含已读取的片
+        self.dirty = (set(), set())  # 每层修改过还没有写回的 (fromid, toid)
+        self.pending = 0  # 上次写回之后的训练次数
+
+    def load(self, word_ids, url_ids):
+        """
+        读取还没有读取过的单词和url的连接，每层一条查询（in列表过长时分批）
+        已经在内存中的连接可能比数据库中的新，不被覆盖
+        :param word_ids: 单词id列表
+        :param url_ids: url id列表
+        :return:
+        """
+        for (layer, ids) in ((0, word_ids), (1, url_ids)):
+            missing = [node_id for node_id in set(ids) if node_id not in self.links[layer]]
+            for node_id in missing:
+                self.links[layer][node_id] = set()
+            column = 'fromid' if layer == 0 else 'toid'
+            for start in range(0, len(missing), BATCH_SIZE):
+                batch = missing[start:start + BATCH_SIZE]
+                cur = self.con.execute('select rowid, fromid, toid, strength from %s where %s in (%s)'
+                                       % (TABLES[layer], column, ','.join('?' * len(batch))), batch)
+                for (rowid, from_id, to_id, strength) in cur:
+                    self.rowids[layer][(from_id, to_id)] = rowid
+                    self.strengths[layer].setdefault((from_id, to_id), strength)
+                    self.add_link(layer, from_id, to_id)
+
+    def add_link(self, layer, from_id, to_id):
+        if layer == 0:
+            self.links[0][from_id].add(to_id)
+        else:
+            self.links[1][to_id].add(from_id)
+
+    def get_hidden_ids(self, word_ids, url_ids):
+        """
+        :return: 与任一单词或任一url相连的隐藏节点，按id排序
+        """
+        self.load(word_ids, url_ids)
+        hidden_ids = set()
+        for word_id in word_ids:
+            hidden_ids.update(self.links[0][word_id])
+        for url_id in url_ids:
+            hidden_ids.update(self.links[1][url_id])
+        return sorted(hidden_ids)
+
+    def get(self, from_id, to_id, layer):
+        self.load([from_id] if layer == 0 else [], [to_id] if layer == 1 else [])
+        return self.strengths[layer].get((from_id, to_id), DEFAULT_STRENGTH[layer])
+
+    def set(self, from_id, to_id, layer, strength):
+        self.load([from_id] if layer == 0 else [], [to_id] if layer == 1 else [])
+        self.strengths[layer][(from_id, to_id)] = strength
+        self.dirty[layer].add((from_id, to_id))
+        self.add_link(layer, from_id, to_id)
+
+    def get_matrix(self, layer, from_ids, to_ids):
+        """
+        :return: 权重矩阵，第i行第j列是from_ids[i]到to_ids[j]的强度，调用前对应的片应已读取
+        """
+        strengths = self.strengths[layer]
+        default = DEFAULT_STRENGTH[layer]
+        return np.array([[strengths.get((from_id, to_id), default) for to_id in to_ids]
+                         for from_id in from_ids], dtype=np.float64).reshape(len(from_ids), len(to_ids))
+
+    def set_matrix(self, layer, from_ids, to_ids, matrix):
+        """
+        用训练后的权重矩阵更新内存中的强度，调用前对应的片应已读取
+        """
+        strengths = self.strengths[layer]
+        dirty = self.dirty[layer]
+        values = matrix.tolist()
+        for (i, from_id) in enumerate(from_ids):
+            for (j, to_id) in enumerate(to_ids):
+                strengths[(from_id, to_id)] = values[i][j]
+                dirty.add((from_id, to_id))
+                self.add_link(layer, from_id, to_id)
+
+    def add_matrix(self, layer, from_ids, to_ids, matrix):
+        """
+        把改变量矩阵累加到内存中的强度上，不存在的连接从默认值开始，调用前对应的片应已读取
+        """
+        strengths = self.strengths[layer]
+        dirty = self.dirty[layer]
+        default = DEFAULT_STRENGTH[layer]
+        values = matrix.tolist()
+        for (i, from_id) in enumerate(from_ids):
+            for (j, to_id) in enumerate(to_ids):
+                strengths[(from_id, to_id)] = strengths.get((from_id, to_id), default) + values[i][j]
+                dirty.add((from_id, to_id))
+                self.add_link(layer, from_id, to_id)
+
+    def tick(self):
+        """
+        完成一次训练，累积到写回间隔时写回
+        :return: 是否写回
+        """
+        self.pending += 1
+        if self.pending < self.flush_interval:
+            return False
+        self.flush()
+        return True
+
+    def flush(self):
+        """
+        把脏的连接写回数据库：已有的按rowid批量更新，新建的批量插入，然后一次提交
+        :return: 写回的连接数
+        """
+        written = 0
+        for layer in (0, 1):
+            strengths, rowids = self.strengths[layer], self.rowids[layer]
+            updates = [(strengths[key], rowids[key]) for key in self.dirty[layer] if key in rowids]
+            inserts = [key for key in self.dirty[layer] if key not in rowids]
+            self.con.executemany('update %s set strength=? where rowid=?' % TABLES[layer], updates)
+            if inserts:
+                self.con.executemany('insert into %s(fromid,toid,strength) values (?,?,?)' % TABLES[layer],
+                                     [(from_id, to_id, strengths[(from_id, to_id)]) for (from_id, to_id) in inserts])
+                # 表没有声明autoincrement，同一事务中连续插入的行的rowid是连续的，最后一行的rowid是最大值
+                last = self.con.execute('select max(rowid) from %s' % TABLES[layer]).fetchone()[0]
+                for (n, key) in enumerate(inserts):
+                    rowids[key] = last - len(inserts) + 1 + n
+            written += len(updates) + len(inserts)
+            self.dirty[layer].clear()
+        self.con.commit()
+        self.pending = 0
+        return written